@@ -1,19 +1,216 @@
-from typing import Optional, Dict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Dict, List
+import asyncio
+import contextvars
 import httpx
 import secrets
 import string
+import time
+from .balancer import Balancer, Endpoint, parse_backend_urls
+from .codec import dumps, loads
 from .config import settings
+from .dataloader import DataLoader
+from .deadline import DeadlineExceeded, clamp_timeout, remaining
+from .hedging import HedgeBudget, LatencyTracker, hedged
+from .lanes import Lane
 from .logger import logger
+from .recorder import recorder
+from .schemas import ChatReply, Conversation, HistoryMessage, TelegramUser
+from .tracing import current_span, inject_headers, span
+
+# Пакетные маршруты backend (BACKEND_BATCHING): поиск Telegram пользователей и создание/получение
+TELEGRAM_USERS_LOOKUP_PATH = "/api/telegram/users/batch/lookup"
+TELEGRAM_USERS_BATCH_PATH = "/api/telegram/users/batch"
+# Через сколько секунд снова пробовать пакетный маршрут, которого не было (backend могли обновить)
+_BATCH_ROUTE_RETRY_SECONDS = 300.0
+
+# Общие HTTP-клиенты (по экземплярам backend) для запросов пакета, ушедшего поштучно:
+# соединения переиспользуются
+_shared_clients: contextvars.ContextVar[Optional[Dict[str, httpx.AsyncClient]]] = contextvars.ContextVar(
+    "backend_shared_clients", default=None
+)
+
+
+class TokenRejected(Exception):
+    """Backend отклонил токен (401/403): нужен новый вход"""
 
 
 class BackendClient:
     def __init__(self):
-        self.base_url = settings.backend_url.rstrip("/")
+        # Экземпляры backend (BACKEND_URL через запятую) и выбор экземпляра для запроса
+        self.balancer = Balancer(
+            parse_backend_urls(settings.backend_url),
+            sticky=settings.backend_sticky,
+            eject_after_failures=settings.backend_eject_after_failures,
+            eject_seconds=settings.backend_eject_seconds,
+            max_ejected_fraction=settings.backend_max_ejected_fraction,
+        )
         self.headers = {
             "Content-Type": "application/json",
         }
+        # Количество запросов к backend, которые сейчас выполняются
+        self.in_flight = 0
+        # Хуки httpx по экземплярам: статус ответа учитывается для пассивного исключения
+        self._event_hooks = {
+            endpoint.url: {"request": [self._on_request], "response": [self._on_response, self._status_hook(endpoint)]}
+            for endpoint in self.balancer.endpoints
+        }
+        # Транспорт httpx (None — сеть); app/replay.py подставляет записанные ответы
+        self.transport: Optional[httpx.AsyncBaseTransport] = None
+        # Длительности идемпотентных GET по маршрутам (порог хеджирования) и бюджет дубликатов
+        self.latency = LatencyTracker()
+        self.hedge_budget = HedgeBudget(ratio=settings.backend_hedge_ratio)
+        # Ограничение одновременных запросов к backend (BACKEND_MAX_CONNECTIONS, 0 — без ограничения)
+        self.pool = Lane("backend", settings.backend_max_connections)
+        # SSL-контекст создается один раз: его построение на каждый вызов занимает десятки мс и блокирует event loop
+        self._ssl_context = httpx.create_ssl_context()
+        # Пакетирование поштучных запросов пользователей (BACKEND_BATCHING)
+        self.telegram_users: DataLoader[int, TelegramUser] = DataLoader(
+            "telegram_users",
+            self._lookup_telegram_users,
+            window_seconds=settings.backend_batch_window_seconds,
+            max_batch=settings.backend_batch_max_size,
+        )
+        self.telegram_user_upserts: DataLoader[int, TelegramUser] = DataLoader(
+            "telegram_user_upserts",
+            self._upsert_telegram_users,
+            window_seconds=settings.backend_batch_window_seconds,
+            max_batch=settings.backend_batch_max_size,
+        )
+        # Пакетный маршрут -> момент, до которого он считается отсутствующим
+        self._batch_missing_until: Dict[str, float] = {}
+        # Пакеты, ушедшие поштучными запросами из-за отсутствия маршрута
+        self.batch_fallbacks = 0
+
+    @staticmethod
+    async def _on_request(request: httpx.Request) -> None:
+        inject_headers(request.headers)
+        current = current_span()
+        current.set("http.method", request.method)
+        current.set("http.path", request.url.path)
+
+    @staticmethod
+    async def _on_response(response: httpx.Response) -> None:
+        current_span().set("http.status_code", response.status_code)
+        if recorder.enabled:
+            try:
+                await recorder.record_backend(response)
+            except Exception as e:
+                logger.warning("Failed to record backend call: %s", e)
+
+    def _status_hook(self, endpoint: Endpoint) -> Callable[[httpx.Response], Awaitable[None]]:
+        async def hook(response: httpx.Response) -> None:
+            self.balancer.record(endpoint, response.status_code < 500)
+        return hook
+
+    def _new_client(self, endpoint: Endpoint, timeout: float) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=endpoint.url,
+            timeout=timeout,
+            event_hooks=self._event_hooks[endpoint.url],
+            transport=self.transport,
+            verify=self._ssl_context,
+        )
+
+    @asynccontextmanager
+    async def _client(
+        self, timeout: float, key: Optional[str] = None, tried: Optional[List[Endpoint]] = None
+    ) -> AsyncIterator[httpx.AsyncClient]:
+        """HTTP-клиент для одного вызова backend: выбор экземпляра, учет запросов в полете
+        и спан трассировки. key — разговор или документ, запросы которого идут на один экземпляр.
+        tried — экземпляры, которым этот запрос уже отправлен (хеджирование): выбирается другой,
+        а выбранный дописывается в список.
+        Таймаут не выходит за дедлайн обработки обновления; ожидание места в пуле
+        соединений входит в таймаут."""
+        timeout = clamp_timeout(timeout)
+        started = time.monotonic()
+        async with asyncio.timeout(timeout):
+            await self.pool.__aenter__()
+        self.in_flight += 1
+        endpoint = self.balancer.acquire(key, tried or ())
+        if tried is not None:
+            tried.append(endpoint)
+        sent = time.monotonic()
+        elapsed: Optional[float] = None
+        try:
+            with span("backend.http") as current:
+                current.set("backend.endpoint", endpoint.url)
+                shared = _shared_clients.get()
+                if shared is not None:
+                    if endpoint.url not in shared:
+                        shared[endpoint.url] = self._new_client(endpoint, settings.backend_timeout_seconds)
+                    yield shared[endpoint.url]
+                else:
+                    async with self._new_client(endpoint, max(0.001, timeout - (sent - started))) as client:
+                        yield client
+            elapsed = time.monotonic() - sent
+        except httpx.TransportError:
+            # Сетевая ошибка или таймаут: длительность не показательна, но считается ошибкой экземпляра
+            self.balancer.record(endpoint, False)
+            raise
+        except asyncio.CancelledError:
+            # Запрос отменен (проиграл хеджированию, дедлайн): задержка не меньше прошедшего времени
+            elapsed = time.monotonic() - sent
+            raise
+        except httpx.HTTPStatusError:
+            # Статус уже учтен хуком ответа
+            elapsed = time.monotonic() - sent
+            raise
+        finally:
+            self.balancer.release(endpoint, elapsed)
+            self.in_flight -= 1
+            await self.pool.__aexit__(None, None, None)
+
+    async def _get(
+        self, route: str, url: str, params: Optional[Dict] = None, key: Optional[str] = None
+    ) -> httpx.Response:
+        """
+        GET идемпотентного маршрута. Общее время ограничено таймаутом и дедлайном обновления;
+        при BACKEND_HEDGING медленный запрос дублируется после p95 маршрута.
+        """
+        timeout = clamp_timeout(settings.backend_timeout_seconds)
+        # Экземпляры, которым уже отправлен этот запрос: дубликат уходит на другой
+        tried: List[Endpoint] = []
 
-    def _generate_email(self, telegram_user_id: int, telegram_username: Optional[str] = None) -> str:
+        async def attempt() -> httpx.Response:
+            started = time.monotonic()
+            async with self._client(timeout=timeout, key=key, tried=tried) as client:
+                r = await client.get(url, headers=self.headers, params=params)
+            if r.status_code >= 500:
+                # Ошибка экземпляра — неудачная попытка: hedged дождется второй, если она есть
+                r.raise_for_status()
+            self.latency.observe(route, time.monotonic() - started)
+            return r
+
+        delay = self.latency.p95(route) if settings.backend_hedging else None
+        try:
+            return await asyncio.wait_for(hedged(attempt, delay, self.hedge_budget), timeout)
+        except asyncio.TimeoutError:
+            left = remaining()
+            if left is not None and left <= 0:
+                raise DeadlineExceeded() from None
+            raise
+
+    async def ping(self, path: str, timeout: float) -> int:
+        """
+        Проверка доступности backend для /readyz: лучший HTTP-статус среди экземпляров
+        (backend готов, если отвечает хотя бы один). Идет мимо пула запросов, балансировки,
+        дедлайна и записи трафика; ошибка — если не ответил ни один экземпляр.
+        """
+        async def one(endpoint: Endpoint) -> int:
+            async with httpx.AsyncClient(
+                base_url=endpoint.url, timeout=timeout, transport=self.transport, verify=self._ssl_context
+            ) as client:
+                r = await client.get(path)
+            return r.status_code
+
+        results = await asyncio.gather(*(one(endpoint) for endpoint in self.balancer.endpoints), return_exceptions=True)
+        statuses = [result for result in results if isinstance(result, int)]
+        if not statuses:
+            raise results[0]
+        return min(statuses)
+
+    def generate_email(self, telegram_user_id: int, telegram_username: Optional[str] = None) -> str:
         """Генерирует email на основе telegram_user_id"""
         if telegram_username:
             # Используем username если есть, очищаем от недопустимых символов
@@ -21,7 +218,7 @@ class BackendClient:
             return f"tg_{safe_username}_{telegram_user_id}@telegram.local"
         return f"tg_user_{telegram_user_id}@telegram.local"
 
-    def _generate_password(self, length: int = 16) -> str:
+    def generate_password(self, length: int = 16) -> str:
         """Генерирует случайный безопасный пароль"""
         alphabet = string.ascii_letters + string.digits + "!@#$%^&*"
         return ''.join(secrets.choice(alphabet) for _ in range(length))
@@ -33,14 +230,14 @@ class BackendClient:
         Returns:
             True если пользователь существует, False если нет
         """
-        url = f"{self.base_url}/api/auth/check-telegram-username"
+        url = "/api/auth/check-telegram-username"
         params = {"telegram_username": telegram_username}
         
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
+            async with self._client(timeout=settings.backend_timeout_seconds) as client:
                 r = await client.get(url, headers=self.headers, params=params)
                 r.raise_for_status()
-                data = r.json()
+                data = loads(r.content)
                 # Предполагаем, что ответ содержит поле exists или similar
                 return data.get("exists", False) or data.get("user_exists", False)
         except httpx.HTTPStatusError as e:
@@ -48,6 +245,9 @@ class BackendClient:
                 return False
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return False
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return False
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return False
@@ -66,7 +266,7 @@ class BackendClient:
         Returns:
             Словарь с токеном и данными пользователя или None в случае ошибки
         """
-        url = f"{self.base_url}/api/auth/register"
+        url = "/api/auth/register"
         payload = {
             "email": email,
             "password": password,
@@ -78,10 +278,10 @@ class BackendClient:
             payload["full_name"] = full_name
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.post(url, headers=self.headers, json=payload)
+            async with self._client(timeout=settings.backend_timeout_seconds) as client:
+                r = await client.post(url, headers=self.headers, content=dumps(payload))
                 r.raise_for_status()
-                data = r.json()
+                data = loads(r.content)
                 return {
                     "token": data.get("token"),
                     "user_id": data.get("user_id"),
@@ -94,6 +294,9 @@ class BackendClient:
                 raise Exception(f"User already exists: {e.response.text}")
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
@@ -105,17 +308,17 @@ class BackendClient:
         Returns:
             Словарь с токеном или None в случае ошибки
         """
-        url = f"{self.base_url}/api/auth/login"
+        url = "/api/auth/login"
         payload = {
             "email": email,
             "password": password,
         }
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.post(url, headers=self.headers, json=payload)
+            async with self._client(timeout=settings.backend_timeout_seconds) as client:
+                r = await client.post(url, headers=self.headers, content=dumps(payload))
                 r.raise_for_status()
-                data = r.json()
+                data = loads(r.content)
                 return {
                     "token": data.get("token"),
                     "user_id": data.get("user_id"),
@@ -123,6 +326,9 @@ class BackendClient:
         except httpx.HTTPStatusError as e:
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
@@ -130,18 +336,23 @@ class BackendClient:
     async def get_profile(self, token: str) -> Optional[Dict]:
         """
         Получает профиль пользователя по токену.
+        TokenRejected — токен истек или недействителен (см. app/sessions.py).
         """
-        url = f"{self.base_url}/api/auth/profile"
+        url = "/api/auth/profile"
         params = {"token": token}
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.get(url, headers=self.headers, params=params)
-                r.raise_for_status()
-                return r.json()
+            r = await self._get("profile", url, params=params)
+            r.raise_for_status()
+            return loads(r.content)
         except httpx.HTTPStatusError as e:
+            if e.response.status_code in (401, 403):
+                raise TokenRejected() from None
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
@@ -152,14 +363,14 @@ class BackendClient:
         telegram_username: Optional[str] = None,
         first_name: Optional[str] = None,
         last_name: Optional[str] = None
-    ) -> Optional[Dict]:
+    ) -> Optional[TelegramUser]:
         """
         Создает или получает существующего Telegram пользователя.
+        При BACKEND_BATCHING запрос объединяется с запросами других пользователей.
         
         Returns:
-            Словарь с данными Telegram пользователя или None в случае ошибки
+            Данные Telegram пользователя или None в случае ошибки
         """
-        url = f"{self.base_url}/api/telegram/users"
         payload = {
             "telegram_user_id": telegram_user_id,
         }
@@ -170,44 +381,147 @@ class BackendClient:
         if last_name:
             payload["last_name"] = last_name
 
+        if not settings.backend_batching:
+            return await self._create_telegram_user(payload)
+        return await self._load_batched(self.telegram_user_upserts, telegram_user_id, payload)
+
+    async def _create_telegram_user(self, payload: Dict) -> Optional[TelegramUser]:
+        url = "/api/telegram/users"
+
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.post(url, headers=self.headers, json=payload)
+            async with self._client(timeout=settings.backend_timeout_seconds) as client:
+                r = await client.post(url, headers=self.headers, content=dumps(payload))
                 r.raise_for_status()
-                return r.json()
+                return TelegramUser.from_payload(loads(r.content))
         except httpx.HTTPStatusError as e:
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
 
-    async def get_telegram_user(self, telegram_user_id: int) -> Optional[Dict]:
+    async def get_telegram_user(self, telegram_user_id: int) -> Optional[TelegramUser]:
         """
         Получает Telegram пользователя по его ID.
+        При BACKEND_BATCHING запрос объединяется с запросами других пользователей.
         
         Returns:
-            Словарь с данными Telegram пользователя или None в случае ошибки
+            Данные Telegram пользователя или None в случае ошибки
         """
-        url = f"{self.base_url}/api/telegram/users/{telegram_user_id}"
+        if not settings.backend_batching:
+            return await self._fetch_telegram_user(telegram_user_id)
+        return await self._load_batched(self.telegram_users, telegram_user_id)
+
+    async def _fetch_telegram_user(self, telegram_user_id: int) -> Optional[TelegramUser]:
+        url = f"/api/telegram/users/{telegram_user_id}"
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.get(url, headers=self.headers)
-                r.raise_for_status()
-                data = r.json()
-                logger.info("Telegram user API response for user_id %s: %s", telegram_user_id, data)
-                return data
+            r = await self._get("telegram_user", url)
+            r.raise_for_status()
+            data = loads(r.content)
+            logger.info("Telegram user API response for user_id %s: %s", telegram_user_id, data)
+            return TelegramUser.from_payload(data)
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
                 logger.info("Telegram user %s not found (404)", telegram_user_id)
                 return None
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
 
+    # --- пакетирование (BACKEND_BATCHING) ---
+
+    async def _load_batched(
+        self, loader: DataLoader, telegram_user_id: int, item: Any = None
+    ) -> Optional[TelegramUser]:
+        try:
+            return await loader.load(telegram_user_id, item, timeout=settings.backend_timeout_seconds)
+        except DeadlineExceeded:
+            logger.warning("Batched %s lookup for %s abandoned: update deadline exceeded", loader.name, telegram_user_id)
+            return None
+        except asyncio.TimeoutError:
+            logger.error("Batched %s lookup for %s timed out", loader.name, telegram_user_id)
+            return None
+        except Exception as e:
+            logger.exception("Batched %s lookup failed: %s", loader.name, e)
+            return None
+
+    async def _post_batch(self, path: str, payload: Dict) -> Optional[List[Dict]]:
+        """
+        POST пакетного маршрута: записи из поля "users" ответа.
+        None — у backend нет такого маршрута (запоминается на _BATCH_ROUTE_RETRY_SECONDS).
+        """
+        if time.monotonic() < self._batch_missing_until.get(path, 0.0):
+            return None
+        async with self._client(timeout=settings.backend_timeout_seconds) as client:
+            r = await client.post(path, headers=self.headers, content=dumps(payload))
+        if r.status_code in (404, 405, 501):
+            logger.info("Backend has no batch route %s (%s), using parallel requests", path, r.status_code)
+            self._batch_missing_until[path] = time.monotonic() + _BATCH_ROUTE_RETRY_SECONDS
+            return None
+        r.raise_for_status()
+        return loads(r.content).get("users") or []
+
+    async def _parallel(
+        self, items: Dict[int, Any], fetch: Callable[[int, Any], Awaitable[Optional[TelegramUser]]]
+    ) -> Dict[int, Optional[TelegramUser]]:
+        """
+        Пакет поштучными запросами через один HTTP-клиент с пулом соединений:
+        не больше BACKEND_BATCH_FALLBACK_CONCURRENCY одновременно (и в пределах BACKEND_MAX_CONNECTIONS).
+        """
+        self.batch_fallbacks += 1
+        concurrency = settings.backend_batch_fallback_concurrency
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one(telegram_user_id: int, item: Any) -> Optional[TelegramUser]:
+            async with limit:
+                return await fetch(telegram_user_id, item)
+
+        clients: Dict[str, httpx.AsyncClient] = {}
+        token = _shared_clients.set(clients)
+        try:
+            results = await asyncio.gather(*(one(key, item) for key, item in items.items()))
+        finally:
+            _shared_clients.reset(token)
+            for client in clients.values():
+                await client.aclose()
+        return dict(zip(items, results))
+
+    @staticmethod
+    def _by_telegram_user_id(records: List[Dict]) -> Dict[int, Optional[TelegramUser]]:
+        users = (TelegramUser.from_payload(data) for data in records)
+        return {user.telegram_user_id: user for user in users if user.telegram_user_id is not None}
+
+    async def _lookup_telegram_users(self, items: Dict[int, Any]) -> Dict[int, Optional[TelegramUser]]:
+        """Пакет get_telegram_user: отсутствующих в ответе пользователей нет в backend"""
+        try:
+            records = await self._post_batch(TELEGRAM_USERS_LOOKUP_PATH, {"telegram_user_ids": list(items)})
+        except Exception as e:
+            logger.error("Batch lookup of %s telegram users failed: %s", len(items), e)
+            return {}
+        if records is None:
+            return await self._parallel(items, lambda telegram_user_id, _: self._fetch_telegram_user(telegram_user_id))
+        return self._by_telegram_user_id(records)
+
+    async def _upsert_telegram_users(self, items: Dict[int, Any]) -> Dict[int, Optional[TelegramUser]]:
+        """Пакет create_or_get_telegram_user"""
+        try:
+            records = await self._post_batch(TELEGRAM_USERS_BATCH_PATH, {"users": list(items.values())})
+        except Exception as e:
+            logger.error("Batch create of %s telegram users failed: %s", len(items), e)
+            return {}
+        if records is None:
+            return await self._parallel(items, lambda _, payload: self._create_telegram_user(payload))
+        return self._by_telegram_user_id(records)
+
     async def link_telegram_user(self, telegram_user_id: int, backend_user_id: int) -> Optional[Dict]:
         """
         Связывает Telegram пользователя с основным аккаунтом.
@@ -215,24 +529,27 @@ class BackendClient:
         Returns:
             Результат связывания или None в случае ошибки
         """
-        url = f"{self.base_url}/api/telegram/users/{telegram_user_id}/link"
+        url = f"/api/telegram/users/{telegram_user_id}/link"
         payload = {
             "user_id": backend_user_id,
         }
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.post(url, headers=self.headers, json=payload)
+            async with self._client(timeout=settings.backend_timeout_seconds) as client:
+                r = await client.post(url, headers=self.headers, content=dumps(payload))
                 r.raise_for_status()
-                return r.json()
+                return loads(r.content)
         except httpx.HTTPStatusError as e:
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
 
-    async def get_conversations(self, user_id: int) -> Optional[list]:
+    async def get_conversations(self, user_id: int) -> Optional[List[Conversation]]:
         """
         Получает список разговоров для пользователя.
         
@@ -242,58 +559,75 @@ class BackendClient:
         Returns:
             Список разговоров или None в случае ошибки
         """
-        url = f"{self.base_url}/api/chat/conversations/{user_id}"
+        url = f"/api/chat/conversations/{user_id}"
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.get(url, headers=self.headers)
-                r.raise_for_status()
-                data = r.json()
-                # Предполагаем, что ответ - массив или объект с полем conversations
-                if isinstance(data, list):
-                    return data
-                return data.get("conversations", []) if isinstance(data, dict) else []
+            r = await self._get("conversations", url)
+            r.raise_for_status()
+            data = loads(r.content)
+            # Предполагаем, что ответ - массив или объект с полем conversations
+            if isinstance(data, dict):
+                data = data.get("conversations", [])
+            return [Conversation.from_payload(c) for c in data] if isinstance(data, list) else []
         except httpx.HTTPStatusError as e:
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
 
-    async def get_conversation_history(self, conversation_id: str) -> Optional[list]:
+    async def get_conversation_history(
+        self,
+        conversation_id: str,
+        after_id: Optional[str] = None,
+        since: Optional[str] = None,
+    ) -> Optional[List[HistoryMessage]]:
         """
         Получает историю разговора.
         
         Args:
             conversation_id: ID разговора (может быть UUID строкой)
+            after_id: вернуть только сообщения новее сообщения с этим ID (delta-синхронизация)
+            since: вернуть только сообщения новее этой метки времени
             
         Returns:
-            Список сообщений или None в случае ошибки
+            Список сообщений или None в случае ошибки.
+            Backend может игнорировать after_id/since и вернуть всю историю.
         """
         # Убеждаемся, что conversation_id - это строка
         if not isinstance(conversation_id, str):
             conversation_id = str(conversation_id)
         
-        url = f"{self.base_url}/api/chat/history/{conversation_id}"
-        logger.info("Fetching conversation history for conversation_id: %s", conversation_id)
+        url = f"/api/chat/history/{conversation_id}"
+        params = {}
+        if after_id is not None:
+            params["after_id"] = after_id
+        if since is not None:
+            params["since"] = since
+        logger.info("Fetching conversation history for conversation_id: %s (%s)", conversation_id, params or "full")
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.get(url, headers=self.headers)
-                r.raise_for_status()
-                data = r.json()
-                # Предполагаем, что ответ - массив или объект с полем messages/history
-                if isinstance(data, list):
-                    return data
-                return data.get("messages", []) or data.get("history", []) if isinstance(data, dict) else []
+            r = await self._get("history", url, params=params, key=conversation_id)
+            r.raise_for_status()
+            data = loads(r.content)
+            # Предполагаем, что ответ - массив или объект с полем messages/history
+            if isinstance(data, dict):
+                data = data.get("messages", []) or data.get("history", [])
+            return [HistoryMessage.from_payload(m) for m in data] if isinstance(data, list) else []
         except httpx.HTTPStatusError as e:
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
 
-    async def send_message(self, user_id: int, message: str, conversation_id: Optional[str] = None) -> Optional[Dict]:
+    async def send_message(self, user_id: int, message: str, conversation_id: Optional[str] = None) -> Optional[ChatReply]:
         """
         Отправляет сообщение на backend API и возвращает ответ.
         
@@ -303,9 +637,9 @@ class BackendClient:
             conversation_id: ID разговора (опционально, может быть UUID строкой)
             
         Returns:
-            Словарь с ответом (может содержать conversation_id) или None в случае ошибки
+            Ответ (текст и, возможно, conversation_id) или None в случае ошибки
         """
-        url = f"{self.base_url}/api/chat/message"
+        url = "/api/chat/message"
         payload = {
             "user_id": str(user_id),  # Backend ожидает строку
             "message": message,
@@ -316,29 +650,106 @@ class BackendClient:
             logger.info("Sending message with conversation_id: %s", conversation_id)
         
         try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                r = await client.post(url, headers=self.headers, json=payload)
+            async with self._client(
+                timeout=settings.backend_generation_timeout_seconds, key=payload.get("conversation_id")
+            ) as client:
+                r = await client.post(url, headers=self.headers, content=dumps(payload))
                 r.raise_for_status()
-                data = r.json()
-                # Пробуем разные варианты формата ответа
-                # Если ответ - строка напрямую, возвращаем её
-                if isinstance(data, str):
-                    return data
-                # Если это словарь, возвращаем весь объект (может содержать conversation_id)
-                if isinstance(data, dict):
-                    return data
-                # Иначе ищем в полях response, message, text, content
-                return (
-                    data.get("response") 
-                    or data.get("message") 
-                    or data.get("text") 
-                    or data.get("content")
-                    or (data.get("data", {}).get("response") if isinstance(data.get("data"), dict) else None)
-                )
+                # Ответ может быть строкой или объектом с разными названиями полей
+                return ChatReply.from_payload(loads(r.content))
         except httpx.HTTPStatusError as e:
             logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
             return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
         except Exception as e:
             logger.exception("Backend API call failed: %s", e)
             return None
 
+    async def upload_document_chunk(
+        self,
+        user_id: int,
+        document_id: str,
+        index: int,
+        text: str,
+        file_name: str,
+        conversation_id: Optional[str] = None,
+    ) -> bool:
+        """
+        Загружает один текстовый фрагмент документа.
+        Фрагменты одного документа могут приходить в любом порядке, index задает их порядок.
+        
+        Returns:
+            True, если backend принял фрагмент
+        """
+        url = f"/api/chat/documents/{document_id}/chunks"
+        payload = {
+            "user_id": str(user_id),
+            "index": index,
+            "text": text,
+            "file_name": file_name,
+        }
+        if conversation_id is not None:
+            payload["conversation_id"] = str(conversation_id)
+
+        try:
+            async with self._client(
+                timeout=settings.backend_generation_timeout_seconds, key=payload.get("conversation_id", document_id)
+            ) as client:
+                r = await client.post(url, headers=self.headers, content=dumps(payload))
+                r.raise_for_status()
+                return True
+        except httpx.HTTPStatusError as e:
+            logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
+            return False
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return False
+        except Exception as e:
+            logger.exception("Backend API call failed: %s", e)
+            return False
+
+    async def complete_document(
+        self,
+        user_id: int,
+        document_id: str,
+        chunks: int,
+        file_name: str,
+        caption: Optional[str] = None,
+        conversation_id: Optional[str] = None,
+    ) -> Optional[ChatReply]:
+        """
+        Завершает загрузку документа: backend собирает фрагменты и отвечает на него
+        (caption — вопрос пользователя к документу).
+        
+        Returns:
+            Ответ (текст и, возможно, conversation_id) или None в случае ошибки
+        """
+        url = f"/api/chat/documents/{document_id}/complete"
+        payload = {
+            "user_id": str(user_id),
+            "chunks": chunks,
+            "file_name": file_name,
+        }
+        if caption:
+            payload["message"] = caption
+        if conversation_id is not None:
+            payload["conversation_id"] = str(conversation_id)
+
+        try:
+            async with self._client(
+                timeout=2 * settings.backend_generation_timeout_seconds, key=payload.get("conversation_id", document_id)
+            ) as client:
+                r = await client.post(url, headers=self.headers, content=dumps(payload))
+                r.raise_for_status()
+                return ChatReply.from_payload(loads(r.content))
+        except httpx.HTTPStatusError as e:
+            logger.error("Backend API error: %s - %s", e.response.status_code, e.response.text)
+            return None
+        except DeadlineExceeded:
+            logger.warning("Backend call to %s abandoned: update deadline exceeded", url)
+            return None
+        except Exception as e:
+            logger.exception("Backend API call failed: %s", e)
+            return None
@@ -0,0 +1,260 @@
+"""
+Встроенный стенд-ин HTTP backend для локальной разработки и проверок.
+
+Реализует маршруты, которые вызывает BackendClient: пользователи и Telegram пользователи
+(включая пакетные маршруты для BACKEND_BATCHING), разговоры, история, сообщения
+и документы. Ответ на сообщение — эхо. Данные живут в памяти процесса.
+
+Запуск отдельным процессом (BACKEND_URL=http://127.0.0.1:3000):
+    python -m app.backend_stub --port 3000
+    python -m app.backend_stub --no-batch        # backend без пакетных маршрутов
+    python -m app.backend_stub --latency 0.05    # задержка каждого ответа
+Или внутри теста/скрипта:
+    server = BackendStub()
+    await server.start()
+    settings.backend_url = server.url
+"""
+import argparse
+import asyncio
+import itertools
+import secrets
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+from .codec import dumps, loads
+from .logger import logger
+
+
+def _json(data: Any, status: int = 200) -> web.Response:
+    return web.Response(body=dumps(data), status=status, content_type="application/json")
+
+
+class BackendStub:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, batch: bool = True, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        # Есть ли пакетные маршруты /api/telegram/users/batch*
+        self.batch = batch
+        # Задержка перед каждым ответом, секунды
+        self.latency = latency
+        self._ids = itertools.count(1)
+        # email -> {user_id, email, password, telegram_username, token}
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._tokens: Dict[str, Dict[str, Any]] = {}
+        # telegram_user_id -> запись Telegram пользователя
+        self._telegram_users: Dict[int, Dict[str, Any]] = {}
+        # conversation_id -> {user_id, title, messages}
+        self._conversations: Dict[str, Dict[str, Any]] = {}
+        self._documents: Dict[str, Dict[int, str]] = {}
+        # Число запросов по маршрутам (для проверок)
+        self.calls: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def _app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        routes = [
+            web.get("/", self.root),
+            web.get("/api/auth/check-telegram-username", self.check_telegram_username),
+            web.post("/api/auth/register", self.register),
+            web.post("/api/auth/login", self.login),
+            web.get("/api/auth/profile", self.profile),
+            web.post("/api/telegram/users", self.create_telegram_user),
+            web.get(r"/api/telegram/users/{telegram_user_id:\d+}", self.get_telegram_user),
+            web.post(r"/api/telegram/users/{telegram_user_id:\d+}/link", self.link_telegram_user),
+            web.get("/api/chat/conversations/{user_id}", self.conversations),
+            web.get("/api/chat/history/{conversation_id}", self.history),
+            web.post("/api/chat/message", self.message),
+            web.post("/api/chat/documents/{document_id}/chunks", self.document_chunk),
+            web.post("/api/chat/documents/{document_id}/complete", self.document_complete),
+        ]
+        if self.batch:
+            routes += [
+                web.post("/api/telegram/users/batch/lookup", self.lookup_telegram_users),
+                web.post("/api/telegram/users/batch", self.create_telegram_users),
+            ]
+        app.add_routes(routes)
+        return app
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self._app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+        logger.info("Backend stand-in server listening on %s (batch routes: %s)", self.url, self.batch)
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler: Any) -> web.StreamResponse:
+        resource = request.match_info.route.resource
+        self.calls[f"{request.method} {resource.canonical if resource is not None else request.path}"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    # --- пользователи ---
+
+    async def root(self, request: web.Request) -> web.Response:
+        return _json({"status": "ok"})
+
+    async def check_telegram_username(self, request: web.Request) -> web.Response:
+        username = request.query.get("telegram_username")
+        exists = any(user.get("telegram_username") == username for user in self._users.values())
+        return _json({"exists": exists})
+
+    def _issue_token(self, user: Dict[str, Any]) -> str:
+        token = secrets.token_urlsafe(24)
+        user["token"] = token
+        self._tokens[token] = user
+        return token
+
+    async def register(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        if data.get("email") in self._users:
+            return _json({"error": "user already exists"}, status=409)
+        user = {
+            "user_id": next(self._ids),
+            "email": data.get("email"),
+            "password": data.get("password"),
+            "telegram_username": data.get("telegram_username"),
+            "full_name": data.get("full_name"),
+        }
+        self._users[user["email"]] = user
+        return _json({"token": self._issue_token(user), "user_id": user["user_id"]})
+
+    async def login(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        user = self._users.get(data.get("email"))
+        if user is None or user["password"] != data.get("password"):
+            return _json({"error": "invalid credentials"}, status=401)
+        return _json({"token": self._issue_token(user), "user_id": user["user_id"]})
+
+    async def profile(self, request: web.Request) -> web.Response:
+        user = self._tokens.get(request.query.get("token", ""))
+        if user is None:
+            return _json({"error": "invalid token"}, status=401)
+        return _json({key: user.get(key) for key in ("user_id", "email", "telegram_username", "full_name")})
+
+    # --- Telegram пользователи ---
+
+    def _upsert_telegram_user(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        telegram_user_id = int(data["telegram_user_id"])
+        record = self._telegram_users.setdefault(telegram_user_id, {"telegram_user_id": telegram_user_id, "user_id": None})
+        for key in ("telegram_username", "first_name", "last_name"):
+            if data.get(key):
+                record[key] = data[key]
+        return record
+
+    async def create_telegram_user(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        if "telegram_user_id" not in data:
+            return _json({"error": "telegram_user_id is required"}, status=400)
+        return _json(self._upsert_telegram_user(data))
+
+    async def get_telegram_user(self, request: web.Request) -> web.Response:
+        record = self._telegram_users.get(int(request.match_info["telegram_user_id"]))
+        if record is None:
+            return _json({"error": "not found"}, status=404)
+        return _json(record)
+
+    async def link_telegram_user(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        record = self._upsert_telegram_user({"telegram_user_id": request.match_info["telegram_user_id"]})
+        record["user_id"] = data.get("user_id")
+        return _json(record)
+
+    async def lookup_telegram_users(self, request: web.Request) -> web.Response:
+        """Пакетный поиск: {"telegram_user_ids": [...]} -> {"users": [...]} (отсутствующие пропускаются)"""
+        data = loads(await request.read())
+        ids = [int(telegram_user_id) for telegram_user_id in data.get("telegram_user_ids") or []]
+        return _json({"users": [self._telegram_users[i] for i in ids if i in self._telegram_users]})
+
+    async def create_telegram_users(self, request: web.Request) -> web.Response:
+        """Пакетное создание/получение: {"users": [payload, ...]} -> {"users": [...]}"""
+        data = loads(await request.read())
+        items: List[Dict[str, Any]] = data.get("users") or []
+        if any("telegram_user_id" not in item for item in items):
+            return _json({"error": "telegram_user_id is required"}, status=400)
+        return _json({"users": [self._upsert_telegram_user(item) for item in items]})
+
+    # --- разговоры ---
+
+    async def conversations(self, request: web.Request) -> web.Response:
+        user_id = request.match_info["user_id"]
+        return _json({"conversations": [
+            {"id": conversation_id, "title": conversation["title"]}
+            for conversation_id, conversation in self._conversations.items()
+            if conversation["user_id"] == user_id
+        ]})
+
+    async def history(self, request: web.Request) -> web.Response:
+        conversation = self._conversations.get(request.match_info["conversation_id"])
+        if conversation is None:
+            return _json({"error": "not found"}, status=404)
+        messages = conversation["messages"]
+        after_id = request.query.get("after_id")
+        if after_id is not None:
+            ids = [m["id"] for m in messages]
+            if after_id in ids:
+                messages = messages[ids.index(after_id) + 1:]
+        return _json({"messages": messages})
+
+    def _reply(self, user_id: str, conversation_id: Optional[str], text: str, answer: str) -> Dict[str, Any]:
+        if conversation_id is None or conversation_id not in self._conversations:
+            conversation_id = conversation_id or str(uuid.uuid4())
+            self._conversations[conversation_id] = {"user_id": user_id, "title": text[:40], "messages": []}
+        messages = self._conversations[conversation_id]["messages"]
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        for role, content in (("user", text), ("assistant", answer)):
+            messages.append({"id": str(next(self._ids)), "role": role, "content": content, "created_at": now})
+        return {"response": answer, "conversation_id": conversation_id}
+
+    async def message(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        text = data.get("message") or ""
+        return _json(self._reply(str(data.get("user_id")), data.get("conversation_id"), text, f"Эхо: {text}"))
+
+    async def document_chunk(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        self._documents.setdefault(request.match_info["document_id"], {})[int(data["index"])] = data.get("text") or ""
+        return _json({"ok": True})
+
+    async def document_complete(self, request: web.Request) -> web.Response:
+        data = loads(await request.read())
+        chunks = self._documents.pop(request.match_info["document_id"], {})
+        if len(chunks) != int(data.get("chunks", 0)):
+            return _json({"error": "missing chunks"}, status=400)
+        size = sum(len(text) for text in chunks.values())
+        question = data.get("message") or data.get("file_name") or ""
+        answer = f"Документ {data.get('file_name')}: {size} символов"
+        return _json(self._reply(str(data.get("user_id")), data.get("conversation_id"), question, answer))
+
+
+async def _serve(host: str, port: int, batch: bool, latency: float) -> None:
+    server = BackendStub(host, port, batch=batch, latency=latency)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory backend stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--no-batch", action="store_true", help="do not expose batch routes")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay before every response, seconds")
+    ns = parser.parse_args()
+    asyncio.run(_serve(ns.host, ns.port, batch=not ns.no_batch, latency=ns.latency))
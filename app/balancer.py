@@ -0,0 +1,160 @@
+"""
+Балансировка запросов между несколькими экземплярами backend (BACKEND_URL через запятую).
+
+Внешнего балансировщика может не быть, поэтому экземпляр выбирает сам BackendClient:
+    - power of two choices: из двух случайных доступных экземпляров берется тот,
+      у которого меньше (запросов в полете + 1) * EWMA задержки;
+    - пассивное исключение: после BACKEND_EJECT_AFTER_FAILURES ошибок подряд (5xx, сетевые
+      ошибки, таймауты) экземпляр не получает запросов BACKEND_EJECT_SECONDS, при повторных
+      исключениях — вдвое дольше (до 8x). Одновременно исключается не больше
+      BACKEND_MAX_EJECTED_FRACTION экземпляров: последний рабочий не исключается никогда;
+    - привязка (BACKEND_STICKY): запросы одного разговора (или документа) идут на один
+      экземпляр по rendezvous hashing, чтобы его кэши оставались теплыми. Выбор зависит
+      только от ключа и списка адресов — все реплики бота выбирают одно и то же, а при
+      исключении экземпляра на другие переезжают только его разговоры;
+    - хеджированный дубликат запроса идет на другой экземпляр (exclude), а не на тот,
+      что уже медлит с основным.
+"""
+import hashlib
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Collection, Dict, List, Optional
+
+from .logger import logger
+
+# Максимальный множитель длительности исключения при повторных исключениях
+_MAX_EJECT_MULTIPLIER = 8
+
+
+def parse_backend_urls(value: str) -> List[str]:
+    """BACKEND_URL: один адрес или несколько через запятую"""
+    urls = [url.strip().rstrip("/") for url in value.split(",") if url.strip()]
+    if not urls:
+        raise ValueError("BACKEND_URL is empty")
+    return list(dict.fromkeys(urls))
+
+
+@dataclass(slots=True)
+class Endpoint:
+    url: str
+    in_flight: int = 0
+    # Сглаженная задержка ответа, секунды (None — еще нет замеров)
+    ewma: Optional[float] = None
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    ejections: int = 0
+    # Показатель удлинения следующего исключения (сбрасывается после периода без исключений)
+    backoff: int = 0
+    ejected_until: float = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class Balancer:
+    def __init__(
+        self,
+        urls: List[str],
+        sticky: bool = True,
+        eject_after_failures: int = 5,
+        eject_seconds: float = 30.0,
+        max_ejected_fraction: float = 0.5,
+        ewma_alpha: float = 0.3,
+    ):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.sticky = sticky
+        self.eject_after_failures = eject_after_failures
+        self.eject_seconds = eject_seconds
+        self.max_ejected_fraction = max_ejected_fraction
+        self.ewma_alpha = ewma_alpha
+        self._random = random.Random()
+
+    def _available(self, now: float) -> List[Endpoint]:
+        available = [endpoint for endpoint in self.endpoints if endpoint.available(now)]
+        # Все исключены (например, все вернули ошибки) — лучше попробовать, чем не отправлять совсем
+        return available or self.endpoints
+
+    @staticmethod
+    def _rendezvous(key: str, endpoint: Endpoint) -> bytes:
+        return hashlib.blake2b(f"{endpoint.url}|{key}".encode(), digest_size=8).digest()
+
+    @staticmethod
+    def _cost(endpoint: Endpoint) -> float:
+        # Экземпляр без замеров выбирается первым, чтобы получить оценку
+        return (endpoint.in_flight + 1) * (endpoint.ewma or 0.0)
+
+    def pick(self, key: Optional[str] = None, exclude: Collection[Endpoint] = ()) -> Endpoint:
+        """
+        Экземпляр для запроса; key — разговор или документ, которые держатся на одном экземпляре.
+        exclude — экземпляры, которые по возможности не выбирать (уже выполняют этот запрос).
+        """
+        if len(self.endpoints) == 1:
+            return self.endpoints[0]
+        candidates = self._available(time.monotonic())
+        if exclude:
+            candidates = [endpoint for endpoint in candidates if endpoint not in exclude] or candidates
+        if key is not None and self.sticky:
+            return max(candidates, key=lambda endpoint: self._rendezvous(key, endpoint))
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = self._random.sample(candidates, 2)
+        return first if self._cost(first) <= self._cost(second) else second
+
+    def acquire(self, key: Optional[str] = None, exclude: Collection[Endpoint] = ()) -> Endpoint:
+        endpoint = self.pick(key, exclude)
+        endpoint.in_flight += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint: Endpoint, elapsed: Optional[float]) -> None:
+        """Запрос завершен; elapsed — его длительность (None — не учитывать в задержке)"""
+        endpoint.in_flight -= 1
+        if elapsed is not None:
+            if endpoint.ewma is None:
+                endpoint.ewma = elapsed
+            else:
+                endpoint.ewma += self.ewma_alpha * (elapsed - endpoint.ewma)
+
+    def record(self, endpoint: Endpoint, ok: bool) -> None:
+        """Итог запроса для пассивного исключения: ok=False — 5xx, сетевая ошибка или таймаут"""
+        if ok:
+            endpoint.consecutive_failures = 0
+            if endpoint.backoff and time.monotonic() - endpoint.ejected_until > self.eject_seconds:
+                endpoint.backoff = 0
+            return
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures < self.eject_after_failures or len(self.endpoints) == 1:
+            return
+        now = time.monotonic()
+        if not endpoint.available(now):
+            return
+        ejected = sum(1 for other in self.endpoints if not other.available(now))
+        limit = min(len(self.endpoints) - 1, max(1, int(len(self.endpoints) * self.max_ejected_fraction)))
+        if ejected >= limit:
+            return
+        multiplier = min(2 ** endpoint.backoff, _MAX_EJECT_MULTIPLIER)
+        endpoint.backoff += 1
+        endpoint.ejections += 1
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = now + self.eject_seconds * multiplier
+        logger.warning(
+            "Backend endpoint %s ejected for %.0fs after %s consecutive failures",
+            endpoint.url, self.eject_seconds * multiplier, self.eject_after_failures,
+        )
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        return {
+            endpoint.url: {
+                "in_flight": endpoint.in_flight,
+                "ewma_ms": round(endpoint.ewma * 1000, 1) if endpoint.ewma is not None else None,
+                "requests": endpoint.requests,
+                "failures": endpoint.failures,
+                "ejections": endpoint.ejections,
+                "ejected_for_s": round(max(0.0, endpoint.ejected_until - now), 1),
+            }
+            for endpoint in self.endpoints
+        }
@@ -0,0 +1,126 @@
+"""
+Память на пользователя в хранилище состояния (STATE_BACKEND=memory).
+
+    python -m app.bench_memory                  # 1 000 000 пользователей
+    python -m app.bench_memory --users 100000
+
+Строит синтетических пользователей в двух представлениях и меряет tracemalloc'ом:
+    legacy  — словарь на пользователя со всеми полями, включая token/email/password
+              (как UserStorage хранил их раньше);
+    compact — UserRecord (app/user_storage.py): горячие поля в __slots__-записи,
+              учетные данные на диске.
+Отдельно меряются состояния регистрации в UserStates (на пользователя в процессе регистрации).
+"""
+import argparse
+import asyncio
+import gc
+import random
+import secrets
+import tracemalloc
+import uuid
+from typing import Any, Callable, Dict, List
+
+from .state import UserStates
+from .user_storage import UserRecord, _pack_conversation_id
+
+_JWT_LENGTH = 180
+
+
+def _profiles(count: int, seed: int = 1) -> List[Dict[str, Any]]:
+    """Синтетические пользователи: у большинства есть username, токен и текущий разговор"""
+    rnd = random.Random(seed)
+    profiles = []
+    for i in range(count):
+        telegram_user_id = 100_000_000 + i * 7
+        # Строки создаются при построении структуры (_username, _conversation_id), чтобы попасть в замер
+        profiles.append({
+            "telegram_user_id": telegram_user_id,
+            "backend_user_id": rnd.randrange(1, 10_000_000),
+            "telegram_username": rnd.getrandbits(40) if rnd.random() < 0.7 else None,
+            "conversation_id": rnd.getrandbits(128) if rnd.random() < 0.8 else None,
+            "registered": rnd.random() < 0.9,
+        })
+    return profiles
+
+
+def _username(p: Dict[str, Any]) -> str:
+    return f"user_{p['telegram_username']:x}"
+
+
+def _conversation_id(p: Dict[str, Any]) -> str:
+    return str(uuid.UUID(int=p["conversation_id"], version=4))
+
+
+def _legacy(profiles: List[Dict[str, Any]]) -> Dict[int, Dict]:
+    storage: Dict[int, Dict] = {}
+    for p in profiles:
+        user_data: Dict[str, Any] = {"backend_user_id": p["backend_user_id"]}
+        if p["registered"]:
+            user_data["token"] = secrets.token_urlsafe(_JWT_LENGTH * 3 // 4)
+            user_data["email"] = f"tg_user_{p['telegram_user_id']}@telegram.local"
+            user_data["password"] = secrets.token_urlsafe(12)
+        if p["telegram_username"] is not None:
+            user_data["telegram_username"] = _username(p)
+        if p["conversation_id"] is not None:
+            user_data["conversation_id"] = _conversation_id(p)
+        storage[p["telegram_user_id"]] = user_data
+    return storage
+
+
+def _compact(profiles: List[Dict[str, Any]]) -> Dict[int, UserRecord]:
+    storage: Dict[int, UserRecord] = {}
+    for p in profiles:
+        storage[p["telegram_user_id"]] = UserRecord(
+            backend_user_id=p["backend_user_id"],
+            telegram_username=_username(p) if p["telegram_username"] is not None else None,
+            conversation_id=_pack_conversation_id(_conversation_id(p)) if p["conversation_id"] is not None else None,
+            registered=p["registered"],
+        )
+    return storage
+
+
+def _user_states(profiles: List[Dict[str, Any]]) -> UserStates:
+    states = UserStates(ttl_seconds=3600)
+
+    async def fill() -> None:
+        for p in profiles:
+            await states.set(p["telegram_user_id"], "waiting_email")
+
+    asyncio.run(fill())
+    return states
+
+
+def _measure(build: Callable[[], Any]) -> int:
+    """Байты, которые остаются занятыми построенной структурой"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return used
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure per-user memory of the in-process state backend")
+    parser.add_argument("--users", type=int, default=1_000_000, help="number of synthetic users")
+    ns = parser.parse_args()
+
+    profiles = _profiles(ns.users)
+    results = [
+        ("legacy dict + credentials", _measure(lambda: _legacy(profiles))),
+        ("compact UserRecord", _measure(lambda: _compact(profiles))),
+        ("UserStates entry (TTL)", _measure(lambda: _user_states(profiles))),
+    ]
+    print(f"Users: {ns.users}")
+    for name, used in results:
+        print(f"  {name:<28} {used / ns.users:8.1f} B/user  {used / 2 ** 20:9.1f} MiB total")
+    legacy, compact = results[0][1], results[1][1]
+    print(f"  compact / legacy: {compact / legacy:.0%}")
+
+
+if __name__ == "__main__":
+    main()
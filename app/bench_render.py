@@ -0,0 +1,136 @@
+"""
+Задержка event loop во время рендеринга больших ответов и историй.
+
+    python -m app.bench_render
+    python -m app.bench_render --reply-chars 200000 --history-messages 800 --renders 20
+
+Пока идут --renders рендерингов (ответы и истории вперемешку, по --concurrency одновременно),
+тикер каждые 5 мс меряет, насколько позже запланированного просыпается loop — так же,
+как LoopLagMonitor. Режимы:
+    inline  — форматирование прямо в event loop (как до Renderer);
+    thread  — Renderer с RENDER_POOL=thread;
+    process — Renderer с RENDER_POOL=process.
+Кэш выключен: каждый рендеринг выполняется заново.
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, List
+
+from .diagnostics import percentile
+from .render import Renderer, render_history, render_reply
+from .schemas import HistoryMessage
+
+_TICK = 0.005
+
+
+def _reply(chars: int, seed: int) -> str:
+    """Ответ LLM с заголовками, списками, жирным и кодом"""
+    rnd = random.Random(seed)
+    words = ["данные", "**важно**", "`код`", "анализ", "отчет", "клиент", "__итог__", "шаг", "*курсив*"]
+    lines: List[str] = []
+    size = 0
+    while size < chars:
+        kind = rnd.random()
+        body = " ".join(rnd.choice(words) for _ in range(rnd.randint(5, 20)))
+        if kind < 0.1:
+            line = f"## {body}"
+        elif kind < 0.4:
+            line = f"- {body}"
+        elif kind < 0.45:
+            line = f"```\n{body}\n```"
+        else:
+            line = body
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def _history(messages: int, seed: int) -> List[HistoryMessage]:
+    return [
+        HistoryMessage(role="user" if i % 2 == 0 else "assistant", content=_reply(800, seed * 10_000 + i))
+        for i in range(messages)
+    ]
+
+
+async def _measure(render: Callable[[int], Awaitable[None]], renders: int, concurrency: int) -> dict:
+    lags: List[float] = []
+    stop = asyncio.Event()
+
+    async def ticker() -> None:
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(_TICK)
+            lags.append(max(0.0, time.perf_counter() - started - _TICK) * 1000)
+
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with limit:
+            await render(i)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(_TICK * 4)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(renders)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+    return {
+        "elapsed": elapsed,
+        "p50": percentile(lags, 50),
+        "p99": percentile(lags, 99),
+        "max": max(lags, default=0.0),
+    }
+
+
+async def _run(ns: argparse.Namespace) -> None:
+    replies = [_reply(ns.reply_chars, seed) for seed in range(ns.renders)]
+    histories = [_history(ns.history_messages, seed) for seed in range(ns.renders)]
+    history_chars = sum(len(msg.content) for msg in histories[0])
+    print(
+        f"Renders: {ns.renders} (reply {ns.reply_chars} chars, history {ns.history_messages} messages / "
+        f"{history_chars} chars), concurrency {ns.concurrency}"
+    )
+
+    async def inline(i: int) -> None:
+        render_reply(replies[i]) if i % 2 == 0 else render_history(histories[i])
+        await asyncio.sleep(0)
+
+    modes = [("inline", inline, None)]
+    for pool in ("thread", "process"):
+        renderer = Renderer(offload_chars=1, pool=pool, workers=ns.workers, cache_size=0)
+
+        async def pooled(i: int, renderer: Renderer = renderer) -> None:
+            await (renderer.reply(replies[i]) if i % 2 == 0 else renderer.history(histories[i]))
+
+        modes.append((pool, pooled, renderer))
+
+    print(f"  {'mode':<8} {'total, s':>9} {'lag p50, ms':>12} {'p99, ms':>9} {'max, ms':>9}")
+    for name, render, renderer in modes:
+        if renderer is not None:
+            # Пул поднимается до замера: запуск процессов не относится к рендерингу
+            executor = renderer._get_executor()
+            await asyncio.gather(*(
+                asyncio.get_running_loop().run_in_executor(executor, render_reply, "warm up") for _ in range(ns.workers)
+            ))
+        result = await _measure(render, ns.renders, ns.concurrency)
+        print(f"  {name:<8} {result['elapsed']:9.2f} {result['p50']:12.1f} {result['p99']:9.1f} {result['max']:9.1f}")
+        if renderer is not None:
+            renderer.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure event loop lag while rendering large replies and histories")
+    parser.add_argument("--reply-chars", type=int, default=100_000, help="size of a synthetic LLM reply")
+    parser.add_argument("--history-messages", type=int, default=500, help="messages in a synthetic history")
+    parser.add_argument("--renders", type=int, default=20, help="renders per mode")
+    parser.add_argument("--concurrency", type=int, default=4, help="renders requested at once")
+    parser.add_argument("--workers", type=int, default=1, help="pool workers")
+    ns = parser.parse_args()
+    asyncio.run(_run(ns))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import asyncio
-import re
+import os
+import secrets
+import time
+from typing import Optional
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.enums import ParseMode
 from aiogram.utils.chat_action import ChatActionSender
 from aiogram.types import (
@@ -10,20 +13,203 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
-from aiogram.types import ForceReply, CallbackQuery
+from aiogram.types import ForceReply, CallbackQuery, BufferedInputFile, FSInputFile
 
 from .config import settings
 from .logger import logger
-from .rate_limiter import RateLimiter
 from .backend_client import BackendClient
-from .user_storage import UserStorage
+from .state import create_state_backends
+from .schemas import ChatReply, HistoryMessage
+from .history_mirror import HistoryMirror
+from .broadcast import Broadcaster
+from .history_export import EXPORT_FORMATS, estimate_size, export_history
+from .render import Renderer, split_message
+from .outbox import Outbox
+from .lanes import FAST, SLOW, LaneMiddleware
+from .health import HealthServer, Probe
+from .telegram_transport import TelegramMetrics, create_telegram_session, parse_method_timeouts
+from .live_config import LiveConfigError, live_config
+from .deadline import DeadlineMiddleware, budget
+from .documents import (
+    DocumentError,
+    IngestProgress,
+    decode_text,
+    document_name,
+    is_text_document,
+    report_progress,
+    split_text,
+    stream_telegram_file,
+    upload_chunks,
+)
+from .dedup import DedupMiddleware
+from .inflight import InflightRegistry, Superseded
+from .prefetch import HistoryPrefetcher, PrefetchCancelMiddleware
+from .sessions import SessionManager
+from .quota import QuotaMiddleware
+from .recorder import RecorderMiddleware, RecorderRequestMiddleware, recorder
+from .tracing import TracingMiddleware, exporter as trace_exporter, span
+from .diagnostics import (
+    HandlerTracker,
+    LoopLagMonitor,
+    cpu_profile,
+    task_counts,
+    tracemalloc_start,
+    tracemalloc_stop,
+    tracemalloc_top,
+)
 
-rate_limiter = RateLimiter(per_minute=settings.rate_limit_per_minute)
+_state = create_state_backends()
+rate_limiter = _state.rate_limiter
 backend = BackendClient()
-user_storage = UserStorage()
+user_storage = _state.user_storage
 
 # Хранилище состояний пользователей (ожидание email для регистрации)
-user_states: dict[int, str] = {}
+user_states = _state.user_states
+dedup_store = _state.dedup
+quota = _state.quota
+
+history_mirror = HistoryMirror(
+    backend.get_conversation_history,
+    directory=settings.history_mirror_dir,
+    max_messages=settings.history_mirror_max_messages,
+    max_conversations=settings.history_mirror_max_conversations,
+    fresh_seconds=settings.history_mirror_fresh_seconds,
+)
+
+broadcaster = Broadcaster(
+    user_storage,
+    checkpoint_file=settings.broadcast_checkpoint_file,
+    rate_per_second=settings.broadcast_rate_per_second,
+    concurrency=settings.broadcast_concurrency,
+)
+
+# Генерации ответа в полете: сброс или смена разговора отменяет их
+inflight = InflightRegistry()
+
+lanes = LaneMiddleware()
+deadline = DeadlineMiddleware(settings.update_budget_seconds)
+handler_tracker = HandlerTracker()
+loop_lag = LoopLagMonitor()
+telegram_metrics = TelegramMetrics()
+
+# Истории первых разговоров из /conversations загружаются заранее, пока медленная полоса не занята
+prefetcher = HistoryPrefetcher(
+    history_mirror.get,
+    top_n=settings.history_prefetch_top_n,
+    concurrency=settings.history_prefetch_concurrency,
+    ttl_seconds=settings.history_prefetch_ttl_seconds,
+    max_bytes=settings.history_prefetch_max_bytes,
+    busy=lambda: lanes.lanes[SLOW].waiting > 0,
+)
+
+# Очистка ответов и форматирование истории: большие тексты — в пуле, вне event loop
+renderer = Renderer(
+    offload_chars=settings.render_offload_chars,
+    pool=settings.render_pool,
+    workers=settings.render_workers,
+    queue_size=settings.render_queue_size,
+    cache_size=settings.render_cache_size,
+)
+
+# Журнал сгенерированных ответов: доставка с повторами, в том числе после рестарта
+outbox = Outbox(
+    journal_file=settings.outbox_file,
+    retry_base_seconds=settings.outbox_retry_base_seconds,
+    retry_max_seconds=settings.outbox_retry_max_seconds,
+    max_age_seconds=settings.outbox_max_age_seconds,
+)
+
+# Токены backend: вход по сохраненным учетным данным, фоновое обновление и кэш профилей
+sessions = SessionManager(
+    backend,
+    user_storage,
+    profile_ttl_seconds=settings.session_profile_ttl_seconds,
+    token_ttl_seconds=settings.session_token_ttl_seconds,
+    refresh_before_seconds=settings.session_refresh_before_seconds,
+    refresh_interval_seconds=settings.session_refresh_interval_seconds,
+)
+
+
+def _queue_depth() -> dict:
+    """Глубина очередей и операций в полете для /readyz и /status"""
+    depth = {
+        f"lane_{lane.name}": {"active": lane.active, "waiting": lane.waiting, "limit": lane.concurrency}
+        for lane in lanes.lanes.values()
+    }
+    depth["backend"] = {"in_flight": backend.in_flight, "waiting": backend.pool.waiting}
+    depth["generations"] = inflight.count()
+    depth["handlers"] = sum(handler_tracker.in_flight.values())
+    if quota is not None:
+        depth["quota_waiting"] = quota.waiting
+    return depth
+
+
+def _saturation() -> Optional[str]:
+    """Реплика не примет новое медленное обновление: очередь медленной полосы заполнена"""
+    slow = lanes.lanes[SLOW]
+    if slow.queue_limit is not None and slow.active >= slow.concurrency and slow.waiting >= slow.queue_limit:
+        return "slow lane queue is full"
+    return None
+
+
+health = HealthServer(
+    loop_lag,
+    depth=_queue_depth,
+    saturated=_saturation,
+    max_loop_stall=settings.health_max_loop_stall_seconds,
+    details={"telegram_methods": telegram_metrics.summary, "backend_endpoints": backend.balancer.summary},
+)
+
+# Объекты, которые кэшируют настройки у себя: получают новые значения при изменении на лету
+live_config.on_change("RATE_LIMIT_PER_MINUTE", lambda value: setattr(rate_limiter, "per_minute", value))
+live_config.on_change("BACKEND_MAX_CONNECTIONS", backend.pool.resize)
+live_config.on_change("BACKEND_HEDGE_RATIO", lambda value: setattr(backend.hedge_budget, "ratio", value))
+for _key, _attr in (
+    ("BACKEND_STICKY", "sticky"),
+    ("BACKEND_EJECT_AFTER_FAILURES", "eject_after_failures"),
+    ("BACKEND_EJECT_SECONDS", "eject_seconds"),
+    ("BACKEND_MAX_EJECTED_FRACTION", "max_ejected_fraction"),
+):
+    live_config.on_change(_key, lambda value, attr=_attr: setattr(backend.balancer, attr, value))
+for _loader in (backend.telegram_users, backend.telegram_user_upserts):
+    live_config.on_change("BACKEND_BATCH_WINDOW_SECONDS", lambda value, loader=_loader: setattr(loader, "window_seconds", value))
+    live_config.on_change("BACKEND_BATCH_MAX_SIZE", lambda value, loader=_loader: setattr(loader, "max_batch", value))
+live_config.on_change("UPDATE_BUDGET_SECONDS", lambda value: setattr(deadline, "budget_seconds", value))
+live_config.on_change("FAST_LANE_CONCURRENCY", lanes.lanes[FAST].resize)
+live_config.on_change("SLOW_LANE_CONCURRENCY", lanes.lanes[SLOW].resize)
+live_config.on_change("SLOW_LANE_QUEUE", lambda value: setattr(lanes.lanes[SLOW], "queue_limit", value))
+live_config.on_change("HISTORY_MIRROR_FRESH_SECONDS", lambda value: setattr(history_mirror, "fresh_seconds", value))
+live_config.on_change("HISTORY_PREFETCH_TOP_N", lambda value: setattr(prefetcher, "top_n", value))
+live_config.on_change("HISTORY_PREFETCH_CONCURRENCY", prefetcher.lane.resize)
+live_config.on_change("HISTORY_PREFETCH_TTL_SECONDS", lambda value: setattr(prefetcher, "ttl_seconds", value))
+live_config.on_change("HISTORY_PREFETCH_MAX_BYTES", lambda value: setattr(prefetcher, "max_bytes", value))
+for _key, _attr in (
+    ("SESSION_PROFILE_TTL_SECONDS", "profile_ttl_seconds"),
+    ("SESSION_TOKEN_TTL_SECONDS", "token_ttl_seconds"),
+    ("SESSION_REFRESH_BEFORE_SECONDS", "refresh_before_seconds"),
+):
+    live_config.on_change(_key, lambda value, attr=_attr: setattr(sessions, attr, value))
+live_config.on_change("RENDER_OFFLOAD_CHARS", lambda value: setattr(renderer, "offload_chars", value))
+for _key, _attr in (
+    ("OUTBOX_RETRY_BASE_SECONDS", "retry_base_seconds"),
+    ("OUTBOX_RETRY_MAX_SECONDS", "retry_max_seconds"),
+    ("OUTBOX_MAX_AGE_SECONDS", "max_age_seconds"),
+):
+    live_config.on_change(_key, lambda value, attr=_attr: setattr(outbox, attr, value))
+live_config.on_change("BROADCAST_RATE_PER_SECOND", lambda value: setattr(broadcaster, "rate_per_second", value))
+live_config.on_change("BROADCAST_CONCURRENCY", lambda value: setattr(broadcaster, "concurrency", value))
+if quota is not None:
+    for _key, _attr in (
+        ("QUOTA_USER_UNITS_PER_MINUTE", "user_budget"),
+        ("QUOTA_GLOBAL_UNITS_PER_MINUTE", "global_budget"),
+        ("QUOTA_CHARS_PER_UNIT", "chars_per_unit"),
+        ("QUOTA_DOCUMENT_UNITS", "document_units"),
+        ("QUOTA_UNITS_PER_SECOND", "units_per_second"),
+        ("QUOTA_TOKENS_PER_UNIT", "tokens_per_unit"),
+        ("QUOTA_MAX_WAIT_SECONDS", "max_wait_seconds"),
+    ):
+        live_config.on_change(_key, lambda value, attr=_attr: setattr(quota, attr, value))
+    live_config.on_change("QUOTA_LOW_PRIORITY_CONCURRENCY", quota.low_priority_slot().resize)
 
 CATEGORIES: list[tuple[str, list[tuple[str, str]]]] = [
     (
@@ -70,16 +256,55 @@ def main_keyboard() -> ReplyKeyboardMarkup:
         input_field_placeholder="Напишите вопрос или откройте шаблоны",
     )
 
-async def on_startup() -> None:
+async def on_startup(bot: Bot) -> None:
     masked = (
         (settings.telegram_bot_token[:6] + "…" + settings.telegram_bot_token[-4:])
         if settings.telegram_bot_token
         else "<none>"
     )
     logger.info("Bot is starting up (TOKEN loaded: %s)", masked)
+    renderer.start()
+    loop_lag.start()
+    live_config.start()
+    sessions.start()
+    if settings.health_port:
+        await _start_health(bot)
+    # Незавершенная рассылка продолжается с сохраненного места
+    broadcaster.resume(bot)
+    # Ответы, не доставленные до рестарта
+    outbox.start(bot)
+
+async def _start_health(bot: Bot) -> None:
+    async def check_backend() -> None:
+        status = await backend.ping(settings.health_backend_path, settings.health_probe_timeout_seconds)
+        if status >= 500:
+            raise RuntimeError(f"HTTP {status}")
+
+    async def check_telegram() -> None:
+        await bot.get_me(request_timeout=int(max(1, settings.health_probe_timeout_seconds)))
+
+    for name, check in (("backend", check_backend), ("telegram", check_telegram)):
+        health.add_probe(Probe(
+            name,
+            check,
+            interval=settings.health_probe_interval_seconds,
+            timeout=settings.health_probe_timeout_seconds,
+        ))
+    try:
+        await health.start(settings.health_host, settings.health_port)
+    except OSError as e:
+        logger.error("Failed to start health endpoints on port %s: %s", settings.health_port, e)
 
 async def on_shutdown() -> None:
     logger.info("Bot is shutting down")
+    await loop_lag.stop()
+    await live_config.stop()
+    await sessions.stop()
+    await outbox.stop()
+    renderer.close()
+    await health.stop()
+    await trace_exporter.close()
+    recorder.close()
 
 async def cmd_start(message: types.Message) -> None:
     if not message.from_user:
@@ -116,22 +341,15 @@ async def cmd_start(message: types.Message) -> None:
     logger.debug("Telegram user from create_or_get: %s", telegram_user)
     
     # Проверяем, связан ли Telegram пользователь с основным аккаунтом
-    # Пробуем разные варианты названий полей
-    backend_user_id = (
-        telegram_user.get("user_id") 
-        or telegram_user.get("backend_user_id")
-        or telegram_user.get("linked_user_id")
-    )
+    backend_user_id = telegram_user.backend_user_id
     
     if backend_user_id:
         # Пользователь уже связан с основным аккаунтом
-        # Получаем токен через логин (нужно сохранить email/password в хранилище)
-        # Или можно использовать существующий токен, если он есть
-        token = user_storage.get_token(telegram_user_id)
+        # Действующий токен из хранилища; истекший обновляется входом по сохраненным email/password
+        token = await sessions.token(telegram_user_id)
         
         if not token:
-            # Если нет токена, нужно запросить у пользователя email для логина
-            # Или можно использовать другой механизм
+            # Учетных данных нет (аккаунт связан не через бота) — вход по email и паролю через /login
             await message.answer(
                 f"Привет, {name}! 👋\n"
                 f"Ваш Telegram аккаунт уже связан с основным аккаунтом.\n\n"
@@ -139,15 +357,19 @@ async def cmd_start(message: types.Message) -> None:
                 reply_markup=main_keyboard(),
             )
         else:
+            # Профиль аккаунта из кэша сессий; при промахе — запрос к backend, а отклоненный
+            # токен заменяется новым входом
+            profile = await sessions.profile(telegram_user_id) or {}
+            token = await sessions.token(telegram_user_id) or token
             # Сохраняем данные в локальное хранилище
-            user_storage.set(
+            await user_storage.set(
                 telegram_user_id=telegram_user_id,
                 backend_user_id=backend_user_id,
                 token=token,
                 telegram_username=telegram_username
             )
             await message.answer(
-                f"Привет, {name}! Добро пожаловать обратно! 👋\n"
+                f"Привет, {profile.get('full_name') or name}! Добро пожаловать обратно! 👋\n"
                 f"Я AI-ассистент для бизнеса. Отправьте мне сообщение, чтобы начать.\n"
                 f"/help для списка команд.",
                 reply_markup=main_keyboard(),
@@ -155,10 +377,10 @@ async def cmd_start(message: types.Message) -> None:
     else:
         # Telegram пользователь не связан с основным аккаунтом
         # Проверяем локальное хранилище
-        if user_storage.has_user(telegram_user_id):
+        if await user_storage.has_user(telegram_user_id):
             # Есть локальные данные, но не связаны в backend
             # Пытаемся связать
-            local_backend_user_id = user_storage.get_backend_user_id(telegram_user_id)
+            local_backend_user_id = await user_storage.get_backend_user_id(telegram_user_id)
             if local_backend_user_id:
                 link_result = await backend.link_telegram_user(telegram_user_id, local_backend_user_id)
                 if link_result:
@@ -191,8 +413,11 @@ async def cmd_help(message: types.Message) -> None:
         "/help - эта справка\n"
         "/conversations - список разговоров\n"
         "/history - история текущего разговора\n"
+        "/export - история текущего разговора файлом (txt, md, html)\n"
         "/clear - очистить память разговора\n"
-        "/templates - открыть шаблоны",
+        "/login - войти в основной аккаунт\n"
+        "/templates - открыть шаблоны\n\n"
+        "Можно отправить текстовый файл (TXT, CSV, JSON и т.п.) с вопросом в подписи.",
         reply_markup=main_keyboard(),
     )
 
@@ -203,17 +428,13 @@ async def cmd_conversations(message: types.Message) -> None:
         return
     
     telegram_user_id = message.from_user.id
-    backend_user_id = user_storage.get_backend_user_id(telegram_user_id)
+    backend_user_id = await user_storage.get_backend_user_id(telegram_user_id)
     
     if not backend_user_id:
         # Пытаемся получить из backend
         telegram_user = await backend.get_telegram_user(telegram_user_id)
         if telegram_user:
-            backend_user_id = (
-                telegram_user.get("user_id") 
-                or telegram_user.get("backend_user_id")
-                or telegram_user.get("linked_user_id")
-            )
+            backend_user_id = telegram_user.backend_user_id
     
     if not backend_user_id:
         await message.answer(
@@ -239,14 +460,13 @@ async def cmd_conversations(message: types.Message) -> None:
     # Создаем клавиатуру с разговорами
     keyboard_rows = []
     for conv in conversations:
-        conv_id = conv.get("id") or conv.get("conversation_id")
-        title = conv.get("title") or conv.get("name") or f"Разговор #{conv_id}"
+        title = conv.title
         # Ограничиваем длину названия для кнопки
         button_text = title[:40] + "..." if len(title) > 40 else title
         keyboard_rows.append([
             InlineKeyboardButton(
                 text=button_text,
-                callback_data=f"conv|{conv_id}"
+                callback_data=f"conv|{conv.id}"
             )
         ])
     
@@ -260,6 +480,24 @@ async def cmd_conversations(message: types.Message) -> None:
         f"Выберите разговор для просмотра или создания нового:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard_rows)
     )
+    if settings.history_prefetch:
+        prefetcher.schedule(telegram_user_id, [conv.id for conv in conversations])
+
+async def _send_history_document(
+    message: types.Message,
+    history: list[HistoryMessage],
+    conversation_id: str,
+    fmt: str,
+) -> None:
+    """Отправляет историю одним документом; временный файл удаляется после отправки"""
+    path = await export_history(history, fmt)
+    try:
+        await message.answer_document(
+            FSInputFile(path, filename=f"history-{conversation_id}.{fmt}"),
+            caption=f"📜 История разговора ({len(history)} сообщений)",
+        )
+    finally:
+        os.unlink(path)
 
 async def cmd_history(message: types.Message) -> None:
     """Показывает историю текущего разговора"""
@@ -268,7 +506,7 @@ async def cmd_history(message: types.Message) -> None:
         return
     
     telegram_user_id = message.from_user.id
-    conversation_id = user_storage.get_conversation_id(telegram_user_id)
+    conversation_id = await user_storage.get_conversation_id(telegram_user_id)
     
     if not conversation_id:
         await message.answer(
@@ -279,7 +517,7 @@ async def cmd_history(message: types.Message) -> None:
     
     await message.answer("⏳ Загружаю историю разговора...")
     
-    history = await backend.get_conversation_history(conversation_id)
+    history = await history_mirror.get(conversation_id)
     
     if history is None:
         await message.answer("❌ Ошибка при получении истории разговора.")
@@ -289,72 +527,361 @@ async def cmd_history(message: types.Message) -> None:
         await message.answer("📭 История разговора пуста.")
         return
     
-    # Форматируем историю
-    history_text = "📜 История разговора:\n\n"
+    # Большую историю отправляем одним файлом вместо десятков сообщений
+    if estimate_size(history) > settings.history_export_threshold:
+        await _send_history_document(message, history, conversation_id, settings.history_export_format)
+        return
+    
+    # Форматирование и разбиение на части длинной истории выполняются в пуле рендеринга
+    for part in await renderer.history(history):
+        await message.answer(part, parse_mode=ParseMode.MARKDOWN)
+
+async def cmd_export(message: types.Message, command: CommandObject) -> None:
+    """/export [txt|md|html] — история текущего разговора файлом"""
+    if not message.from_user:
+        await message.answer("Ошибка: не удалось получить информацию о пользователе.")
+        return
     
-    # Получаем title разговора (если есть)
-    title = None
-    for msg in history:
-        if msg.get("title"):
-            title = msg.get("title")
-            break
+    fmt = (command.args or settings.history_export_format).strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        await message.answer("Использование: /export [txt|md|html]")
+        return
     
-    if title:
-        history_text += f"**{title}**\n\n"
+    conversation_id = await user_storage.get_conversation_id(message.from_user.id)
+    if not conversation_id:
+        await message.answer(
+            "❌ У вас нет активного разговора.\n\n"
+            "Используйте /conversations для выбора разговора."
+        )
+        return
     
-    # Форматируем сообщения
-    for msg in history:
-        role = msg.get("role") or msg.get("name") or "user"
-        content = msg.get("content") or msg.get("message") or msg.get("text") or ""
-        
-        # Определяем имя отправителя
-        if role.lower() in ["user", "human"]:
-            name = "Вы"
-        elif role.lower() in ["assistant", "ai", "bot"]:
-            name = "Ассистент"
-        else:
-            name = role.capitalize()
-        
-        history_text += f"{name}:\n{content}\n\n"
-    
-    # Разбиваем на части, если сообщение слишком длинное
-    if len(history_text) > 4000:
-        # Отправляем частями
-        parts = [history_text[i:i+4000] for i in range(0, len(history_text), 4000)]
-        for part in parts:
-            await message.answer(part, parse_mode=ParseMode.MARKDOWN)
-    else:
-        await message.answer(history_text, parse_mode=ParseMode.MARKDOWN)
+    history = await history_mirror.get(conversation_id)
+    if history is None:
+        await message.answer("❌ Ошибка при получении истории разговора.")
+        return
+    if not history:
+        await message.answer("📭 История разговора пуста.")
+        return
+    
+    await _send_history_document(message, history, conversation_id, fmt)
 
 async def cmd_clear(message: types.Message) -> None:
     # Очищаем текущий разговор (сбрасываем conversation_id)
     if message.from_user:
-        user_storage.set_conversation_id(message.from_user.id, None)
+        inflight.supersede(message.from_user.id)
+        await user_storage.set_conversation_id(message.from_user.id, None)
     await message.answer("✅ Текущий разговор сброшен. Новое сообщение начнет новый разговор.", reply_markup=main_keyboard())
 
 
-def _clean_markdown(text: str) -> str:
-    lines = text.splitlines()
-    cleaned: list[str] = []
-    for line in lines:
-        line = re.sub(r"^\s{0,3}#{1,6}\s*", "", line)
-        line = re.sub(r"^\s{0,3}[-*]\s+", "• ", line)
-        line = re.sub(r"^\s{0,3}>\s?", "", line)
-        line = line.replace("**", "").replace("__", "").replace("*", "")
-        line = line.replace("```", "").replace("`", "")
-        cleaned.append(line)
-    result = "\n".join(cleaned)
-    result = re.sub(r"\n{3,}", "\n\n", result).strip()
-    return result
+# Шаги входа по email и паролю в user_states: ожидание email, затем пароля ("login_password|<email>")
+LOGIN_EMAIL = "login_email"
+LOGIN_PASSWORD = "login_password|"
 
 
-async def _process_text(bot: Bot, chat_id: int, user_id: int, text: str) -> None:
+def _is_login_state(state: Optional[str]) -> bool:
+    return state is not None and (state == LOGIN_EMAIL or state.startswith(LOGIN_PASSWORD))
+
+
+async def is_login_step(update: types.Update) -> bool:
+    """Сообщение — ввод email или пароля после /login: не записывается и не оплачивается квотой"""
+    message = update.message
+    if message is None or message.from_user is None or not message.text or message.text.startswith("/"):
+        return False
+    try:
+        return _is_login_state(await user_states.get(message.from_user.id))
+    except Exception as e:
+        # Состояние неизвестно — считаем шагом входа, чтобы пароль точно не попал в запись
+        logger.warning("Login state check failed for user %s: %s", message.from_user.id, e)
+        return True
+
+
+async def cmd_login(message: types.Message) -> None:
+    """/login — вход в основной аккаунт: по сохраненным учетным данным или по email и паролю"""
+    if not message.from_user:
+        return
+    telegram_user_id = message.from_user.id
+    credentials = await user_storage.get_credentials(telegram_user_id)
+    if credentials.get("email") and credentials.get("password") and await sessions.login(telegram_user_id):
+        await message.answer("✅ Вход выполнен. Отправьте мне сообщение, чтобы продолжить.", reply_markup=main_keyboard())
+        return
+    await user_states.set(telegram_user_id, LOGIN_EMAIL)
+    await message.answer(
+        "Введите email основного аккаунта.\nЧтобы отменить вход, отправьте «Отмена».",
+        reply_markup=ForceReply(),
+    )
+
+
+async def _continue_login(message: types.Message, state: str) -> None:
+    """Следующий шаг входа: сообщение пользователя — email или пароль"""
+    telegram_user_id = message.from_user.id
+    text = message.text.strip()
+    if text.lower() == "отмена":
+        await user_states.pop(telegram_user_id)
+        await message.answer("Вход отменен.", reply_markup=main_keyboard())
+        return
+    if state == LOGIN_EMAIL:
+        if "@" not in text or " " in text:
+            await message.answer("Похоже, это не email. Введите email или отправьте «Отмена».", reply_markup=ForceReply())
+            return
+        await user_states.set(telegram_user_id, LOGIN_PASSWORD + text)
+        await message.answer("Введите пароль. Сообщение с паролем будет удалено.", reply_markup=ForceReply())
+        return
+
+    email = state[len(LOGIN_PASSWORD):]
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.warning("Failed to delete password message from %s: %s", telegram_user_id, e)
+    linked_before = await user_storage.get_backend_user_id(telegram_user_id)
+    token = await sessions.login_with(telegram_user_id, email, text)
+    if token is None:
+        await user_states.set(telegram_user_id, LOGIN_EMAIL)
+        await message.answer(
+            "❌ Неверный email или пароль. Введите email еще раз или отправьте «Отмена».",
+            reply_markup=ForceReply(),
+        )
+        return
+    await user_states.pop(telegram_user_id)
+    backend_user_id = await user_storage.get_backend_user_id(telegram_user_id)
+    if backend_user_id and backend_user_id != linked_before:
+        if not await backend.link_telegram_user(telegram_user_id, backend_user_id):
+            logger.warning("Failed to link telegram user %s to backend user %s", telegram_user_id, backend_user_id)
+    await message.answer("✅ Вход выполнен. Отправьте мне сообщение, чтобы продолжить.", reply_markup=main_keyboard())
+
+
+def _is_admin(message: types.Message) -> bool:
+    return bool(
+        message.from_user
+        and settings.admin_user_id is not None
+        and message.from_user.id == settings.admin_user_id
+    )
+
+
+def _container_size(obj: object, attr: str) -> str:
+    """Размер in-memory контейнера или пометка, что состояние во внешнем хранилище"""
+    container = getattr(obj, attr, None)
+    return str(len(container)) if container is not None else "внешнее хранилище"
+
+
+async def cmd_admin_stats(message: types.Message) -> None:
+    """Сводка по живому процессу: задачи, запросы к backend, размеры состояния, lag"""
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+
+    lag = loop_lag.percentiles()
+    tasks = task_counts()
+    lines = [
+        "🛠 Диагностика",
+        "",
+        f"Задачи asyncio: {sum(tasks.values())}",
+    ]
+    lines += [f"  {name}: {count}" for name, count in tasks.most_common(10)]
+    lines.append("Обработчики в работе:")
+    lines += [f"  {name}: {count}" for name, count in handler_tracker.in_flight.most_common()] or ["  нет"]
+    lines += [
+        "Полосы: " + ", ".join(
+            f"{lane.name} {lane.active}/{lane.concurrency} (ожидают {lane.waiting})"
+            for lane in lanes.lanes.values()
+        ),
+        f"Запросы к backend в полете: {backend.in_flight}",
+    ]
+    if len(backend.balancer.endpoints) > 1:
+        lines.append("Экземпляры backend (в полете, EWMA, запросов/ошибок, исключений):")
+        lines += [
+            f"  {url}: {e['in_flight']}, {e['ewma_ms'] or 0:.0f} мс, {e['requests']}/{e['failures']}, {e['ejections']}"
+            + (f", исключен еще на {e['ejected_for_s']:.0f} с" if e["ejected_for_s"] else "")
+            for url, e in backend.balancer.summary().items()
+        ]
+    lines += [
+        f"Генерации в полете: {inflight.count()}, отменено: {inflight.cancelled}",
+        (
+            f"Квота: ждут {quota.waiting}, отложено {quota.deferred}, отказано {quota.rejected}"
+            if quota is not None
+            else "Квота: выключена"
+        ),
+        f"Пропущено повторных обновлений: {dedup_store.duplicates}",
+        (
+            f"Сессии: {sessions.size()[0]}, входов {sessions.logins} (неудачных {sessions.failed_logins}), "
+            f"обновлено заранее {sessions.refreshed}, профили в кэше {sessions.size()[1]} "
+            f"(попаданий {sessions.profile_hits}, промахов {sessions.profile_misses})"
+        ),
+        (
+            f"Предзагрузка историй: загружено {prefetcher.prefetched}, попаданий {prefetcher.hits}, "
+            f"промахов {prefetcher.misses}, отменено {prefetcher.cancelled}, в кэше {prefetcher.size()[0]}"
+        ),
+        (
+            "Пакеты пользователей backend: " + ", ".join(
+                f"{loader.name} {loader.batches} (в среднем {loader.summary()['avg_batch']})"
+                for loader in (backend.telegram_users, backend.telegram_user_upserts)
+            ) + f", поштучно {backend.batch_fallbacks}"
+            if settings.backend_batching
+            else "Пакеты пользователей backend: выключены"
+        ),
+        (
+            f"Рендеринг: сразу {renderer.inline}, в пуле {renderer.offloaded} (ждали места {renderer.waited}), "
+            f"из кэша {renderer.cache_hits}"
+        ),
+        (
+            f"Outbox: доставлено {outbox.delivered}, ждут {outbox.pending()}, повторов {outbox.retried}, "
+            f"обычным текстом {outbox.plain_fallbacks}, отказов {outbox.dropped}"
+        ),
+        f"Хеджирование GET: дубликатов {backend.hedge_budget.hedged}, отказано бюджетом {backend.hedge_budget.denied}",
+        "Bot API, мс (вызовы/ошибки p50 p95):",
+    ]
+    methods = list(telegram_metrics.summary().items())[:8]
+    lines += [
+        f"  {name}: {m['calls']}/{m['errors']} p50={m['p50_ms']:.0f} p95={m['p95_ms']:.0f}" for name, m in methods
+    ] or ["  нет вызовов"]
+    lines += [
+        "",
+        f"RateLimiter._hits: {_container_size(rate_limiter, '_hits')}",
+        f"user_states: {_container_size(user_states, '_states')}",
+        f"UserStorage._storage: {_container_size(user_storage, '_storage')}",
+        "",
+        "Задержка event loop, мс: "
+        f"p50={lag['p50']:.1f} p90={lag['p90']:.1f} p99={lag['p99']:.1f} max={lag['max']:.1f}",
+    ]
+    await message.answer("\n".join(lines))
+
+
+async def cmd_admin_mem(message: types.Message, command: CommandObject) -> None:
+    """/admin_mem start|stop|top [N] — снимок аллокаций через tracemalloc"""
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+
+    args = (command.args or "top").split()
+    action = args[0].lower()
+    if action == "start":
+        started = tracemalloc_start()
+        await message.answer("✅ tracemalloc включен." if started else "tracemalloc уже включен.")
+    elif action == "stop":
+        stopped = tracemalloc_stop()
+        await message.answer("✅ tracemalloc выключен." if stopped else "tracemalloc не был включен.")
+    elif action == "top":
+        limit = int(args[1]) if len(args) > 1 and args[1].isdigit() else 10
+        # До 50 строк с путями могут не поместиться в одно сообщение
+        for part in split_message(tracemalloc_top(min(limit, 50))):
+            await message.answer(part)
+    else:
+        await message.answer("Использование: /admin_mem start|stop|top [N]")
+
+
+async def cmd_admin_profile(message: types.Message, command: CommandObject) -> None:
+    """/admin_profile [секунды] — сэмплирующий CPU-профиль event loop файлом"""
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+
+    seconds = int(command.args) if command.args and command.args.strip().isdigit() else 5
+    seconds = max(1, min(seconds, 30))
+    await message.answer(f"⏳ Собираю CPU-профиль ({seconds} с)...")
+    profile = await cpu_profile(seconds)
+    await message.answer_document(
+        BufferedInputFile(profile, filename=f"cpu-profile-{int(time.time())}.txt"),
+        caption="Collapsed stacks (flamegraph.pl / speedscope)",
+    )
+
+
+def _format_changes(changes: dict) -> str:
+    if not changes:
+        return "Значения не изменились."
+    return "\n".join(f"{key}: {old} → {new}" for key, (old, new) in changes.items())
+
+
+async def cmd_admin_config(message: types.Message) -> None:
+    """/admin_config — текущие значения настроек, изменяемых без перезапуска"""
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+
+    lines = ["⚙️ Настройки без перезапуска (* — изменено после запуска)", ""]
+    for key in live_config.keys():
+        value = live_config.current(key)
+        mark = " *" if value != live_config.startup(key) else ""
+        lines.append(f"{key}={value}{mark}")
+    lines += ["", "/admin_set KEY=VALUE ... — изменить, /admin_reload — перечитать LIVE_CONFIG_FILE"]
+    await message.answer("\n".join(lines))
+
+
+async def cmd_admin_set(message: types.Message, command: CommandObject) -> None:
+    """/admin_set KEY=VALUE [KEY=VALUE ...] — изменить настройки до перезапуска"""
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+
+    args = (command.args or "").split()
+    if len(args) == 2 and "=" not in args[0]:
+        args = [f"{args[0]}={args[1]}"]
+    if not args or any("=" not in arg for arg in args):
+        await message.answer("Использование: /admin_set KEY=VALUE [KEY=VALUE ...]\nСписок настроек: /admin_config")
+        return
+    changes = dict(arg.split("=", 1) for arg in args)
+    try:
+        result = live_config.apply(changes, source=f"admin {message.from_user.id}")
+    except LiveConfigError as e:
+        await message.answer(f"❌ Не применено: {e}")
+        return
+    await message.answer("✅ " + _format_changes(result))
+
+
+async def cmd_admin_reload(message: types.Message) -> None:
+    """/admin_reload — перечитать LIVE_CONFIG_FILE (то же, что SIGHUP)"""
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+
+    try:
+        result = live_config.reload(source=f"admin {message.from_user.id}")
+    except LiveConfigError as e:
+        await message.answer(f"❌ Не применено: {e}")
+        return
+    await message.answer("✅ " + _format_changes(result))
+
+
+async def cmd_broadcast(message: types.Message, command: CommandObject) -> None:
+    """/broadcast <текст> — рассылка всем пользователям"""
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+    
+    text = (command.args or "").strip()
+    if not text:
+        await message.answer("Использование: /broadcast <текст сообщения>")
+        return
+    
+    if not broadcaster.start(message.bot, text, message.chat.id):
+        await message.answer("Рассылка уже идет. /broadcast_status — прогресс, /broadcast_cancel — отмена.")
+        return
+    await message.answer("📣 Рассылка запущена. Прогресс будет обновляться в этом чате.")
+
+
+async def cmd_broadcast_status(message: types.Message) -> None:
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+    await message.answer(broadcaster.progress_text())
+
+
+async def cmd_broadcast_cancel(message: types.Message) -> None:
+    if not _is_admin(message):
+        await message.answer("Команда доступна только администратору.")
+        return
+    if await broadcaster.cancel():
+        await message.answer("⏹ Рассылка отменена.\n\n" + broadcaster.progress_text())
+    else:
+        await message.answer("Рассылка не запущена.")
+
+
+async def _resolve_backend_user_id(user_id: int) -> Optional[int]:
+    """Определяет backend_user_id по локальному хранилищу или backend (GET, затем POST)"""
     # Получаем backend_user_id из Telegram пользователя или локального хранилища
     backend_user_id = None
     
     # Сначала проверяем локальное хранилище
-    if user_storage.has_user(user_id):
-        backend_user_id = user_storage.get_backend_user_id(user_id)
+    if await user_storage.has_user(user_id):
+        backend_user_id = await user_storage.get_backend_user_id(user_id)
     
     # Если нет в локальном хранилище, проверяем через GET, затем создаем через POST если нужно
     if not backend_user_id:
@@ -376,22 +903,17 @@ async def _process_text(bot: Bot, chat_id: int, user_id: int, text: str) -> None
             
             if telegram_user:
                 logger.info("Telegram user response: %s", telegram_user)
-                # Пробуем разные варианты названий полей
-                backend_user_id = (
-                    telegram_user.get("user_id") 
-                    or telegram_user.get("backend_user_id")
-                    or telegram_user.get("linked_user_id")
-                )
+                backend_user_id = telegram_user.backend_user_id
                 logger.info("Extracted backend_user_id: %s from telegram_user: %s", backend_user_id, telegram_user)
                 
                 # Если нашли в backend, сохраняем в локальное хранилище
                 if backend_user_id:
-                    token = user_storage.get_token(user_id)
-                    user_storage.set(
+                    token = await user_storage.get_token(user_id)
+                    await user_storage.set(
                         telegram_user_id=user_id,
                         backend_user_id=backend_user_id,
                         token=token,  # Сохраняем токен, если есть
-                        telegram_username=telegram_user.get("telegram_username")
+                        telegram_username=telegram_user.telegram_username
                     )
                 else:
                     # Telegram пользователь существует, но не связан с основным аккаунтом
@@ -399,16 +921,23 @@ async def _process_text(bot: Bot, chat_id: int, user_id: int, text: str) -> None
                     logger.info("Telegram user %s exists but not linked to backend account, using telegram_user_id directly", user_id)
                     backend_user_id = user_id  # Используем telegram_user_id как user_id
                     # Сохраняем в локальное хранилище для будущих запросов
-                    user_storage.set(
+                    await user_storage.set(
                         telegram_user_id=user_id,
                         backend_user_id=user_id,  # Временно используем telegram_user_id
-                        telegram_username=telegram_user.get("telegram_username")
+                        telegram_username=telegram_user.telegram_username
                     )
             else:
                 logger.warning("Failed to get/create Telegram user %s", user_id)
         except Exception as e:
             logger.exception("Error getting/creating Telegram user: %s", e)
     
+    return backend_user_id
+
+
+async def _process_text(bot: Bot, chat_id: int, user_id: int, text: str) -> None:
+    with span("identity.lookup"):
+        backend_user_id = await _resolve_backend_user_id(user_id)
+    
     # Если все еще нет backend_user_id, пользователь не зарегистрирован
     if not backend_user_id:
         await bot.send_message(
@@ -417,53 +946,44 @@ async def _process_text(bot: Bot, chat_id: int, user_id: int, text: str) -> None
         )
         return
     
-    if not rate_limiter.allow(user_id):
+    if not await rate_limiter.allow(user_id):
         await bot.send_message(chat_id, "Превышен лимит запросов. Попробуйте позже.")
         return
 
     # Получаем текущий conversation_id
-    conversation_id = user_storage.get_conversation_id(user_id)
+    conversation_id = await user_storage.get_conversation_id(user_id)
     logger.info("Sending message with conversation_id: %s (user_id: %s)", conversation_id, user_id)
     
+    if settings.cancel_on_followup:
+        # Новое сообщение вытесняет ответ на предыдущее, который еще генерируется
+        inflight.supersede(user_id)
+
     async with ChatActionSender.typing(bot=bot, chat_id=chat_id):
         try:
-            reply_data = await backend.send_message(backend_user_id, text, conversation_id)
+            started = time.monotonic()
+            reply_data, epoch = await inflight.run(user_id, backend.send_message(backend_user_id, text, conversation_id))
+            if quota is not None and reply_data is not None:
+                await quota.charge(user_id, quota.reply_cost(time.monotonic() - started, reply_data.tokens))
             if reply_data is None:
                 await bot.send_message(chat_id, "Ошибка при обращении к серверу. Попробуйте позже.")
                 return
             
             logger.info("Backend response: %s", reply_data)
             
+            if not inflight.is_current(user_id, epoch):
+                # Разговор сбросили, пока списывалась квота
+                raise Superseded()
+            
             # Проверяем, вернул ли backend conversation_id в ответе
             # (если это новый разговор, backend может вернуть его ID)
-            new_conversation_id = None
-            reply = None
+            if reply_data.conversation_id is not None:
+                logger.info("New conversation_id received: %s", reply_data.conversation_id)
+                await user_storage.set_conversation_id(user_id, reply_data.conversation_id)
             
-            if isinstance(reply_data, dict):
-                # Пробуем разные варианты названий полей для conversation_id
-                new_conversation_id = (
-                    reply_data.get("conversation_id") 
-                    or reply_data.get("conversationId")
-                    or reply_data.get("id")
-                )
-                
-                # Конвертируем в строку (может быть UUID)
-                if new_conversation_id is not None:
-                    new_conversation_id = str(new_conversation_id)
-                    logger.info("New conversation_id received: %s", new_conversation_id)
-                    user_storage.set_conversation_id(user_id, new_conversation_id)
-                
-                # Извлекаем текст ответа
-                reply = (
-                    reply_data.get("response") 
-                    or reply_data.get("message") 
-                    or reply_data.get("text")
-                    or reply_data.get("content")
-                    or reply_data.get("answer")
-                )
-            else:
-                reply = reply_data
-                
+            reply = reply_data.text
+        except Superseded:
+            logger.info("Dropping superseded reply for user %s", user_id)
+            return
         except Exception as e:
             logger.exception("Backend call failed: %s", e)
             await bot.send_message(chat_id, "Ошибка сервера. Попробуйте позже.")
@@ -473,8 +993,64 @@ async def _process_text(bot: Bot, chat_id: int, user_id: int, text: str) -> None
         await bot.send_message(chat_id, "Ошибка: пустой ответ от сервера.")
         return
     
-    reply = _clean_markdown(reply)
-    await bot.send_message(chat_id, reply, parse_mode=ParseMode.HTML)
+    await _send_reply(bot, chat_id, user_id, epoch, reply_data.conversation_id or conversation_id, text, reply)
+
+
+async def _send_reply(
+    bot: Bot,
+    chat_id: int,
+    user_id: int,
+    epoch: int,
+    conversation_id: Optional[str],
+    user_text: str,
+    reply: str,
+) -> None:
+    """Отправляет ответ backend пользователю, если разговор не сбросили после получения ответа (epoch)"""
+    if not inflight.is_current(user_id, epoch):
+        logger.info("Dropping superseded reply for user %s", user_id)
+        return
+    # Ход разговора сразу попадает в локальное зеркало истории
+    await history_mirror.append_turns(conversation_id, [("user", user_text), ("assistant", reply)])
+    prefetcher.invalidate(conversation_id)
+    
+    with span("markdown.clean", chars=len(reply)):
+        parts = await renderer.reply(reply)
+    if not inflight.is_current(user_id, epoch):
+        # Сброс пришел, пока ответ записывался в зеркало и форматировался
+        logger.info("Dropping superseded reply for user %s", user_id)
+        return
+    # Ответ сначала попадает в журнал outbox: сбой отправки не требует повторной генерации
+    with span("telegram.send_message"):
+        await outbox.deliver(bot, chat_id, parts, ParseMode.HTML)
+
+
+async def _ingest_document(
+    bot: Bot,
+    document: types.Document,
+    backend_user_id: int,
+    caption: Optional[str],
+    conversation_id: Optional[str],
+    progress: IngestProgress,
+) -> Optional[ChatReply]:
+    """Потоком загружает документ в backend фрагментами и запрашивает ответ по нему"""
+    document_id = secrets.token_hex(8)
+    file_name = document_name(document)
+    file = await bot.get_file(document.file_id)
+    chunks = split_text(
+        decode_text(stream_telegram_file(bot, file.file_path, settings.document_max_bytes, progress)),
+        settings.document_chunk_chars,
+        progress,
+    )
+
+    async def upload(index: int, text: str) -> None:
+        if not await backend.upload_document_chunk(backend_user_id, document_id, index, text, file_name, conversation_id):
+            raise DocumentError("Сервер не принял фрагмент документа. Попробуйте позже.")
+
+    with span("document.ingest", file_size=document.file_size or 0):
+        count = await upload_chunks(chunks, upload, settings.document_upload_concurrency, progress)
+    if count == 0:
+        raise DocumentError("Документ пустой.")
+    return await backend.complete_document(backend_user_id, document_id, count, file_name, caption, conversation_id)
 
 
 def categories_keyboard() -> InlineKeyboardMarkup:
@@ -526,7 +1102,8 @@ async def on_callback(call: CallbackQuery) -> None:
         
         if conv_data == "new":
             # Создаем новый разговор (сбрасываем conversation_id)
-            user_storage.set_conversation_id(telegram_user_id, None)
+            inflight.supersede(telegram_user_id)
+            await user_storage.set_conversation_id(telegram_user_id, None)
             await call.message.edit_text(
                 "✅ Новый разговор создан.\n\n"
                 "Отправьте сообщение, чтобы начать новый разговор."
@@ -538,12 +1115,14 @@ async def on_callback(call: CallbackQuery) -> None:
         conversation_id = str(conv_data)
         
         # Устанавливаем выбранный разговор как текущий
-        user_storage.set_conversation_id(telegram_user_id, conversation_id)
-        
-        # Загружаем и показываем историю разговора
-        await call.message.edit_text("⏳ Загружаю историю разговора...")
+        inflight.supersede(telegram_user_id)
+        await user_storage.set_conversation_id(telegram_user_id, conversation_id)
         
-        history = await backend.get_conversation_history(conversation_id)
+        # Загружаем и показываем историю разговора (заранее загруженная показывается сразу)
+        history = prefetcher.take(telegram_user_id, conversation_id)
+        if history is None:
+            await call.message.edit_text("⏳ Загружаю историю разговора...")
+            history = await history_mirror.get(conversation_id)
         
         if history is None:
             await call.message.edit_text("❌ Ошибка при получении истории разговора.")
@@ -558,46 +1137,18 @@ async def on_callback(call: CallbackQuery) -> None:
             await call.answer("Разговор выбран")
             return
         
-        # Форматируем историю
-        history_text = "📜 История разговора:\n\n"
-        
-        # Получаем title разговора (если есть)
-        title = None
-        for msg in history:
-            if msg.get("title"):
-                title = msg.get("title")
-                break
-        
-        if title:
-            history_text += f"**{title}**\n\n"
+        if estimate_size(history) > settings.history_export_threshold:
+            await call.message.edit_text("📎 История большая — отправляю её файлом.")
+            await _send_history_document(call.message, history, conversation_id, settings.history_export_format)
+            await call.answer("Разговор выбран")
+            return
         
-        # Форматируем сообщения
-        for msg in history:
-            role = msg.get("role") or msg.get("name") or "user"
-            content = msg.get("content") or msg.get("message") or msg.get("text") or ""
-            
-            # Определяем имя отправителя
-            if role.lower() in ["user", "human"]:
-                name = "Вы"
-            elif role.lower() in ["assistant", "ai", "bot"]:
-                name = "Ассистент"
-            else:
-                name = role.capitalize()
-            
-            history_text += f"{name}:\n{content}\n\n"
+        parts = await renderer.history(history)
         
-        # Разбиваем на части, если сообщение слишком длинное
-        if len(history_text) > 4000:
-            # Отправляем первую часть
-            first_part = history_text[:4000]
-            await call.message.edit_text(first_part, parse_mode=ParseMode.MARKDOWN)
-            # Остальные части отправляем отдельными сообщениями
-            remaining = history_text[4000:]
-            parts = [remaining[i:i+4000] for i in range(0, len(remaining), 4000)]
-            for part in parts:
-                await call.message.answer(part, parse_mode=ParseMode.MARKDOWN)
-        else:
-            await call.message.edit_text(history_text, parse_mode=ParseMode.MARKDOWN)
+        # Первая часть заменяет сообщение со списком, остальные отправляем отдельными сообщениями
+        await call.message.edit_text(parts[0], parse_mode=ParseMode.MARKDOWN)
+        for part in parts[1:]:
+            await call.message.answer(part, parse_mode=ParseMode.MARKDOWN)
         
         await call.answer("Разговор выбран")
         return
@@ -613,7 +1164,7 @@ async def on_callback(call: CallbackQuery) -> None:
         name = call.from_user.full_name or "Пользователь"
         
         # Проверяем, не зарегистрирован ли уже
-        if user_storage.has_user(telegram_user_id):
+        if await user_storage.has_user(telegram_user_id):
             await call.answer("Вы уже зарегистрированы!", show_alert=True)
             await call.message.edit_text(
                 f"Привет, {name}! 👋\n"
@@ -626,8 +1177,8 @@ async def on_callback(call: CallbackQuery) -> None:
         await call.message.edit_text("⏳ Создаю аккаунт...")
         
         # Генерируем email автоматически
-        email = backend._generate_email(telegram_user_id, telegram_username)
-        password = backend._generate_password()
+        email = backend.generate_email(telegram_user_id, telegram_username)
+        password = backend.generate_password()
         
         try:
             result = await backend.register(
@@ -649,7 +1200,7 @@ async def on_callback(call: CallbackQuery) -> None:
                     logger.warning("Failed to link telegram user %s to backend user %s", telegram_user_id, backend_user_id)
                 
                 # Сохраняем данные
-                user_storage.set(
+                await user_storage.set(
                     telegram_user_id=telegram_user_id,
                     backend_user_id=backend_user_id,
                     token=token,
@@ -657,6 +1208,8 @@ async def on_callback(call: CallbackQuery) -> None:
                     password=password,
                     telegram_username=telegram_username
                 )
+                if token:
+                    sessions.remember(telegram_user_id, token, issued_at=time.time())
                 
                 await call.message.edit_text(
                     f"✅ Аккаунт успешно создан!\n\n"
@@ -687,7 +1240,7 @@ async def on_callback(call: CallbackQuery) -> None:
     
     if data == "register_cancel":
         if call.from_user:
-            user_states.pop(call.from_user.id, None)
+            await user_states.pop(call.from_user.id)
         await call.message.edit_text(
             "Регистрация отменена. Используйте /start для начала работы."
         )
@@ -723,6 +1276,80 @@ async def on_callback(call: CallbackQuery) -> None:
         await call.answer()
         return
 
+async def handle_document(message: types.Message) -> None:
+    """Документ пользователя: загрузка в backend по частям и ответ по его содержимому"""
+    if not message.from_user or not message.document:
+        await message.answer("Ошибка: не удалось получить информацию о пользователе.")
+        return
+    
+    user_id = message.from_user.id
+    document = message.document
+    if not is_text_document(document):
+        await message.answer("Пока поддерживаются только текстовые файлы: TXT, CSV, MD, JSON, XML, HTML.")
+        return
+    if document.file_size and document.file_size > settings.document_max_bytes:
+        await message.answer(f"Файл слишком большой (максимум {settings.document_max_bytes // (1024 * 1024)} МБ).")
+        return
+    
+    with span("identity.lookup"):
+        backend_user_id = await _resolve_backend_user_id(user_id)
+    if not backend_user_id:
+        await message.answer("❌ Вы не зарегистрированы. Пожалуйста, используйте /start для регистрации.")
+        return
+    if not await rate_limiter.allow(user_id):
+        await message.answer("Превышен лимит запросов. Попробуйте позже.")
+        return
+    
+    conversation_id = await user_storage.get_conversation_id(user_id)
+    file_name = document_name(document)
+    status = await message.answer("📄 Получил документ, начинаю обработку...")
+    progress = IngestProgress(total_bytes=document.file_size)
+    reporter = asyncio.create_task(report_progress(status.edit_text, progress))
+    started = time.monotonic()
+    try:
+        # Загрузка большого файла дольше обычного ответа — свой бюджет времени
+        with budget(settings.document_budget_seconds):
+            reply_data, epoch = await inflight.run(
+                user_id,
+                _ingest_document(message.bot, document, backend_user_id, message.caption, conversation_id, progress),
+            )
+    except Superseded:
+        await status.edit_text("Обработка документа отменена.")
+        return
+    except DocumentError as e:
+        await status.edit_text(f"❌ {e}")
+        return
+    except Exception as e:
+        logger.exception("Document ingestion failed: %s", e)
+        await status.edit_text("❌ Не удалось обработать документ. Попробуйте позже.")
+        return
+    finally:
+        reporter.cancel()
+    
+    if reply_data is None:
+        await status.edit_text("❌ Ошибка при обращении к серверу. Попробуйте позже.")
+        return
+    if quota is not None:
+        await quota.charge(user_id, quota.reply_cost(time.monotonic() - started, reply_data.tokens))
+    if not inflight.is_current(user_id, epoch):
+        await status.edit_text("Обработка документа отменена.")
+        return
+    if reply_data.conversation_id is not None:
+        await user_storage.set_conversation_id(user_id, reply_data.conversation_id)
+    
+    await status.edit_text(f"✅ Документ «{file_name}» обработан ({progress.chunks_uploaded} фрагм.).")
+    if reply_data.text:
+        await _send_reply(
+            message.bot,
+            message.chat.id,
+            user_id,
+            epoch,
+            reply_data.conversation_id or conversation_id,
+            message.caption or f"📄 {file_name}",
+            reply_data.text,
+        )
+
+
 async def handle_message(message: types.Message) -> None:
     if not message.text:
         await message.answer("Пожалуйста, отправьте текстовое сообщение.")
@@ -739,28 +1366,75 @@ async def handle_message(message: types.Message) -> None:
     first_name = name_parts[0] if name_parts else None
     last_name = name_parts[1] if len(name_parts) > 1 else None
     
+    # Ввод email и пароля после /login
+    state = await user_states.get(uid)
+    if _is_login_state(state):
+        await _continue_login(message, state)
+        return
+
     # Обычная обработка сообщений
     await _process_text(message.bot, message.chat.id, uid, message.text)
 
-async def main() -> None:
-    if not settings.telegram_bot_token:
-        logger.error("Env var TELEGRAM_BOT_TOKEN not found. Ensure it is set in deployment service variables.")
-        raise RuntimeError("TELEGRAM_BOT_TOKEN is required")
-    bot = Bot(token=settings.telegram_bot_token)
+def create_dispatcher() -> Dispatcher:
+    """Dispatcher со всеми middleware и обработчиками (используется и в app/replay.py)"""
     dp = Dispatcher()
 
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    if recorder.enabled:
+        dp.update.outer_middleware(RecorderMiddleware(recorder, is_secret=is_login_step))
+    dp.update.outer_middleware(DedupMiddleware(dedup_store))
+    dp.update.outer_middleware(PrefetchCancelMiddleware(prefetcher))
+    dp.update.outer_middleware(TracingMiddleware())
+    if quota is not None:
+        # Ожидание квоты — до дедлайна и полос: оно не тратит бюджет ответа и места в полосе
+        dp.update.outer_middleware(QuotaMiddleware(quota, is_exempt=is_login_step))
+    dp.update.outer_middleware(deadline)
+    dp.update.outer_middleware(lanes)
+    dp.message.middleware(handler_tracker)
+    dp.callback_query.middleware(handler_tracker)
 
     dp.message.register(cmd_start, Command("start"))
     dp.message.register(cmd_help, Command("help"))
     dp.message.register(cmd_conversations, Command("conversations"))
     dp.message.register(cmd_history, Command("history"))
+    dp.message.register(cmd_export, Command("export"))
     dp.message.register(cmd_clear, Command("clear"))
+    dp.message.register(cmd_login, Command("login"))
     dp.message.register(open_templates, Command("templates"))
+    dp.message.register(cmd_admin_stats, Command("admin_stats"))
+    dp.message.register(cmd_admin_mem, Command("admin_mem"))
+    dp.message.register(cmd_admin_profile, Command("admin_profile"))
+    dp.message.register(cmd_admin_config, Command("admin_config"))
+    dp.message.register(cmd_admin_set, Command("admin_set"))
+    dp.message.register(cmd_admin_reload, Command("admin_reload"))
+    dp.message.register(cmd_broadcast, Command("broadcast"))
+    dp.message.register(cmd_broadcast_status, Command("broadcast_status"))
+    dp.message.register(cmd_broadcast_cancel, Command("broadcast_cancel"))
     dp.message.register(open_templates, F.text == "Шаблоны")
     dp.callback_query.register(on_callback)
+    dp.message.register(handle_document, F.document)
     dp.message.register(handle_message)
+    return dp
+
+
+async def main() -> None:
+    if not settings.telegram_bot_token:
+        logger.error("Env var TELEGRAM_BOT_TOKEN not found. Ensure it is set in deployment service variables.")
+        raise RuntimeError("TELEGRAM_BOT_TOKEN is required")
+    session = create_telegram_session(settings)
+    if settings.telegram_api_url:
+        logger.info("Using Bot API server %s (local mode: %s)", settings.telegram_api_url, settings.telegram_api_local)
+    live_config.on_change("TELEGRAM_TIMEOUT_SECONDS", lambda value: setattr(session, "timeout", value))
+    live_config.on_change(
+        "TELEGRAM_METHOD_TIMEOUTS",
+        lambda value: setattr(session, "method_timeouts", parse_method_timeouts(value)),
+    )
+    bot = Bot(token=settings.telegram_bot_token, session=session)
+    bot.session.middleware(telegram_metrics)
+    if recorder.enabled:
+        bot.session.middleware(RecorderRequestMiddleware(recorder))
+    dp = create_dispatcher()
 
     await dp.start_polling(bot)
 
@@ -0,0 +1,229 @@
+"""
+Рассылка администратора всем пользователям из хранилища.
+
+- получатели читаются из хранилища страницами по возрастанию id (iter_user_ids);
+- отправка ограничена общим темпом (BROADCAST_RATE_PER_SECOND) и числом параллельных
+  отправок; RetryAfter от Telegram приостанавливает всю рассылку на указанное время,
+  после чего тот же чат отправляется повторно;
+- прогресс сохраняется в checkpoint-файл: курсор последней завершенной страницы и id,
+  уже обработанные в текущей странице. После рестарта рассылка продолжается с этого места;
+- пользователи, заблокировавшие бота, удаляются из хранилища.
+"""
+import asyncio
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from .codec import dumps, loads
+from .logger import logger
+
+# Сколько раз повторять отправку одному чату после RetryAfter
+MAX_RETRIES = 5
+# Как часто сохранять прогресс внутри страницы, секунды
+CHECKPOINT_INTERVAL = 1.0
+
+
+@dataclass
+class BroadcastState:
+    text: str
+    admin_chat_id: int
+    # Последний id полностью обработанной страницы
+    cursor: Optional[int] = None
+    # id, уже обработанные в текущей (незавершенной) странице
+    page_done: List[int] = field(default_factory=list)
+    sent: int = 0
+    failed: int = 0
+    removed: int = 0
+    started_at: float = field(default_factory=time.time)
+    status_message_id: Optional[int] = None
+
+
+class _Pacer:
+    """Равномерный общий темп отправки с возможностью паузы (RetryAfter)"""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float) -> None:
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    def __init__(
+        self,
+        user_storage: Any,
+        checkpoint_file: str = "broadcast_checkpoint.json",
+        rate_per_second: float = 25.0,
+        concurrency: int = 8,
+        batch_size: int = 200,
+        progress_interval: float = 5.0,
+    ):
+        self.user_storage = user_storage
+        self.checkpoint_file = Path(checkpoint_file)
+        self.rate_per_second = rate_per_second
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.state: Optional[BroadcastState] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _save(self) -> None:
+        if self.state is None:
+            return
+        tmp = self.checkpoint_file.with_suffix(".tmp")
+        tmp.write_bytes(dumps(asdict(self.state)))
+        os.replace(tmp, self.checkpoint_file)
+
+    def _load(self) -> Optional[BroadcastState]:
+        if not self.checkpoint_file.exists():
+            return None
+        try:
+            return BroadcastState(**loads(self.checkpoint_file.read_bytes()))
+        except Exception as e:
+            logger.error("Broken broadcast checkpoint %s: %s", self.checkpoint_file, e)
+            return None
+
+    def start(self, bot: Bot, text: str, admin_chat_id: int) -> bool:
+        """Запускает новую рассылку. False, если другая рассылка еще идет."""
+        if self.running:
+            return False
+        self.state = BroadcastState(text=text, admin_chat_id=admin_chat_id)
+        self._save()
+        self._task = asyncio.create_task(self._run(bot), name="broadcast")
+        return True
+
+    def resume(self, bot: Bot) -> bool:
+        """Продолжает незавершенную рассылку после рестарта"""
+        if self.running:
+            return False
+        state = self._load()
+        if state is None:
+            return False
+        self.state = state
+        logger.info("Resuming broadcast after user %s (sent=%s)", state.cursor, state.sent)
+        self._task = asyncio.create_task(self._run(bot, resumed=True), name="broadcast")
+        return True
+
+    async def cancel(self) -> bool:
+        if not self.running:
+            return False
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.checkpoint_file.unlink(missing_ok=True)
+        return True
+
+    def progress_text(self, final: bool = False) -> str:
+        state = self.state
+        if state is None:
+            return "Рассылок не было."
+        elapsed = max(time.time() - state.started_at, 1e-6)
+        done = state.sent + state.failed + state.removed
+        header = "✅ Рассылка завершена" if final else ("📣 Рассылка идет" if self.running else "⏸ Рассылка остановлена")
+        return (
+            f"{header}\n\n"
+            f"Отправлено: {state.sent}\n"
+            f"Ошибки: {state.failed}\n"
+            f"Удалено (бот заблокирован): {state.removed}\n"
+            f"Обработано: {done}, последний id: {state.cursor}\n"
+            f"Скорость: {state.sent / elapsed:.1f} сообщ./с, прошло {int(elapsed)} с"
+        )
+
+    async def _report(self, bot: Bot, final: bool = False) -> None:
+        state = self.state
+        text = self.progress_text(final)
+        try:
+            if state.status_message_id is None:
+                message = await bot.send_message(state.admin_chat_id, text)
+                state.status_message_id = message.message_id
+            else:
+                await bot.edit_message_text(text, chat_id=state.admin_chat_id, message_id=state.status_message_id)
+        except Exception as e:
+            logger.warning("Failed to report broadcast progress: %s", e)
+
+    async def _send_one(self, bot: Bot, pacer: _Pacer, chat_id: int) -> None:
+        state = self.state
+        for attempt in range(MAX_RETRIES):
+            await pacer.wait()
+            try:
+                await bot.send_message(chat_id, state.text)
+                state.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.warning("Broadcast hit flood limit, pausing for %s s", e.retry_after)
+                pacer.pause(e.retry_after)
+            except TelegramForbiddenError:
+                await self.user_storage.delete(chat_id)
+                state.removed += 1
+                return
+            except Exception as e:
+                logger.warning("Broadcast to %s failed: %s", chat_id, e)
+                state.failed += 1
+                return
+        state.failed += 1
+
+    async def _run(self, bot: Bot, resumed: bool = False) -> None:
+        state = self.state
+        pacer = _Pacer(self.rate_per_second)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_report = 0.0
+
+        async def worker(chat_id: int) -> None:
+            async with semaphore:
+                await self._send_one(bot, pacer, chat_id)
+            state.page_done.append(chat_id)
+
+        if resumed:
+            await self._report(bot)
+        try:
+            async for page in self.user_storage.iter_user_ids(after=state.cursor, batch_size=self.batch_size):
+                already_done = set(state.page_done)
+                pending = {asyncio.create_task(worker(uid)) for uid in page if uid not in already_done}
+                try:
+                    while pending:
+                        done, pending = await asyncio.wait(pending, timeout=CHECKPOINT_INTERVAL)
+                        for task in done:
+                            task.result()
+                        self._save()
+                        if time.monotonic() - last_report >= self.progress_interval:
+                            last_report = time.monotonic()
+                            await self._report(bot)
+                finally:
+                    for task in pending:
+                        task.cancel()
+                state.cursor = page[-1]
+                state.page_done = []
+                self._save()
+        except asyncio.CancelledError:
+            # При остановке процесса прогресс сохраняется, чтобы продолжить после рестарта
+            self._save()
+            logger.info("Broadcast stopped at user %s", state.cursor)
+            raise
+        except Exception as e:
+            # Checkpoint сохранен — рассылку можно продолжить после рестарта
+            logger.exception("Broadcast stopped with error: %s", e)
+            await self._report(bot)
+            return
+
+        await self._report(bot, final=True)
+        self.checkpoint_file.unlink(missing_ok=True)
+        logger.info("Broadcast finished: sent=%s failed=%s removed=%s", state.sent, state.failed, state.removed)
@@ -0,0 +1,15 @@
+"""
+Быстрое (де)кодирование JSON на orjson для ответов backend, хранилища и экспорта спанов.
+"""
+from typing import Any, Callable, Optional, Union
+
+import orjson
+
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    return orjson.loads(data)
+
+
+def dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """Компактный JSON в UTF-8; int-ключи словарей сериализуются как строки"""
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
@@ -1,5 +1,5 @@
-from typing import Optional
-from pydantic import Field
+from typing import Literal, Optional
+from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -7,6 +7,7 @@ class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", extra="ignore")
 
     telegram_bot_token: str = Field(default="", alias="TELEGRAM_BOT_TOKEN")
+    # Один адрес backend или несколько через запятую (балансировка на стороне бота, см. app/balancer.py)
     backend_url: str = Field(default="http://localhost:3000", alias="BACKEND_URL")
     # Старые настройки AI (оставлены для обратной совместимости, но не используются)
     ai_provider: str = Field(default="openai", alias="AI_PROVIDER")
@@ -17,5 +18,125 @@ class Settings(BaseSettings):
     max_history_messages: int = Field(default=8, alias="MAX_HISTORY_MESSAGES")
     rate_limit_per_minute: int = Field(default=20, alias="RATE_LIMIT_PER_MINUTE")
     admin_user_id: Optional[int] = Field(default=None, alias="ADMIN_USER_ID")
+    # Хранилище состояния: memory (одна реплика) или redis (общее для нескольких реплик)
+    state_backend: str = Field(default="memory", alias="STATE_BACKEND")
+    redis_url: str = Field(default="redis://localhost:6379/0", alias="REDIS_URL")
+    redis_prefix: str = Field(default="tgbot:", alias="REDIS_PREFIX")
+    user_state_ttl_seconds: int = Field(default=3600, alias="USER_STATE_TTL_SECONDS")
+    # Сессии backend: кэш профилей, срок токена без exp (0 — до отказа backend) и фоновое обновление
+    # токенов, истекающих в ближайшие SESSION_REFRESH_BEFORE_SECONDS
+    session_profile_ttl_seconds: float = Field(default=300.0, alias="SESSION_PROFILE_TTL_SECONDS")
+    session_token_ttl_seconds: float = Field(default=3600.0, alias="SESSION_TOKEN_TTL_SECONDS")
+    session_refresh_before_seconds: float = Field(default=300.0, alias="SESSION_REFRESH_BEFORE_SECONDS")
+    session_refresh_interval_seconds: float = Field(default=60.0, alias="SESSION_REFRESH_INTERVAL_SECONDS")
+    # История больше порога (в символах) отправляется одним файлом
+    history_export_threshold: int = Field(default=12000, alias="HISTORY_EXPORT_THRESHOLD")
+    history_export_format: Literal["txt", "md", "html"] = Field(default="txt", alias="HISTORY_EXPORT_FORMAT")
+    # Очистка ответов и форматирование истории длиннее RENDER_OFFLOAD_CHARS символов — в пуле (thread или process)
+    # с ограниченной очередью; результаты кэшируются по хэшу содержимого
+    render_offload_chars: int = Field(default=20000, alias="RENDER_OFFLOAD_CHARS")
+    render_pool: str = Field(default="thread", alias="RENDER_POOL")
+    render_workers: int = Field(default=1, alias="RENDER_WORKERS")
+    render_queue_size: int = Field(default=16, alias="RENDER_QUEUE_SIZE")
+    render_cache_size: int = Field(default=128, alias="RENDER_CACHE_SIZE")
+    # Локальное зеркало истории разговоров (delta-синхронизация с backend)
+    history_mirror_dir: str = Field(default="history_mirror", alias="HISTORY_MIRROR_DIR")
+    history_mirror_max_messages: int = Field(default=1000, alias="HISTORY_MIRROR_MAX_MESSAGES")
+    history_mirror_max_conversations: int = Field(default=2000, alias="HISTORY_MIRROR_MAX_CONVERSATIONS")
+    history_mirror_fresh_seconds: float = Field(default=30.0, alias="HISTORY_MIRROR_FRESH_SECONDS")
+    # Упреждающая загрузка историй первых разговоров после /conversations
+    history_prefetch: bool = Field(default=False, alias="HISTORY_PREFETCH")
+    history_prefetch_top_n: int = Field(default=3, alias="HISTORY_PREFETCH_TOP_N")
+    history_prefetch_concurrency: int = Field(default=2, alias="HISTORY_PREFETCH_CONCURRENCY")
+    history_prefetch_ttl_seconds: float = Field(default=60.0, alias="HISTORY_PREFETCH_TTL_SECONDS")
+    history_prefetch_max_bytes: int = Field(default=8 * 1024 * 1024, alias="HISTORY_PREFETCH_MAX_BYTES")
+    # Outbox: журнал сгенерированных ответов, повторы доставки с экспоненциальной задержкой
+    # и отказ от ответа, не доставленного за OUTBOX_MAX_AGE_SECONDS
+    outbox_file: str = Field(default="outbox.jsonl", alias="OUTBOX_FILE")
+    outbox_retry_base_seconds: float = Field(default=1.0, alias="OUTBOX_RETRY_BASE_SECONDS")
+    outbox_retry_max_seconds: float = Field(default=300.0, alias="OUTBOX_RETRY_MAX_SECONDS")
+    outbox_max_age_seconds: float = Field(default=86400.0, alias="OUTBOX_MAX_AGE_SECONDS")
+    # Рассылка администратора
+    broadcast_rate_per_second: float = Field(default=25.0, alias="BROADCAST_RATE_PER_SECOND")
+    broadcast_concurrency: int = Field(default=8, alias="BROADCAST_CONCURRENCY")
+    broadcast_checkpoint_file: str = Field(default="broadcast_checkpoint.json", alias="BROADCAST_CHECKPOINT_FILE")
+    # Взвешенная квота: стоимость запроса по длине текста и времени генерации (или токенам)
+    weighted_quota: bool = Field(default=False, alias="WEIGHTED_QUOTA")
+    quota_user_units_per_minute: float = Field(default=120.0, alias="QUOTA_USER_UNITS_PER_MINUTE")
+    quota_global_units_per_minute: float = Field(default=3000.0, alias="QUOTA_GLOBAL_UNITS_PER_MINUTE")
+    quota_chars_per_unit: int = Field(default=500, alias="QUOTA_CHARS_PER_UNIT")
+    quota_document_units: float = Field(default=10.0, alias="QUOTA_DOCUMENT_UNITS")
+    quota_units_per_second: float = Field(default=1.0, alias="QUOTA_UNITS_PER_SECOND")
+    quota_tokens_per_unit: int = Field(default=250, alias="QUOTA_TOKENS_PER_UNIT")
+    quota_max_wait_seconds: float = Field(default=120.0, alias="QUOTA_MAX_WAIT_SECONDS")
+    quota_low_priority_concurrency: int = Field(default=2, alias="QUOTA_LOW_PRIORITY_CONCURRENCY")
+    # Защита от повторной обработки обновлений (update_id / message_id)
+    dedup_ttl_seconds: int = Field(default=86400, alias="DEDUP_TTL_SECONDS")
+    dedup_max_keys: int = Field(default=50000, alias="DEDUP_MAX_KEYS")
+    dedup_journal_file: str = Field(default="dedup_journal.txt", alias="DEDUP_JOURNAL_FILE")
+    # Загрузка документов: лимит размера, размер фрагмента (символов), параллельность и бюджет времени
+    document_max_bytes: int = Field(default=20 * 1024 * 1024, alias="DOCUMENT_MAX_BYTES")
+    document_chunk_chars: int = Field(default=8000, alias="DOCUMENT_CHUNK_CHARS")
+    document_upload_concurrency: int = Field(default=4, alias="DOCUMENT_UPLOAD_CONCURRENCY")
+    document_budget_seconds: float = Field(default=600.0, alias="DOCUMENT_BUDGET_SECONDS")
+    # Новое сообщение отменяет еще не полученный ответ на предыдущее
+    cancel_on_followup: bool = Field(default=False, alias="CANCEL_ON_FOLLOWUP")
+    # Таймауты запросов к backend: короткие вызовы и генерация ответа (завершение документа — вдвое дольше);
+    # максимум одновременных запросов к backend (0 — без ограничения)
+    backend_timeout_seconds: float = Field(default=30.0, alias="BACKEND_TIMEOUT_SECONDS")
+    backend_generation_timeout_seconds: float = Field(default=60.0, alias="BACKEND_GENERATION_TIMEOUT_SECONDS")
+    backend_max_connections: int = Field(default=0, alias="BACKEND_MAX_CONNECTIONS")
+    # Несколько экземпляров backend: привязка разговора к экземпляру и исключение экземпляра
+    # после ошибок подряд (не больше доли экземпляров одновременно)
+    backend_sticky: bool = Field(default=True, alias="BACKEND_STICKY")
+    backend_eject_after_failures: int = Field(default=5, alias="BACKEND_EJECT_AFTER_FAILURES")
+    backend_eject_seconds: float = Field(default=30.0, alias="BACKEND_EJECT_SECONDS")
+    backend_max_ejected_fraction: float = Field(default=0.5, alias="BACKEND_MAX_EJECTED_FRACTION")
+    # Пакетирование поиска/создания Telegram пользователей: окно сбора, размер пакета
+    # и параллельность поштучных запросов, если у backend нет пакетного маршрута
+    backend_batching: bool = Field(default=False, alias="BACKEND_BATCHING")
+    backend_batch_window_seconds: float = Field(default=0.005, alias="BACKEND_BATCH_WINDOW_SECONDS")
+    backend_batch_max_size: int = Field(default=100, alias="BACKEND_BATCH_MAX_SIZE")
+    backend_batch_fallback_concurrency: int = Field(default=8, alias="BACKEND_BATCH_FALLBACK_CONCURRENCY")
+    # Настройки, изменяемые без перезапуска: файл KEY=VALUE (пусто — выключено) и период его проверки
+    live_config_file: str = Field(default="", alias="LIVE_CONFIG_FILE")
+    live_config_poll_seconds: float = Field(default=5.0, alias="LIVE_CONFIG_POLL_SECONDS")
+    # Бюджет времени на обработку обновления (0 — без дедлайна) и хеджирование GET к backend
+    update_budget_seconds: float = Field(default=90.0, alias="UPDATE_BUDGET_SECONDS")
+    backend_hedging: bool = Field(default=False, alias="BACKEND_HEDGING")
+    backend_hedge_ratio: float = Field(default=0.05, alias="BACKEND_HEDGE_RATIO")
+    # Запись трафика для app/replay.py (пусто — выключено)
+    record_file: str = Field(default="", alias="RECORD_FILE")
+    record_salt: str = Field(default="", alias="RECORD_SALT")
+    record_redact_text: bool = Field(default=True, alias="RECORD_REDACT_TEXT")
+    # Транспорт Bot API: собственный сервер (пусто — api.telegram.org), пул, keep-alive и таймауты
+    telegram_api_url: str = Field(default="", alias="TELEGRAM_API_URL")
+    telegram_api_local: bool = Field(default=False, alias="TELEGRAM_API_LOCAL")
+    telegram_api_server_files_dir: str = Field(default="", alias="TELEGRAM_API_SERVER_FILES_DIR")
+    telegram_api_local_files_dir: str = Field(default="", alias="TELEGRAM_API_LOCAL_FILES_DIR")
+    telegram_pool_size: int = Field(default=100, alias="TELEGRAM_POOL_SIZE")
+    telegram_keepalive_seconds: float = Field(default=30.0, alias="TELEGRAM_KEEPALIVE_SECONDS")
+    telegram_timeout_seconds: float = Field(default=60.0, alias="TELEGRAM_TIMEOUT_SECONDS")
+    telegram_method_timeouts: str = Field(default="", alias="TELEGRAM_METHOD_TIMEOUTS")
+    # HTTP-эндпоинты /healthz, /readyz, /status (порт 0 — выключено)
+    health_host: str = Field(default="0.0.0.0", alias="HEALTH_HOST")
+    health_port: int = Field(default=0, alias="HEALTH_PORT")
+    health_probe_interval_seconds: float = Field(default=10.0, alias="HEALTH_PROBE_INTERVAL_SECONDS")
+    health_probe_timeout_seconds: float = Field(default=3.0, alias="HEALTH_PROBE_TIMEOUT_SECONDS")
+    health_max_loop_stall_seconds: float = Field(default=5.0, alias="HEALTH_MAX_LOOP_STALL_SECONDS")
+    health_backend_path: str = Field(default="/", alias="HEALTH_BACKEND_PATH")
+    # Трассировка: доля сэмплируемых обновлений (0 — выключено) и файл для спанов
+    trace_sample_rate: float = Field(default=0.0, alias="TRACE_SAMPLE_RATE")
+    trace_file: str = Field(default="traces.jsonl", alias="TRACE_FILE")
+    # Полосы приоритета: быстрая (локальные ответы) и медленная (backend/LLM)
+    fast_lane_concurrency: int = Field(default=32, alias="FAST_LANE_CONCURRENCY")
+    slow_lane_concurrency: int = Field(default=16, alias="SLOW_LANE_CONCURRENCY")
+    slow_lane_queue: int = Field(default=200, alias="SLOW_LANE_QUEUE")
+
+    @field_validator("history_export_format", mode="before")
+    @classmethod
+    def _normalize_export_format(cls, value: object) -> object:
+        # MD, " html " и т.п. — то же, что принимает /export
+        return value.strip().lower() if isinstance(value, str) else value
 
 settings = Settings()
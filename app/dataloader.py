@@ -0,0 +1,117 @@
+"""
+Пакетная загрузка по ключам (dataloader) для поштучных запросов к backend.
+
+В пике сотни разных пользователей запрашивают свои записи в пределах нескольких
+миллисекунд, и каждый запрос — отдельный HTTP-вызов. DataLoader собирает ключи,
+запрошенные за окно window_seconds (но не больше max_batch), и загружает их одним
+вызовом batch_load; результат раздается всем ожидающим корутинам. Одинаковые ключи
+в одном окне загружаются один раз.
+
+Пакет выполняется в пустом контексте — без дедлайна и трассировки обновления, которое
+открыло окно: его результат нужен и другим обновлениям. Каждый вызывающий ждет не
+дольше своего таймаута; отмена одного ожидающего не отменяет загрузку для остальных.
+"""
+import asyncio
+import contextvars
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, Set, Tuple, TypeVar
+
+from .deadline import DeadlineExceeded, clamp_timeout, remaining
+from .logger import logger
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+# Загрузка пакета: {ключ: данные запроса} -> {ключ: результат}; отсутствующий ключ — None
+BatchLoader = Callable[[Dict[K, Any]], Awaitable[Dict[K, Optional[V]]]]
+
+
+class DataLoader(Generic[K, V]):
+    def __init__(
+        self,
+        name: str,
+        batch_load: BatchLoader,
+        window_seconds: float = 0.005,
+        max_batch: int = 100,
+    ):
+        self.name = name
+        self._batch_load = batch_load
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        # Текущее окно: ключ -> (данные запроса, future результата)
+        self._pending: Dict[K, Tuple[Any, asyncio.Future]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.keys = 0
+        self.merged = 0
+
+    async def load(self, key: K, item: Any = None, timeout: Optional[float] = None) -> Optional[V]:
+        """
+        Результат для ключа из ближайшего пакета. item — данные запроса (для одинаковых
+        ключей в окне используется первый). Ожидание ограничено timeout и дедлайном обновления.
+        """
+        entry = self._pending.get(key)
+        if entry is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = (item, future)
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._timer is None:
+                # Пустой контекст: пакет не наследует дедлайн и спан обновления, открывшего окно
+                self._timer = asyncio.get_running_loop().call_later(
+                    self.window_seconds, self._dispatch, context=contextvars.Context()
+                )
+        else:
+            future = entry[1]
+            self.merged += 1
+
+        if timeout is None:
+            return await asyncio.shield(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), clamp_timeout(timeout))
+        except asyncio.TimeoutError:
+            left = remaining()
+            if left is not None and left <= 0:
+                raise DeadlineExceeded() from None
+            raise
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        task = asyncio.create_task(
+            self._run(batch), name=f"dataloader-{self.name}", context=contextvars.Context()
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: Dict[K, Tuple[Any, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.keys += len(batch)
+        try:
+            results = await self._batch_load({key: item for key, (item, _) in batch.items()})
+        except Exception as e:
+            logger.warning("Batch load %s of %s keys failed: %s", self.name, len(batch), e)
+            for _, future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # Исключение могли не забрать (все ожидающие ушли по таймауту)
+                    future.exception()
+            return
+        for key, (_, future) in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "keys": self.keys,
+            "merged": self.merged,
+            "avg_batch": round(self.keys / self.batches, 1) if self.batches else 0.0,
+        }
@@ -0,0 +1,72 @@
+"""
+Дедлайн обработки обновления Telegram.
+
+Outer-middleware выставляет дедлайн (UPDATE_BUDGET_SECONDS от получения обновления)
+в contextvar; вызовы backend ограничивают свои таймауты оставшимся временем и не начинаются,
+если бюджет уже исчерпан. Вне обработки обновления (фоновые задачи) дедлайна нет.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from .config import settings
+
+# monotonic-время, к которому ответ пользователю уже не нужен
+_deadline: ContextVar[Optional[float]] = ContextVar("update_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Бюджет времени на обработку обновления исчерпан"""
+
+
+def remaining() -> Optional[float]:
+    """Сколько секунд осталось до дедлайна; None — дедлайна нет"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def clamp_timeout(timeout: float) -> float:
+    """Таймаут вызова, не выходящий за дедлайн. DeadlineExceeded, если времени не осталось."""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(timeout, left)
+
+
+@contextmanager
+def budget(seconds: float) -> Iterator[None]:
+    """Заменяет дедлайн внутри блока (например, для долгой загрузки документа); 0 — без дедлайна"""
+    token = _deadline.set(time.monotonic() + seconds if seconds > 0 else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class DeadlineMiddleware(BaseMiddleware):
+    """Outer-middleware для dp.update: дедлайн на все вызовы backend при обработке обновления"""
+
+    def __init__(self, budget_seconds: float):
+        self.budget_seconds = budget_seconds
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if self.budget_seconds <= 0:
+            return await handler(event, data)
+        token = _deadline.set(time.monotonic() + self.budget_seconds)
+        try:
+            return await handler(event, data)
+        finally:
+            _deadline.reset(token)
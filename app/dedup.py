@@ -0,0 +1,146 @@
+"""
+Защита от повторной обработки одного и того же обновления Telegram.
+
+После рестарта посреди обработки (или при повторной доставке webhook) Telegram присылает
+тот же update_id еще раз, и без проверки бот повторно запускает генерацию в backend и
+отвечает дважды. Outer-middleware до диспетчеризации «занимает» ключи обновления
+(update_id и chat_id:message_id); если хотя бы один уже встречался, обновление пропускается.
+
+Хранилище ограничено по размеру (DEDUP_MAX_KEYS) и по времени (DEDUP_TTL_SECONDS).
+В памяти ключи лежат в OrderedDict в порядке добавления — проверка O(1), истекшие
+удаляются с головы. Для переживания рестарта каждый ключ дописывается в журнал,
+который периодически сжимается. Запись в журнал идет в пуле потоков; ключи обновлений,
+пришедших, пока идет предыдущая запись, дописываются следующей одной пачкой. В Redis используется SET NX EX (см. app/redis_state.py).
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from .logger import logger
+
+
+def update_keys(update: Update) -> List[str]:
+    """Ключи, по которым обновление считается повтором"""
+    keys = [f"u:{update.update_id}"]
+    message = update.message or update.edited_message
+    if message is not None:
+        keys.append(f"m:{message.chat.id}:{message.message_id}")
+    return keys
+
+
+class DedupStore:
+    """Недавно обработанные ключи в памяти процесса с журналом на диске"""
+
+    def __init__(self, journal_file: str = "dedup_journal.txt", ttl_seconds: int = 86400, max_keys: int = 50000):
+        self.journal_file = Path(journal_file)
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        # ключ -> unix-время истечения; порядок добавления совпадает с порядком истечения
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+        self._journal_lines = 0
+        # Строки журнала, еще не записанные на диск
+        self._unwritten: List[str] = []
+        self._write_lock = asyncio.Lock()
+        self.duplicates = 0
+        self._load()
+
+    def _load(self) -> None:
+        if not self.journal_file.exists():
+            return
+        now = time.time()
+        try:
+            with open(self.journal_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    key, _, expires = line.rstrip("\n").rpartition("\t")
+                    if key and float(expires) > now:
+                        self._seen[key] = float(expires)
+                        self._seen.move_to_end(key)
+        except Exception as e:
+            logger.error("Error loading dedup journal %s: %s", self.journal_file, e)
+        while len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+        self._compact()
+
+    def _compact(self, items: Optional[List[Tuple[str, float]]] = None) -> None:
+        """Переписывает журнал только живыми ключами (items — снимок, сделанный в event loop)"""
+        if items is None:
+            items = list(self._seen.items())
+        tmp = self.journal_file.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, expires in items:
+                f.write(f"{key}\t{expires:.0f}\n")
+        os.replace(tmp, self.journal_file)
+        self._journal_lines = len(items)
+
+    def _write(self, lines: List[str]) -> None:
+        with open(self.journal_file, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+
+    def _expire(self, now: float) -> None:
+        while self._seen:
+            key, expires = next(iter(self._seen.items()))
+            if expires > now:
+                break
+            self._seen.popitem(last=False)
+
+    async def claim(self, keys: List[str]) -> bool:
+        """Отмечает ключи обработанными. False, если хотя бы один уже встречался."""
+        now = time.time()
+        self._expire(now)
+        if any(key in self._seen for key in keys):
+            self.duplicates += 1
+            return False
+
+        expires = now + self.ttl_seconds
+        for key in keys:
+            self._seen[key] = expires
+        while len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+
+        self._unwritten.extend(f"{key}\t{expires:.0f}\n" for key in keys)
+        await self._flush()
+        return True
+
+    async def _flush(self) -> None:
+        async with self._write_lock:
+            if not self._unwritten:
+                # Ключи уже записаны пачкой вместе с предыдущей записью
+                return
+            lines, self._unwritten = self._unwritten, []
+            try:
+                await asyncio.to_thread(self._write, lines)
+                self._journal_lines += len(lines)
+                if self._journal_lines > 2 * self.max_keys:
+                    await asyncio.to_thread(self._compact, list(self._seen.items()))
+            except Exception as e:
+                logger.error("Error writing dedup journal: %s", e)
+
+
+class DedupMiddleware(BaseMiddleware):
+    """Outer-middleware для dp.update: пропускает уже обработанные обновления"""
+
+    def __init__(self, store: Any):
+        self.store = store
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        try:
+            fresh = await self.store.claim(update_keys(event))
+        except Exception as e:
+            # Недоступное хранилище не должно останавливать бота
+            logger.warning("Dedup check failed for update %s: %s", event.update_id, e)
+            fresh = True
+        if not fresh:
+            logger.info("Skipping duplicate update %s", event.update_id)
+            return None
+        return await handler(event, data)
@@ -0,0 +1,177 @@
+"""
+Диагностика живого процесса для администратора: задачи asyncio, задержка event loop,
+снимки памяти (tracemalloc) и короткий сэмплирующий CPU-профиль.
+"""
+import asyncio
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from .logger import logger
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class LoopLagMonitor:
+    """Измеряет, насколько позже запланированного просыпается event loop"""
+
+    def __init__(self, interval: float = 0.5, max_samples: int = 1200):
+        self.interval = interval
+        self._samples: Deque[float] = deque(maxlen=max_samples)
+        self._task: Optional[asyncio.Task] = None
+        self.last_tick = time.monotonic()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="loop-lag-monitor")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_tick = time.monotonic()
+            self._samples.append(max(0.0, self.last_tick - started - self.interval))
+
+    def stall(self) -> float:
+        """
+        Текущая задержка в секундах: последний замер или, если монитор давно не просыпался,
+        время сверх интервала с последнего пробуждения.
+        """
+        overdue = time.monotonic() - self.last_tick - self.interval
+        return max(overdue, self._samples[-1] if self._samples else 0.0, 0.0)
+
+    def percentiles(self) -> Dict[str, float]:
+        """Задержка в миллисекундах: p50/p90/p99/max"""
+        samples = [s * 1000 for s in self._samples]
+        return {
+            "p50": percentile(samples, 50),
+            "p90": percentile(samples, 90),
+            "p99": percentile(samples, 99),
+            "max": max(samples, default=0.0),
+        }
+
+
+class HandlerTracker(BaseMiddleware):
+    """Inner-middleware: считает обработчики, которые выполняются прямо сейчас"""
+
+    def __init__(self):
+        self.in_flight: Counter = Counter()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        self.in_flight[name] += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight[name] -= 1
+            if not self.in_flight[name]:
+                del self.in_flight[name]
+
+
+def task_counts() -> Counter:
+    """Количество живых задач asyncio по имени корутины"""
+    counts: Counter = Counter()
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        counts[getattr(coro, "__qualname__", type(coro).__name__)] += 1
+    return counts
+
+
+def tracemalloc_start(frames: int = 10) -> bool:
+    """Включает tracemalloc. Возвращает False, если он уже включен."""
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def tracemalloc_stop() -> bool:
+    if not tracemalloc.is_tracing():
+        return False
+    tracemalloc.stop()
+    return True
+
+
+def _short_path(filename: str) -> str:
+    """Путь относительно ближайшего каталога из sys.path (app/bot.py, aiogram/client/bot.py)"""
+    best = filename
+    for root in sys.path:
+        if root and filename.startswith(root.rstrip("/") + "/"):
+            candidate = filename[len(root.rstrip("/")) + 1:]
+            if len(candidate) < len(best):
+                best = candidate
+    return best
+
+
+def tracemalloc_top(limit: int = 10) -> str:
+    """Топ-N мест аллокаций по текущему снимку"""
+    if not tracemalloc.is_tracing():
+        return "tracemalloc выключен. Используйте /admin_mem start"
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    stats = snapshot.statistics("lineno")
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced: {current / 1024:.1f} KiB (peak {peak / 1024:.1f} KiB)"]
+    for index, stat in enumerate(stats[:limit], 1):
+        frame = stat.traceback[0]
+        lines.append(
+            f"{index}. {_short_path(frame.filename)}:{frame.lineno} — {stat.size / 1024:.1f} KiB in {stat.count} blocks"
+        )
+    return "\n".join(lines)
+
+
+def _sample_stacks(thread_id: int, seconds: float, interval: float) -> Counter:
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        parts: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+            frame = frame.f_back
+        if parts:
+            stacks[";".join(reversed(parts))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+async def cpu_profile(seconds: float = 5.0, interval: float = 0.005) -> bytes:
+    """
+    Сэмплирует стек потока event loop из отдельного потока и возвращает профиль
+    в формате collapsed stacks (подходит для flamegraph.pl / speedscope).
+    """
+    thread_id = threading.get_ident()
+    stacks = await asyncio.to_thread(_sample_stacks, thread_id, seconds, interval)
+    logger.info("CPU profile collected: %s samples", sum(stacks.values()))
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()).encode("utf-8")
@@ -0,0 +1,199 @@
+"""
+Потоковая загрузка документов пользователя в backend.
+
+Файл из Telegram читается потоком кусками по 64 КБ с ограничением размера,
+текст декодируется инкрементально и режется на фрагменты под контекст модели
+(DOCUMENT_CHUNK_CHARS, по границам строк). Фрагменты загружаются в backend
+ограниченным числом параллельных запросов через очередь фиксированного размера:
+если backend не успевает, чтение файла приостанавливается. В памяти одновременно
+находятся лишь несколько фрагментов, независимо от размера файла.
+
+Поддерживаются текстовые форматы (txt, csv, md, json, xml, html и т.п.): счета
+и прайс-листы обычно выгружаются в CSV или текст.
+"""
+import asyncio
+import codecs
+import os
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from aiogram import Bot
+from aiogram.types import Document
+
+from .logger import logger
+
+TEXT_EXTENSIONS = (".txt", ".csv", ".tsv", ".md", ".json", ".xml", ".html", ".htm", ".log", ".yaml", ".yml")
+TEXT_MIME_TYPES = ("application/json", "application/xml", "application/csv", "application/x-yaml")
+
+_READ_CHUNK = 64 * 1024
+
+
+class DocumentError(Exception):
+    """Документ нельзя обработать; текст исключения показывается пользователю"""
+
+
+def is_text_document(document: Document) -> bool:
+    mime = (document.mime_type or "").lower()
+    if mime.startswith("text/") or mime in TEXT_MIME_TYPES:
+        return True
+    name = (document.file_name or "").lower()
+    return name.endswith(TEXT_EXTENSIONS)
+
+
+@dataclass
+class IngestProgress:
+    total_bytes: Optional[int] = None
+    bytes_read: int = 0
+    chunks_read: int = 0
+    chunks_uploaded: int = 0
+
+    def text(self) -> str:
+        size = f"{self.bytes_read // 1024} КБ"
+        if self.total_bytes:
+            size += f" из {self.total_bytes // 1024} КБ"
+        return f"📄 Обрабатываю документ: прочитано {size}, отправлено фрагментов {self.chunks_uploaded}/{self.chunks_read}"
+
+
+async def stream_telegram_file(
+    bot: Bot,
+    file_path: str,
+    max_bytes: int,
+    progress: IngestProgress,
+    timeout: int = 300,
+) -> AsyncIterator[bytes]:
+    """Читает файл с серверов Telegram потоком, не больше max_bytes"""
+    api = bot.session.api
+    if api.is_local:
+        # Локальный Bot API сервер отдает путь к файлу на диске
+        chunks = _read_local_file(api.wrap_local_file.to_local(file_path))
+    else:
+        chunks = bot.session.stream_content(api.file_url(bot.token, file_path), timeout=timeout, chunk_size=_READ_CHUNK)
+    async for chunk in chunks:
+        progress.bytes_read += len(chunk)
+        if progress.bytes_read > max_bytes:
+            raise DocumentError(f"Файл больше {max_bytes // (1024 * 1024)} МБ.")
+        yield chunk
+
+
+async def _read_local_file(path: str) -> AsyncIterator[bytes]:
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, _READ_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        f.close()
+
+
+async def decode_text(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    Инкрементально декодирует байты в текст. Кодировка определяется по первому куску:
+    UTF-8 (с BOM или без), иначе cp1251 — типичная для выгрузок из 1С и Excel.
+    """
+    decoder: Optional[codecs.IncrementalDecoder] = None
+    async for chunk in chunks:
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder("utf-8-sig")("strict")
+            try:
+                text = decoder.decode(chunk)
+            except UnicodeDecodeError:
+                decoder = codecs.getincrementaldecoder("cp1251")("replace")
+                text = decoder.decode(chunk)
+            if "\x00" in text:
+                raise DocumentError("Файл не похож на текстовый.")
+            decoder.errors = "replace"
+        else:
+            text = decoder.decode(chunk)
+        if text:
+            yield text
+    if decoder is not None:
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+
+async def split_text(pieces: AsyncIterator[str], max_chars: int, progress: IngestProgress) -> AsyncIterator[str]:
+    """Режет поток текста на фрагменты не длиннее max_chars, по возможности по переводу строки"""
+    buffer = ""
+    async for piece in pieces:
+        buffer += piece
+        while len(buffer) >= max_chars:
+            cut = buffer.rfind("\n", 0, max_chars)
+            if cut < max_chars // 2:
+                cut = max_chars
+            chunk, buffer = buffer[:cut], buffer[cut:].lstrip("\n")
+            if chunk.strip():
+                progress.chunks_read += 1
+                yield chunk
+    if buffer.strip():
+        progress.chunks_read += 1
+        yield buffer
+
+
+async def upload_chunks(
+    chunks: AsyncIterator[str],
+    upload: Callable[[int, str], Awaitable[None]],
+    concurrency: int,
+    progress: IngestProgress,
+) -> int:
+    """
+    Загружает фрагменты параллельно, не больше concurrency запросов одновременно.
+    Очередь ограничена, поэтому чтение источника ждет, пока загрузка не освободит место.
+    Возвращает число фрагментов; первая ошибка загрузки прерывает процесс.
+    """
+    queue: "asyncio.Queue[Optional[tuple]]" = asyncio.Queue(maxsize=concurrency)
+    errors: List[BaseException] = []
+
+    async def worker() -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if errors:
+                # После ошибки очередь только опустошается, чтобы не блокировать источник
+                continue
+            try:
+                await upload(*item)
+                progress.chunks_uploaded += 1
+            except Exception as e:
+                errors.append(e)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    count = 0
+    try:
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                if errors:
+                    break
+                await queue.put((count, chunk))
+                count += 1
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+    if errors:
+        raise errors[0]
+    return count
+
+
+def document_name(document: Document) -> str:
+    return os.path.basename(document.file_name or "document.txt")
+
+
+async def report_progress(edit: Callable[[str], Awaitable[None]], progress: IngestProgress, interval: float = 2.0) -> None:
+    """Периодически обновляет сообщение о прогрессе (запускается отдельной задачей)"""
+    last = ""
+    while True:
+        await asyncio.sleep(interval)
+        text = progress.text()
+        if text != last:
+            last = text
+            try:
+                await edit(text)
+            except Exception as e:
+                logger.warning("Failed to update document progress: %s", e)
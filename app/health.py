@@ -0,0 +1,164 @@
+"""
+HTTP-эндпоинты здоровья для оркестратора и балансировщика (HEALTH_PORT, 0 — выключено).
+
+    GET /healthz — liveness: процесс жив и event loop отзывчив (задержка loop не больше
+                   HEALTH_MAX_LOOP_STALL_SECONDS). 503 — процесс пора перезапускать.
+    GET /readyz  — readiness: backend и Telegram (getMe) отвечают, медленная полоса
+                   не переполнена. 503 — трафик на эту реплику лучше не направлять.
+    GET /status  — то же с подробностями (всегда 200): задержки проверок, глубина очередей,
+                   задержки Bot API по методам.
+
+Проверки зависимостей кэшируются: каждая выполняется не чаще раза в
+HEALTH_PROBE_INTERVAL_SECONDS, одновременные запросы ждут одну и ту же проверку,
+поэтому частые опросы не создают нагрузку на backend и Bot API.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from aiohttp import web
+
+from .codec import dumps
+from .diagnostics import LoopLagMonitor, percentile
+from .logger import logger
+
+
+class Probe:
+    """Кэшируемая проверка зависимости с историей задержек"""
+
+    def __init__(
+        self,
+        name: str,
+        check: Callable[[], Awaitable[Any]],
+        interval: float = 10.0,
+        timeout: float = 3.0,
+        history: int = 30,
+    ):
+        self.name = name
+        self.check = check
+        self.interval = interval
+        self.timeout = timeout
+        self.ok: Optional[bool] = None
+        self.error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+        self._latencies: Deque[float] = deque(maxlen=history)
+        self._running: Optional[asyncio.Task] = None
+
+    def _fresh(self) -> bool:
+        return self.checked_at is not None and time.monotonic() - self.checked_at < self.interval
+
+    async def result(self) -> bool:
+        """Результат последней проверки; проверяет заново, если он устарел"""
+        if self._fresh():
+            return bool(self.ok)
+        if self._running is None:
+            self._running = asyncio.create_task(self._run(), name=f"health-probe-{self.name}")
+        # shield: отключившийся клиент не должен отменять общую проверку
+        await asyncio.shield(self._running)
+        return bool(self.ok)
+
+    async def _run(self) -> None:
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self.check(), self.timeout)
+            self.ok, self.error = True, None
+        except asyncio.TimeoutError:
+            self.ok, self.error = False, f"timeout after {self.timeout:g} s"
+        except Exception as e:
+            self.ok, self.error = False, f"{type(e).__name__}: {e}"
+        finally:
+            self._latencies.append(time.monotonic() - started)
+            self.checked_at = time.monotonic()
+            self._running = None
+        if not self.ok:
+            logger.warning("Health probe %s failed: %s", self.name, self.error)
+
+    def summary(self) -> Dict[str, Any]:
+        ms = [x * 1000 for x in self._latencies]
+        return {
+            "ok": self.ok,
+            "error": self.error,
+            "age_s": round(time.monotonic() - self.checked_at, 1) if self.checked_at is not None else None,
+            "latency_ms": round(ms[-1], 1) if ms else None,
+            "p50_ms": round(percentile(ms, 50), 1),
+            "p95_ms": round(percentile(ms, 95), 1),
+            "max_ms": round(max(ms, default=0.0), 1),
+        }
+
+
+class HealthServer:
+    def __init__(
+        self,
+        loop_lag: LoopLagMonitor,
+        depth: Callable[[], Dict[str, Any]],
+        saturated: Callable[[], Optional[str]],
+        max_loop_stall: float = 5.0,
+        details: Optional[Dict[str, Callable[[], Any]]] = None,
+    ):
+        self.loop_lag = loop_lag
+        # Глубина очередей и число операций в полете
+        self.depth = depth
+        # Причина, по которой реплика не принимает новую работу (None — принимает)
+        self.saturated = saturated
+        self.max_loop_stall = max_loop_stall
+        # Дополнительные разделы /status (например, задержки Bot API по методам)
+        self.details = details or {}
+        self.probes: List[Probe] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    def add_probe(self, probe: Probe) -> None:
+        self.probes.append(probe)
+
+    def _liveness(self) -> Dict[str, Any]:
+        stall = self.loop_lag.stall()
+        return {"ok": stall <= self.max_loop_stall, "loop_stall_ms": round(stall * 1000, 1)}
+
+    async def _readiness(self) -> Dict[str, Any]:
+        results = await asyncio.gather(*(probe.result() for probe in self.probes))
+        saturated = self.saturated()
+        return {
+            "ok": all(results) and saturated is None and self._liveness()["ok"],
+            "saturated": saturated,
+            "probes": {probe.name: probe.summary() for probe in self.probes},
+        }
+
+    @staticmethod
+    def _json(payload: Dict[str, Any], ok: bool = True) -> web.Response:
+        return web.Response(body=dumps(payload), status=200 if ok else 503, content_type="application/json")
+
+    async def handle_healthz(self, request: web.Request) -> web.Response:
+        live = self._liveness()
+        return self._json(live, live["ok"])
+
+    async def handle_readyz(self, request: web.Request) -> web.Response:
+        ready = await self._readiness()
+        ready["depth"] = self.depth()
+        return self._json(ready, ready["ok"])
+
+    async def handle_status(self, request: web.Request) -> web.Response:
+        lag = self.loop_lag.percentiles()
+        status = {
+            "live": self._liveness(),
+            "ready": await self._readiness(),
+            "depth": self.depth(),
+            "loop_lag_ms": {key: round(value, 1) for key, value in lag.items()},
+        }
+        for name, section in self.details.items():
+            status[name] = section()
+        return self._json(status)
+
+    async def start(self, host: str, port: int) -> None:
+        app = web.Application()
+        app.router.add_get("/healthz", self.handle_healthz)
+        app.router.add_get("/readyz", self.handle_readyz)
+        app.router.add_get("/status", self.handle_status)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Health endpoints listening on %s:%s", host, port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
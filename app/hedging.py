@@ -0,0 +1,94 @@
+"""
+Хеджирование идемпотентных запросов к backend.
+
+Если запрос не ответил за наблюдаемый p95 своего маршрута, отправляется дубликат
+и используется первый успешный ответ, второй отменяется. Число дубликатов ограничено
+бюджетом: каждый обычный запрос добавляет BACKEND_HEDGE_RATIO токена, дубликат тратит
+один, поэтому при деградации backend хеджирование не умножает нагрузку.
+"""
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from .diagnostics import percentile
+
+T = TypeVar("T")
+
+# Сколько последних длительностей хранить на маршрут и сколько нужно для оценки p95
+_WINDOW = 200
+_MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных запросов по маршрутам"""
+
+    def __init__(self, window: int = _WINDOW, min_samples: int = _MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def observe(self, route: str, seconds: float) -> None:
+        samples = self._samples.get(route)
+        if samples is None:
+            samples = self._samples[route] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def p95(self, route: str) -> Optional[float]:
+        """p95 длительности маршрута в секундах; None, пока данных мало"""
+        samples = self._samples.get(route)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        return percentile(list(samples), 95)
+
+
+class HedgeBudget:
+    """Токены на дубликаты: ratio за каждый запрос, не больше burst"""
+
+    def __init__(self, ratio: float = 0.05, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+        self.hedged = 0
+        self.denied = 0
+
+    def earn(self) -> None:
+        self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            self.hedged += 1
+            return True
+        self.denied += 1
+        return False
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: Optional[float], budget: HedgeBudget) -> T:
+    """
+    Выполняет call(); если он не завершился за delay секунд и бюджет позволяет,
+    запускает второй call() и возвращает первый успешный результат.
+    Ошибка поднимается, только если упали все запущенные попытки.
+    """
+    budget.earn()
+    primary = asyncio.ensure_future(call())
+    if delay is None:
+        return await primary
+
+    attempts = {primary}
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if not done and budget.try_spend():
+            attempts.add(asyncio.ensure_future(call()))
+        error: Optional[BaseException] = None
+        pending = set(attempts)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in attempts:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,88 @@
+"""
+Экспорт истории разговора в файл (TXT, Markdown или HTML).
+
+Транскрипт пишется в файл по одному сообщению, целиком строкой в памяти он не собирается.
+Большая история уходит в Telegram одним sendDocument вместо десятков сообщений по 4000 символов.
+"""
+import asyncio
+import html
+import os
+import tempfile
+from typing import IO, List, Optional
+
+from .schemas import HistoryMessage
+
+EXPORT_FORMATS = ("txt", "md", "html")
+
+# Служебные символы на каждое сообщение в текстовом представлении (имя, переводы строк)
+_PER_MESSAGE_OVERHEAD = 16
+
+
+def speaker_name(role: str) -> str:
+    """Имя отправителя для отображения"""
+    if role.lower() in ["user", "human"]:
+        return "Вы"
+    if role.lower() in ["assistant", "ai", "bot"]:
+        return "Ассистент"
+    return role.capitalize()
+
+
+def history_title(history: List[HistoryMessage]) -> Optional[str]:
+    """Title разговора (backend присылает его в сообщениях)"""
+    for msg in history:
+        if msg.title:
+            return msg.title
+    return None
+
+
+def estimate_size(history: List[HistoryMessage]) -> int:
+    """Примерный размер транскрипта в символах без его построения"""
+    return sum(len(msg.content) + _PER_MESSAGE_OVERHEAD for msg in history)
+
+
+def write_transcript(history: List[HistoryMessage], fmt: str, f: IO[str]) -> None:
+    """Пишет транскрипт в открытый текстовый файл по одному сообщению"""
+    title = history_title(history)
+    if fmt == "html":
+        heading = html.escape(title or "История разговора")
+        f.write(
+            "<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+            f"<title>{heading}</title></head><body>\n<h1>{heading}</h1>\n"
+        )
+        for msg in history:
+            f.write(f"<p><b>{html.escape(speaker_name(msg.role))}:</b><br>\n")
+            f.write(html.escape(msg.content).replace("\n", "<br>\n"))
+            f.write("</p>\n")
+        f.write("</body></html>\n")
+    elif fmt == "md":
+        f.write(f"# {title or 'История разговора'}\n\n")
+        for msg in history:
+            f.write(f"**{speaker_name(msg.role)}:**\n\n{msg.content}\n\n---\n\n")
+    else:
+        f.write("История разговора\n")
+        if title:
+            f.write(f"{title}\n")
+        f.write("\n")
+        for msg in history:
+            f.write(f"{speaker_name(msg.role)}:\n{msg.content}\n\n")
+
+
+def _export_to_file(history: List[HistoryMessage], fmt: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="history-", suffix=f".{fmt}")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", buffering=64 * 1024) as f:
+            write_transcript(history, fmt, f)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+
+async def export_history(history: List[HistoryMessage], fmt: str = "txt") -> str:
+    """
+    Записывает историю во временный файл и возвращает путь к нему.
+    Файл удаляет вызывающая сторона после отправки.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    return await asyncio.to_thread(_export_to_file, history, fmt)
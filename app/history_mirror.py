@@ -0,0 +1,241 @@
+"""
+Локальное зеркало истории разговоров с delta-синхронизацией.
+
+Каждый разговор хранится на диске JSONL-файлом. При просмотре истории у backend
+запрашиваются только сообщения новее последнего известного (after_id / since),
+а ходы, которые бот сам отправил и получил в _process_text, дописываются сразу.
+Зеркало ограничено по числу сообщений в разговоре и по числу разговоров (LRU по mtime).
+Разговор длиннее max_messages в зеркале хранится не целиком, поэтому его история
+всегда загружается с backend полностью — /history и /export не обрезаются.
+"""
+import asyncio
+import hashlib
+import os
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .codec import dumps, loads
+from .logger import logger
+from .schemas import HistoryMessage
+
+HistoryFetcher = Callable[..., Awaitable[Optional[List[HistoryMessage]]]]
+
+
+class _Entry:
+    """Сообщение в зеркале; local=True — ход, записанный ботом и еще не подтвержденный backend"""
+
+    __slots__ = ("message", "local")
+
+    def __init__(self, message: HistoryMessage, local: bool = False):
+        self.message = message
+        self.local = local
+
+    def to_json(self) -> bytes:
+        data = asdict(self.message)
+        if self.local:
+            data["local"] = True
+        return dumps(data)
+
+    @classmethod
+    def from_json(cls, line: bytes) -> "_Entry":
+        data = loads(line)
+        local = bool(data.pop("local", False))
+        return cls(HistoryMessage(**data), local)
+
+
+def _is_newer(message: HistoryMessage, cursor_ts: Any) -> bool:
+    if message.created_at is None or cursor_ts is None:
+        return False
+    try:
+        return message.created_at > cursor_ts
+    except TypeError:
+        return str(message.created_at) > str(cursor_ts)
+
+
+class HistoryMirror:
+    def __init__(
+        self,
+        fetch: HistoryFetcher,
+        directory: str = "history_mirror",
+        max_messages: int = 1000,
+        max_conversations: int = 2000,
+        fresh_seconds: float = 30.0,
+    ):
+        self._fetch = fetch
+        self.directory = Path(directory)
+        self.max_messages = max_messages
+        self.max_conversations = max_conversations
+        self.fresh_seconds = fresh_seconds
+        # имя файла разговора -> время последнего обращения (порядок LRU)
+        self._lru: "OrderedDict[str, float]" = OrderedDict()
+        # имя файла -> monotonic-время последней синхронизации с backend
+        self._synced_at: Dict[str, float] = {}
+        # имя файла -> блокировка разговора
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.delta_syncs = 0
+        self.full_syncs = 0
+        self._scan()
+
+    def _scan(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = sorted(self.directory.glob("*.jsonl"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            self._lru[path.stem] = path.stat().st_mtime
+
+    def _path(self, conversation_id: str) -> Path:
+        return self.directory / f"{self._name(conversation_id)}.jsonl"
+
+    @staticmethod
+    def _name(conversation_id: str) -> str:
+        return hashlib.blake2b(str(conversation_id).encode(), digest_size=16).hexdigest()
+
+    def _lock(self, conversation_id: str) -> asyncio.Lock:
+        name = self._name(conversation_id)
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        return lock
+
+    def _touch(self, conversation_id: str) -> None:
+        name = self._name(conversation_id)
+        self._lru[name] = time.time()
+        self._lru.move_to_end(name)
+        busy = []
+        while self._lru and len(self._lru) + len(busy) > self.max_conversations:
+            evicted, touched = self._lru.popitem(last=False)
+            lock = self._locks.get(evicted)
+            if evicted == name or (lock is not None and lock.locked()):
+                # Файл сейчас читается или переписывается — удалим при следующем вытеснении
+                busy.append((evicted, touched))
+                continue
+            self._synced_at.pop(evicted, None)
+            try:
+                (self.directory / f"{evicted}.jsonl").unlink()
+            except FileNotFoundError:
+                pass
+        for evicted, touched in reversed(busy):
+            self._lru[evicted] = touched
+            self._lru.move_to_end(evicted, last=False)
+
+    # --- файловые операции (выполняются в пуле потоков) ---
+
+    def _read(self, conversation_id: str) -> Optional[List[_Entry]]:
+        path = self._path(conversation_id)
+        try:
+            with open(path, "rb") as f:
+                return [_Entry.from_json(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Corrupted history mirror for %s, dropping it: %s", conversation_id, e)
+            path.unlink(missing_ok=True)
+            return None
+
+    def _rewrite(self, conversation_id: str, entries: List[_Entry]) -> None:
+        path = self._path(conversation_id)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            for entry in entries[-self.max_messages:]:
+                f.write(entry.to_json() + b"\n")
+        os.replace(tmp, path)
+
+    def _append(self, conversation_id: str, entries: Iterable[_Entry]) -> None:
+        with open(self._path(conversation_id), "ab") as f:
+            for entry in entries:
+                f.write(entry.to_json() + b"\n")
+
+    # --- публичный API ---
+
+    async def get(self, conversation_id: str) -> Optional[List[HistoryMessage]]:
+        """История разговора: из зеркала, дополненная новыми сообщениями с backend"""
+        conversation_id = str(conversation_id)
+        async with self._lock(conversation_id):
+            entries = await asyncio.to_thread(self._read, conversation_id)
+            if entries is None or len(entries) >= self.max_messages:
+                # Нет в зеркале или зеркало хранит только конец разговора
+                return await self._full_sync(conversation_id)
+
+            synced_at = self._synced_at.get(self._name(conversation_id))
+            if synced_at is not None and time.monotonic() - synced_at < self.fresh_seconds:
+                self.hits += 1
+                self._touch(conversation_id)
+                return [entry.message for entry in entries]
+
+            return await self._delta_sync(conversation_id, entries)
+
+    async def _full_sync(self, conversation_id: str) -> Optional[List[HistoryMessage]]:
+        history = await self._fetch(conversation_id)
+        if history is None:
+            return None
+        self.full_syncs += 1
+        await asyncio.to_thread(self._rewrite, conversation_id, [_Entry(m) for m in history])
+        self._synced_at[self._name(conversation_id)] = time.monotonic()
+        self._touch(conversation_id)
+        return history
+
+    def _cursor(self, entries: List[_Entry]) -> Tuple[Optional[str], Any]:
+        for entry in reversed(entries):
+            if not entry.local and (entry.message.id is not None or entry.message.created_at is not None):
+                return entry.message.id, entry.message.created_at
+        return None, None
+
+    async def _delta_sync(self, conversation_id: str, entries: List[_Entry]) -> Optional[List[HistoryMessage]]:
+        cursor_id, cursor_ts = self._cursor(entries)
+        if cursor_id is None and cursor_ts is None:
+            # Backend не присылает ни ID, ни времени сообщений — дельту не посчитать
+            return await self._full_sync(conversation_id)
+
+        fetched = await self._fetch(conversation_id, after_id=cursor_id, since=cursor_ts)
+        if fetched is None:
+            # Backend недоступен — отдаем то, что есть локально
+            logger.warning("History delta sync failed for %s, serving local mirror", conversation_id)
+            return [entry.message for entry in entries]
+
+        # Backend мог проигнорировать параметры и вернуть всю историю — отрезаем известное
+        ids = [m.id for m in fetched]
+        if cursor_id is not None and cursor_id in ids:
+            delta = fetched[ids.index(cursor_id) + 1:]
+        elif cursor_ts is not None and any(m.created_at is not None for m in fetched):
+            delta = [m for m in fetched if _is_newer(m, cursor_ts)]
+        else:
+            delta = fetched
+
+        new_entries = [_Entry(m) for m in delta]
+        if len(entries) + len(new_entries) > self.max_messages:
+            # Разговор перерос зеркало: отдаем полную историю, в зеркале останется ее конец
+            return await self._full_sync(conversation_id)
+
+        self.delta_syncs += 1
+        if new_entries and any(entry.local for entry in entries):
+            # Локально записанные ходы заменяются подтвержденными сообщениями backend
+            merged = [entry for entry in entries if not entry.local] + new_entries
+            await asyncio.to_thread(self._rewrite, conversation_id, merged)
+        else:
+            merged = entries + new_entries
+            if new_entries:
+                await asyncio.to_thread(self._append, conversation_id, new_entries)
+
+        self._synced_at[self._name(conversation_id)] = time.monotonic()
+        self._touch(conversation_id)
+        return [entry.message for entry in merged]
+
+    async def append_turns(self, conversation_id: Optional[str], turns: Iterable[Tuple[str, str]]) -> None:
+        """Дописывает ходы разговора, которые прошли через бота (role, content)"""
+        if conversation_id is None:
+            return
+        conversation_id = str(conversation_id)
+        if self._name(conversation_id) not in self._lru:
+            # Разговор еще не зеркалируется — при первом просмотре будет полная загрузка
+            return
+        async with self._lock(conversation_id):
+            if self._name(conversation_id) not in self._lru:
+                # Вытеснен, пока ждали блокировку: файл с одними новыми ходами был бы неполным
+                return
+            entries = [_Entry(HistoryMessage(role=role, content=content), local=True) for role, content in turns]
+            await asyncio.to_thread(self._append, conversation_id, entries)
+            self._touch(conversation_id)
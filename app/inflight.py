@@ -0,0 +1,95 @@
+"""
+Реестр генераций ответа, которые сейчас ждут backend, по пользователям.
+
+Когда пользователь сбрасывает разговор (/clear, «Новый разговор», выбор другого разговора),
+незавершенные запросы send_message становятся ненужными: их ответ ушел бы в уже
+сброшенный разговор и перезаписал бы conversation_id. supersede() отменяет такие запросы
+(httpx закрывает соединение, backend видит обрыв и может остановить генерацию),
+а результат, успевший прийти до отмены, отбрасывается по номеру эпохи. run() возвращает
+эпоху вместе с результатом: сброс может прийти и после ответа backend, пока сохраняется
+conversation_id и отправляется ответ, поэтому перед этими шагами проверяется is_current().
+
+Реестр локален для процесса: при нескольких репликах отменяются только запросы,
+которые выполняет та же реплика.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Dict, Set, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Сколько помнить сброс у пользователя без запросов в полете: результат, полученный до сброса,
+# за это время успевает сохраниться и отправиться
+_MARK_SECONDS = 300.0
+
+
+class Superseded(Exception):
+    """Результат генерации больше не нужен: пользователь сбросил или сменил разговор"""
+
+
+class InflightRegistry:
+    def __init__(self):
+        self._tasks: Dict[int, Set[asyncio.Task]] = {}
+        # Эпоха — общий счетчик вызовов supersede(). Для пользователя хранится номер его последнего
+        # сброса и время (порядок — по времени): результат эпохи меньше номера устарел. Запись
+        # нужна, только пока ее могут проверить: удаляется по завершении последнего запроса
+        # пользователя или через _MARK_SECONDS
+        self._epoch = 0
+        self._superseded: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()
+        self.cancelled = 0
+
+    def count(self) -> int:
+        return sum(len(tasks) for tasks in self._tasks.values())
+
+    async def run(self, user_id: int, awaitable: Awaitable[T]) -> Tuple[T, int]:
+        """
+        Выполняет запрос как отменяемую задачу пользователя; возвращает результат и эпоху,
+        в которой он получен. Superseded, если запрос вытеснили.
+        """
+        epoch = self._epoch
+        task = asyncio.ensure_future(awaitable)
+        self._tasks.setdefault(user_id, set()).add(task)
+        try:
+            await asyncio.wait({task})
+        finally:
+            if not task.done():
+                # Отменили сам обработчик (например, остановка бота)
+                task.cancel()
+            tasks = self._tasks.get(user_id)
+            if tasks is not None:
+                tasks.discard(task)
+                if not tasks:
+                    del self._tasks[user_id]
+        stale = task.cancelled() or not self.is_current(user_id, epoch)
+        if user_id not in self._tasks:
+            # Все запросы, начатые до последнего сброса, уже отменены: отметка больше ни на что не влияет
+            self._superseded.pop(user_id, None)
+        if stale:
+            raise Superseded()
+        return task.result(), epoch
+
+    def is_current(self, user_id: int, epoch: int) -> bool:
+        """False, если после получения результата в эпохе epoch пользователь сбросил разговор"""
+        mark = self._superseded.get(user_id)
+        return mark is None or mark[0] <= epoch
+
+    def supersede(self, user_id: int) -> int:
+        """Отменяет все запросы пользователя в полете; возвращает их число"""
+        now = time.monotonic()
+        self._epoch += 1
+        self._superseded[user_id] = (self._epoch, now)
+        self._superseded.move_to_end(user_id)
+        while self._superseded:
+            _, (_, marked_at) = next(iter(self._superseded.items()))
+            if now - marked_at < _MARK_SECONDS:
+                break
+            self._superseded.popitem(last=False)
+        tasks = self._tasks.get(user_id)
+        if not tasks:
+            return 0
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        self.cancelled += len(pending)
+        return len(pending)
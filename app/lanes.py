@@ -0,0 +1,154 @@
+"""
+Полосы приоритета для входящих обновлений.
+
+Обновления классифицируются на входе: быстрая полоса — обработчики, которые отвечают
+из локальных данных (справка, шаблоны, сброс разговора), медленная — всё, что ходит
+в backend/LLM. У каждой полосы свой лимит одновременных обработчиков, поэтому навигация
+по меню не ждет, пока медленная полоса занята долгими генерациями.
+"""
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from .config import settings
+from .logger import logger
+
+FAST = "fast"
+SLOW = "slow"
+
+# Команды и кнопки, которые обслуживаются только локальными данными
+# (диагностика администратора тоже должна работать, когда медленная полоса забита)
+FAST_COMMANDS = {
+    "/help",
+    "/templates",
+    "/clear",
+    "/admin_stats",
+    "/admin_mem",
+    "/admin_profile",
+    "/admin_config",
+    "/admin_set",
+    "/admin_reload",
+    "/broadcast",
+    "/broadcast_status",
+    "/broadcast_cancel",
+}
+FAST_TEXTS = {"Шаблоны"}
+FAST_CALLBACK_PREFIXES = ("cat|", "tpl|", "back|cats", "register_cancel")
+
+
+def classify_update(update: Update) -> str:
+    """Определяет полосу для обновления"""
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        return FAST if data.startswith(FAST_CALLBACK_PREFIXES) else SLOW
+    message = update.message
+    if message is not None and message.text:
+        text = message.text.strip()
+        if text in FAST_TEXTS:
+            return FAST
+        if text.startswith("/"):
+            command = text.split(maxsplit=1)[0].split("@", 1)[0].lower()
+            if command in FAST_COMMANDS:
+                return FAST
+    return SLOW
+
+
+class LaneFull(Exception):
+    pass
+
+
+class Lane:
+    """
+    Ограничение одновременных обработчиков с ограниченной очередью ожидания.
+    Лимит можно менять на лету (resize); concurrency <= 0 — без ограничения.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_limit: Optional[int] = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _has_slot(self) -> bool:
+        return self.concurrency <= 0 or self.active < self.concurrency
+
+    def _wake(self) -> None:
+        """Передает освободившиеся места ожидающим в порядке очереди"""
+        while self._waiters and self._has_slot():
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def resize(self, concurrency: int) -> None:
+        """Новый лимит; при уменьшении лишние обработчики доработают, новые будут ждать"""
+        self.concurrency = concurrency
+        self._wake()
+
+    async def __aenter__(self) -> "Lane":
+        if not self._waiters and self._has_slot():
+            self.active += 1
+            return self
+        if self.queue_limit is not None and len(self._waiters) >= self.queue_limit:
+            raise LaneFull(self.name)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Место уже было передано этому обработчику — отдаем его следующему
+                self.active -= 1
+                self._wake()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.active -= 1
+        self._wake()
+
+
+class LaneMiddleware(BaseMiddleware):
+    """Outer-middleware для dp.update: распределяет обновления по полосам"""
+
+    def __init__(self):
+        self.lanes: Dict[str, Lane] = {
+            FAST: Lane(FAST, settings.fast_lane_concurrency),
+            SLOW: Lane(SLOW, settings.slow_lane_concurrency, queue_limit=settings.slow_lane_queue),
+        }
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        lane = self.lanes[classify_update(event)]
+        data["lane"] = lane.name
+        try:
+            async with lane:
+                return await handler(event, data)
+        except LaneFull:
+            logger.warning("Lane %s is full, rejecting update %s", lane.name, event.update_id)
+            await _reject_busy(event)
+            return None
+
+
+async def _reject_busy(event: Update) -> None:
+    try:
+        if event.callback_query is not None:
+            await event.callback_query.answer("Сервер перегружен, попробуйте чуть позже.", show_alert=True)
+        elif event.message is not None:
+            await event.message.answer("Сервер перегружен, попробуйте чуть позже.")
+    except Exception as e:
+        logger.warning("Failed to notify user about overload: %s", e)
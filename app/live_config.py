@@ -0,0 +1,285 @@
+"""
+Настройки, изменяемые без перезапуска.
+
+Settings читаются один раз при импорте, а редеплой ради смены лимита обрывает ответы
+в полете. Часть настроек (лимиты, таймауты, параллельность — см. TUNABLE) можно поменять
+в работающем процессе:
+    - файлом LIVE_CONFIG_FILE в формате .env (KEY=VALUE): он проверяется раз
+      в LIVE_CONFIG_POLL_SECONDS и перечитывается сразу по SIGHUP; ключ, удаленный
+      из файла, возвращается к значению при запуске;
+    - командой /admin_set KEY=VALUE ... (до перезапуска или следующего изменения).
+
+Изменение применяется целиком или не применяется совсем: все значения сначала
+приводятся к типу поля Settings и проверяются, затем записываются в settings и передаются
+объектам, которые кэшируют их у себя (RateLimiter, полосы, пул backend — on_change).
+Если объект не принял значение, уже примененные изменения откатываются.
+"""
+import asyncio
+import os
+import signal
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pydantic import TypeAdapter, ValidationError
+
+from .config import Settings, settings
+from .logger import logger
+from .telegram_transport import parse_method_timeouts
+
+
+def _positive(value: Any) -> bool:
+    return value > 0
+
+
+def _non_negative(value: Any) -> bool:
+    return value >= 0
+
+
+def _fraction(value: Any) -> bool:
+    return 0 <= value <= 1
+
+
+def _method_timeouts(value: str) -> bool:
+    try:
+        parse_method_timeouts(value)
+    except ValueError:
+        return False
+    return True
+
+
+# Настройки, которые можно менять на лету, и проверка значения (None — только тип)
+TUNABLE: Dict[str, Optional[Callable[[Any], bool]]] = {
+    "RATE_LIMIT_PER_MINUTE": _positive,
+    "BACKEND_TIMEOUT_SECONDS": _positive,
+    "BACKEND_GENERATION_TIMEOUT_SECONDS": _positive,
+    "BACKEND_MAX_CONNECTIONS": _non_negative,
+    "BACKEND_HEDGING": None,
+    "BACKEND_HEDGE_RATIO": _fraction,
+    "BACKEND_STICKY": None,
+    "BACKEND_EJECT_AFTER_FAILURES": _positive,
+    "BACKEND_EJECT_SECONDS": _positive,
+    "BACKEND_MAX_EJECTED_FRACTION": _fraction,
+    "BACKEND_BATCHING": None,
+    "BACKEND_BATCH_WINDOW_SECONDS": _non_negative,
+    "BACKEND_BATCH_MAX_SIZE": _positive,
+    "BACKEND_BATCH_FALLBACK_CONCURRENCY": _positive,
+    "UPDATE_BUDGET_SECONDS": _non_negative,
+    "FAST_LANE_CONCURRENCY": _positive,
+    "SLOW_LANE_CONCURRENCY": _positive,
+    "SLOW_LANE_QUEUE": _non_negative,
+    "CANCEL_ON_FOLLOWUP": None,
+    "HISTORY_EXPORT_THRESHOLD": _positive,
+    "HISTORY_MIRROR_FRESH_SECONDS": _non_negative,
+    "RENDER_OFFLOAD_CHARS": _positive,
+    "HISTORY_PREFETCH": None,
+    "HISTORY_PREFETCH_TOP_N": _positive,
+    "HISTORY_PREFETCH_CONCURRENCY": _positive,
+    "HISTORY_PREFETCH_TTL_SECONDS": _non_negative,
+    "HISTORY_PREFETCH_MAX_BYTES": _positive,
+    "SESSION_PROFILE_TTL_SECONDS": _non_negative,
+    "SESSION_TOKEN_TTL_SECONDS": _non_negative,
+    "SESSION_REFRESH_BEFORE_SECONDS": _non_negative,
+    "OUTBOX_RETRY_BASE_SECONDS": _positive,
+    "OUTBOX_RETRY_MAX_SECONDS": _positive,
+    "OUTBOX_MAX_AGE_SECONDS": _positive,
+    "BROADCAST_RATE_PER_SECOND": _positive,
+    "BROADCAST_CONCURRENCY": _positive,
+    "DOCUMENT_MAX_BYTES": _positive,
+    "DOCUMENT_CHUNK_CHARS": _positive,
+    "DOCUMENT_UPLOAD_CONCURRENCY": _positive,
+    "DOCUMENT_BUDGET_SECONDS": _non_negative,
+    "QUOTA_USER_UNITS_PER_MINUTE": _positive,
+    "QUOTA_GLOBAL_UNITS_PER_MINUTE": _positive,
+    "QUOTA_CHARS_PER_UNIT": _positive,
+    "QUOTA_DOCUMENT_UNITS": _non_negative,
+    "QUOTA_UNITS_PER_SECOND": _non_negative,
+    "QUOTA_TOKENS_PER_UNIT": _positive,
+    "QUOTA_MAX_WAIT_SECONDS": _non_negative,
+    "QUOTA_LOW_PRIORITY_CONCURRENCY": _positive,
+    "TRACE_SAMPLE_RATE": _fraction,
+    "TELEGRAM_TIMEOUT_SECONDS": _positive,
+    "TELEGRAM_METHOD_TIMEOUTS": _method_timeouts,
+}
+
+
+class LiveConfigError(ValueError):
+    """Изменение отклонено; текст показывается администратору"""
+
+
+def parse_env_file(path: str) -> Dict[str, str]:
+    """KEY=VALUE по строке, # — комментарий; отсутствующий файл — пустой набор"""
+    values: Dict[str, str] = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return values
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        key, sep, value = line.partition("=")
+        if not sep:
+            raise LiveConfigError(f"{path}:{number}: ожидается KEY=VALUE")
+        values[key.strip().upper()] = value.strip().strip("'\"")
+    return values
+
+
+class LiveConfig:
+    def __init__(
+        self,
+        settings: Settings,
+        tunable: Dict[str, Optional[Callable[[Any], bool]]],
+        path: str = "",
+        poll_seconds: float = 5.0,
+    ):
+        self.settings = settings
+        self.path = path
+        self.poll_seconds = poll_seconds
+        fields = {field.alias: name for name, field in type(settings).model_fields.items() if field.alias}
+        self._fields = {key: fields[key] for key in tunable}
+        self._checks = tunable
+        self._adapters = {
+            key: TypeAdapter(type(settings).model_fields[name].annotation) for key, name in self._fields.items()
+        }
+        self._appliers: Dict[str, List[Callable[[Any], None]]] = defaultdict(list)
+        self._startup = {key: self.current(key) for key in tunable}
+        # Ключи, значения которых сейчас заданы файлом
+        self._from_file: Dict[str, Any] = {}
+        self._mtime: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self.changes = 0
+
+    def keys(self) -> List[str]:
+        return list(self._fields)
+
+    def current(self, key: str) -> Any:
+        return getattr(self.settings, self._fields[key])
+
+    def startup(self, key: str) -> Any:
+        return self._startup[key]
+
+    def on_change(self, key: str, apply: Callable[[Any], None]) -> None:
+        """Регистрирует объект, который кэширует значение настройки у себя"""
+        if key not in self._fields:
+            raise KeyError(key)
+        self._appliers[key].append(apply)
+
+    def parse(self, changes: Dict[str, Any]) -> Dict[str, Any]:
+        """Приводит значения к типам полей и проверяет их; LiveConfigError при первой ошибке"""
+        parsed = {}
+        for key, raw in changes.items():
+            key = key.upper()
+            if key not in self._fields:
+                raise LiveConfigError(f"{key}: не меняется без перезапуска")
+            try:
+                value = self._adapters[key].validate_python(raw)
+            except ValidationError:
+                raise LiveConfigError(f"{key}: некорректное значение {raw!r}") from None
+            check = self._checks[key]
+            if check is not None and not check(value):
+                raise LiveConfigError(f"{key}: недопустимое значение {raw!r}")
+            parsed[key] = value
+        return parsed
+
+    def apply(self, changes: Dict[str, Any], source: str) -> Dict[str, Tuple[Any, Any]]:
+        """
+        Применяет изменения атомарно. Возвращает {ключ: (старое, новое)} для реально
+        изменившихся значений; LiveConfigError — ничего не изменено.
+        """
+        parsed = self.parse(changes)
+        diff = {key: value for key, value in parsed.items() if value != self.current(key)}
+        applied: List[Tuple[str, Any]] = []
+        try:
+            for key, value in diff.items():
+                applied.append((key, self.current(key)))
+                setattr(self.settings, self._fields[key], value)
+                for apply in self._appliers[key]:
+                    apply(value)
+        except Exception as e:
+            failed = applied[-1][0]
+            for key, old in reversed(applied):
+                setattr(self.settings, self._fields[key], old)
+                for apply in self._appliers[key]:
+                    try:
+                        apply(old)
+                    except Exception as rollback_error:
+                        logger.error("Failed to roll back %s: %s", key, rollback_error)
+            logger.error("Live config change from %s rejected, rolled back: %s: %s", source, failed, e)
+            raise LiveConfigError(f"{failed}: {e}") from e
+
+        result = {key: (old, diff[key]) for key, old in applied}
+        if result:
+            self.changes += 1
+            logger.info(
+                "Live config changed from %s: %s",
+                source,
+                ", ".join(f"{key} {old!r} -> {new!r}" for key, (old, new) in result.items()),
+            )
+        return result
+
+    def reload(self, source: str = "file") -> Dict[str, Tuple[Any, Any]]:
+        """Перечитывает LIVE_CONFIG_FILE; удаленные из файла ключи возвращаются к значениям при запуске"""
+        if not self.path:
+            raise LiveConfigError("LIVE_CONFIG_FILE не задан")
+        values = self.parse(parse_env_file(self.path))
+        target = {key: self._startup[key] for key in self._from_file if key not in values}
+        target.update(values)
+        result = self.apply(target, source)
+        self._from_file = values
+        return result
+
+    # --- фоновая проверка файла и SIGHUP ---
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _reload_logged(self, source: str) -> None:
+        try:
+            self.reload(source)
+        except LiveConfigError as e:
+            logger.error("Live config %s not applied: %s", self.path, e)
+
+    def start(self) -> None:
+        if not self.path or self._task is not None:
+            return
+        self._mtime = self._file_mtime()
+        self._reload_logged("file")
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._reload_logged, "SIGHUP")
+        except (AttributeError, NotImplementedError, RuntimeError):
+            # Нет SIGHUP (Windows) или цикл не в главном потоке — остается проверка файла
+            pass
+        self._task = asyncio.create_task(self._run(), name="live-config-watcher")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            try:
+                asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            except (AttributeError, NotImplementedError, RuntimeError):
+                pass
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            mtime = self._file_mtime()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self._reload_logged("file")
+
+
+live_config = LiveConfig(
+    settings,
+    TUNABLE,
+    path=settings.live_config_file,
+    poll_seconds=settings.live_config_poll_seconds,
+)
@@ -0,0 +1,279 @@
+"""
+Надежная доставка сгенерированных ответов пользователю (outbox).
+
+Ответ LLM стоит секунд генерации, а bot.send_message может упасть на ошибке разбора HTML,
+сетевом сбое или 429 — без outbox такой ответ терялся. Outbox:
+    - дописывает ответ в журнал (OUTBOX_FILE, JSONL, fsync) до первой попытки отправки;
+    - отправляет его по частям, отмечая в журнале отправленные, чтобы повтор не дублировал
+      уже доставленные части;
+    - при ошибке разбора разметки отправляет часть обычным текстом; при RetryAfter ждет
+      указанное время, при сетевых ошибках и 5xx повторяет с экспоненциальной задержкой
+      (OUTBOX_RETRY_BASE_SECONDS … OUTBOX_RETRY_MAX_SECONDS); ответ старше
+      OUTBOX_MAX_AGE_SECONDS, заблокированный бот или другая ошибка запроса — отказ;
+    - после рестарта недоставленные ответы из журнала отправляются заново.
+
+Ответы одного чата доставляются по порядку: пока у чата есть недоставленный ответ,
+новые встают за ним. Журнал локальный для реплики.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import secrets
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from .codec import dumps, loads
+from .logger import logger
+
+
+@dataclass
+class OutboxEntry:
+    id: str
+    chat_id: int
+    parts: List[str]
+    parse_mode: Optional[str]
+    created_at: float
+    # Сколько частей уже доставлено
+    sent: int = 0
+    attempts: int = 0
+
+
+class _Retry(Exception):
+    """Доставку нужно повторить позже; delay — рекомендованная задержка (RetryAfter)"""
+
+    def __init__(self, reason: str, delay: Optional[float] = None):
+        super().__init__(reason)
+        self.delay = delay
+
+
+def _is_parse_error(error: TelegramBadRequest) -> bool:
+    return "can't parse entities" in str(error).lower()
+
+
+class Outbox:
+    def __init__(
+        self,
+        journal_file: str = "outbox.jsonl",
+        retry_base_seconds: float = 1.0,
+        retry_max_seconds: float = 300.0,
+        max_age_seconds: float = 86400.0,
+        compact_after: int = 1000,
+    ):
+        self.journal_file = Path(journal_file)
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.max_age_seconds = max_age_seconds
+        self.compact_after = compact_after
+        # Недоставленные ответы в порядке добавления
+        self._entries: Dict[str, OutboxEntry] = {}
+        # chat_id -> доставка недоставленных ответов чата
+        self._workers: Dict[int, asyncio.Task] = {}
+        # Чаты, ответ которым сейчас отправляется прямо из deliver
+        self._sending: Set[int] = set()
+        self._write_lock = asyncio.Lock()
+        self._journal_lines = 0
+        self.delivered = 0
+        self.retried = 0
+        self.plain_fallbacks = 0
+        self.dropped = 0
+        self._load()
+
+    # --- журнал ---
+
+    def _load(self) -> None:
+        if not self.journal_file.exists():
+            return
+        try:
+            with open(self.journal_file, "rb") as f:
+                for line in f:
+                    try:
+                        record = loads(line)
+                    except Exception:
+                        # Оборванная последняя строка (процесс был убит во время записи)
+                        continue
+                    op = record.pop("op", None)
+                    if op == "put":
+                        self._entries[record["id"]] = OutboxEntry(**record)
+                    elif op == "sent" and record["id"] in self._entries:
+                        self._entries[record["id"]].sent = record["sent"]
+                    elif op == "done":
+                        self._entries.pop(record["id"], None)
+        except Exception as e:
+            logger.error("Error loading outbox journal %s: %s", self.journal_file, e)
+        self._compact()
+        if self._entries:
+            logger.info("Outbox has %s undelivered replies from the previous run", len(self._entries))
+
+    def _compact(self) -> None:
+        """Переписывает журнал только недоставленными ответами"""
+        tmp = self.journal_file.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            for entry in self._entries.values():
+                f.write(dumps({"op": "put", **asdict(entry)}) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_file)
+        self._journal_lines = len(self._entries)
+
+    def _write(self, records: List[Dict], sync: bool) -> None:
+        with open(self.journal_file, "ab") as f:
+            f.write(b"".join(dumps(record) + b"\n" for record in records))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    async def _journal(self, record: Dict, sync: bool = False) -> None:
+        async with self._write_lock:
+            try:
+                await asyncio.to_thread(self._write, [record], sync)
+                self._journal_lines += 1
+                if self._journal_lines > self.compact_after + 2 * len(self._entries):
+                    await asyncio.to_thread(self._compact)
+            except Exception as e:
+                logger.error("Error writing outbox journal: %s", e)
+
+    # --- доставка ---
+
+    async def deliver(self, bot: Bot, chat_id: int, parts: List[str], parse_mode: Optional[str] = None) -> bool:
+        """
+        Записывает ответ в журнал и отправляет. True — доставлен сразу; False — отказ или
+        доставка продолжится в фоне (или после рестарта).
+        """
+        entry = OutboxEntry(
+            id=secrets.token_hex(8),
+            chat_id=chat_id,
+            parts=parts,
+            parse_mode=parse_mode,
+            created_at=time.time(),
+        )
+        queued = chat_id in self._workers or chat_id in self._sending
+        self._entries[entry.id] = entry
+        if queued:
+            await self._journal({"op": "put", **asdict(entry)}, sync=True)
+            # У чата уже есть недоставленный ответ: новый отправится после него
+            return entry.id not in self._entries
+        self._sending.add(chat_id)
+        try:
+            await self._journal({"op": "put", **asdict(entry)}, sync=True)
+            if chat_id in self._workers:
+                return entry.id not in self._entries
+            return await self._attempt(bot, entry)
+        except _Retry as e:
+            logger.warning("Reply to chat %s not delivered, will retry: %s", chat_id, e)
+            self._spawn_worker(bot, entry.chat_id, e.delay)
+            return False
+        finally:
+            self._sending.discard(chat_id)
+            if any(e.chat_id == chat_id for e in self._entries.values()):
+                # Ответы, вставшие в очередь за этим, доставит фоновая задача
+                self._spawn_worker(bot, chat_id, None)
+
+    def start(self, bot: Bot) -> None:
+        """Доставляет ответы, оставшиеся в журнале после рестарта"""
+        for chat_id in {entry.chat_id for entry in self._entries.values()}:
+            self._spawn_worker(bot, chat_id, None)
+
+    async def stop(self) -> None:
+        """Останавливает фоновую доставку; недоставленное остается в журнале до следующего запуска"""
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def _spawn_worker(self, bot: Bot, chat_id: int, delay: Optional[float]) -> None:
+        if chat_id in self._workers:
+            return
+        # Пустой контекст: фоновая доставка не наследует дедлайн обновления
+        task = asyncio.create_task(
+            self._drain(bot, chat_id, delay), name=f"outbox-{chat_id}", context=contextvars.Context()
+        )
+        self._workers[chat_id] = task
+
+        def forget(_: asyncio.Task) -> None:
+            if self._workers.get(chat_id) is task:
+                del self._workers[chat_id]
+
+        task.add_done_callback(forget)
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** max(0, attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _drain(self, bot: Bot, chat_id: int, delay: Optional[float]) -> None:
+        while True:
+            entry = next((e for e in self._entries.values() if e.chat_id == chat_id), None)
+            if entry is None:
+                # Без await между проверкой и снятием: новый ответ чата либо уже найден выше,
+                # либо deliver отправит его сам
+                self._workers.pop(chat_id, None)
+                return
+            if delay is None and entry.attempts:
+                delay = self._backoff(entry.attempts)
+            if delay:
+                await asyncio.sleep(delay)
+            delay = None
+            if time.time() - entry.created_at > self.max_age_seconds:
+                logger.error("Dropping reply to chat %s: not delivered within %.0f s", chat_id, self.max_age_seconds)
+                await self._finish(entry, dropped=True)
+                continue
+            self.retried += 1
+            try:
+                await self._attempt(bot, entry)
+            except _Retry as e:
+                logger.warning("Reply to chat %s not delivered (attempt %s): %s", chat_id, entry.attempts, e)
+                delay = e.delay
+
+    async def _attempt(self, bot: Bot, entry: OutboxEntry) -> bool:
+        """Отправляет недоставленные части; False — отказ, _Retry — повторить позже"""
+        entry.attempts += 1
+        while entry.sent < len(entry.parts):
+            part = entry.parts[entry.sent]
+            try:
+                try:
+                    await bot.send_message(entry.chat_id, part, parse_mode=entry.parse_mode)
+                except TelegramBadRequest as e:
+                    if entry.parse_mode is None or not _is_parse_error(e):
+                        raise
+                    logger.warning("Reply to chat %s has broken markup, sending as plain text: %s", entry.chat_id, e)
+                    self.plain_fallbacks += 1
+                    await bot.send_message(entry.chat_id, part, parse_mode=None)
+            except TelegramRetryAfter as e:
+                raise _Retry("flood control", delay=e.retry_after) from None
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                raise _Retry(str(e) or type(e).__name__) from None
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован или запрос отклонен — повтор не поможет
+                logger.error("Dropping reply to chat %s: %s", entry.chat_id, e)
+                await self._finish(entry, dropped=True)
+                return False
+            except Exception as e:
+                logger.exception("Unexpected error sending reply to chat %s: %s", entry.chat_id, e)
+                raise _Retry(str(e) or type(e).__name__) from None
+            entry.sent += 1
+            if entry.sent < len(entry.parts):
+                await self._journal({"op": "sent", "id": entry.id, "sent": entry.sent})
+        await self._finish(entry)
+        return True
+
+    async def _finish(self, entry: OutboxEntry, dropped: bool = False) -> None:
+        self._entries.pop(entry.id, None)
+        if dropped:
+            self.dropped += 1
+        else:
+            self.delivered += 1
+        await self._journal({"op": "done", "id": entry.id})
+
+    def pending(self) -> int:
+        return len(self._entries)
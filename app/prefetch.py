@@ -0,0 +1,194 @@
+"""
+Упреждающая загрузка историй разговоров (HISTORY_PREFETCH).
+
+После /conversations пользователь почти всегда открывает один из первых разговоров
+списка, и каждое нажатие ждет загрузки истории с backend. Prefetcher сразу после показа
+списка загружает истории первых HISTORY_PREFETCH_TOP_N разговоров в фоне и держит
+их в памяти HISTORY_PREFETCH_TTL_SECONDS (не больше HISTORY_PREFETCH_MAX_BYTES на все
+истории), а обработчик conv| сначала смотрит сюда.
+
+Загрузка низкоприоритетная: одновременно выполняется не больше
+HISTORY_PREFETCH_CONCURRENCY загрузок, и новые не начинаются, пока обновления ждут места
+в медленной полосе. Фоновые задачи запускаются в пустом контексте — без дедлайна
+и трассировки обновления, которое их создало. Любое другое действие пользователя
+отменяет загрузки, которые еще ждут очереди (начатые доводятся до конца, но не кэшируются);
+нажатие на разговор отменяет загрузку остальных.
+"""
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from .history_export import estimate_size
+from .lanes import Lane
+from .logger import logger
+from .schemas import HistoryMessage
+
+HistoryLoader = Callable[[str], Awaitable[Optional[List[HistoryMessage]]]]
+
+
+class HistoryPrefetcher:
+    def __init__(
+        self,
+        load: HistoryLoader,
+        top_n: int = 3,
+        concurrency: int = 2,
+        ttl_seconds: float = 60.0,
+        max_bytes: int = 8 * 1024 * 1024,
+        busy: Callable[[], bool] = lambda: False,
+    ):
+        self._load = load
+        self.top_n = top_n
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        # Занят ли бот срочной работой (тогда новые загрузки не начинаются)
+        self._busy = busy
+        self.lane = Lane("prefetch", concurrency)
+        # conversation_id -> (момент истечения, размер, история); порядок — от старых к новым
+        self._cache: "OrderedDict[str, Tuple[float, int, List[HistoryMessage]]]" = OrderedDict()
+        self._bytes = 0
+        # telegram_user_id -> {conversation_id: задача загрузки}
+        self._tasks: Dict[int, Dict[str, asyncio.Task]] = {}
+        self.prefetched = 0
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+        self.skipped = 0
+
+    # --- кэш ---
+
+    def _evict(self, conversation_id: str) -> None:
+        _, size, _ = self._cache.pop(conversation_id)
+        self._bytes -= size
+
+    def _purge(self, now: float) -> None:
+        while self._cache:
+            conversation_id, (expires_at, _, _) = next(iter(self._cache.items()))
+            if expires_at > now and self._bytes <= self.max_bytes:
+                return
+            self._evict(conversation_id)
+
+    def _store(self, conversation_id: str, history: List[HistoryMessage]) -> None:
+        size = estimate_size(history)
+        if size > self.max_bytes:
+            return
+        if conversation_id in self._cache:
+            self._evict(conversation_id)
+        self._cache[conversation_id] = (time.monotonic() + self.ttl_seconds, size, history)
+        self._bytes += size
+        self._purge(time.monotonic())
+
+    def take(self, user_id: int, conversation_id: str) -> Optional[List[HistoryMessage]]:
+        """История из кэша (None — нет или устарела); загрузка остальных разговоров отменяется"""
+        self.cancel(user_id, keep=conversation_id)
+        conversation_id = str(conversation_id)
+        self._purge(time.monotonic())
+        entry = self._cache.get(conversation_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[2]
+
+    def invalidate(self, conversation_id: Optional[str]) -> None:
+        """Разговор изменился (новый ход) — закэшированная история больше не актуальна"""
+        if conversation_id is not None and str(conversation_id) in self._cache:
+            self._evict(str(conversation_id))
+
+    def size(self) -> Tuple[int, int]:
+        """Число историй и их суммарный размер"""
+        return len(self._cache), self._bytes
+
+    # --- фоновая загрузка ---
+
+    def schedule(self, user_id: int, conversation_ids: List[str]) -> None:
+        """Загружает в фоне первые top_n разговоров, которых еще нет в кэше"""
+        self.cancel(user_id)
+        now = time.monotonic()
+        self._purge(now)
+        tasks: Dict[str, asyncio.Task] = {}
+        for conversation_id in conversation_ids[:self.top_n]:
+            conversation_id = str(conversation_id)
+            if conversation_id in self._cache:
+                continue
+            # Пустой контекст: без дедлайна, спана и update_id обновления, которое запустило загрузку
+            tasks[conversation_id] = asyncio.create_task(
+                self._prefetch(user_id, conversation_id),
+                name=f"history-prefetch-{user_id}",
+                context=contextvars.Context(),
+            )
+        if tasks:
+            self._tasks[user_id] = tasks
+
+    async def _prefetch(self, user_id: int, conversation_id: str) -> None:
+        try:
+            async with self.lane:
+                if self._busy():
+                    self.skipped += 1
+                    return
+                load = asyncio.ensure_future(self._load(conversation_id))
+                try:
+                    history = await asyncio.shield(load)
+                except asyncio.CancelledError:
+                    # Начатая загрузка доводится до конца, чтобы не прервать запись зеркала истории;
+                    # место в полосе занято до ее завершения
+                    await asyncio.wait({load})
+                    raise
+            if history is not None:
+                self.prefetched += 1
+                self._store(conversation_id, history)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("History prefetch for %s failed: %s", conversation_id, e)
+        finally:
+            tasks = self._tasks.get(user_id)
+            if tasks is not None and tasks.get(conversation_id) is asyncio.current_task():
+                del tasks[conversation_id]
+                if not tasks:
+                    del self._tasks[user_id]
+
+    def cancel(self, user_id: int, keep: Optional[str] = None) -> None:
+        """Отменяет незавершенные загрузки пользователя (кроме разговора keep)"""
+        tasks = self._tasks.pop(user_id, None)
+        if not tasks:
+            return
+        for conversation_id, task in tasks.items():
+            if conversation_id == keep:
+                continue
+            if not task.done():
+                task.cancel()
+                self.cancelled += 1
+
+    def pending(self) -> int:
+        return sum(len(tasks) for tasks in self._tasks.values())
+
+
+def _is_conversation_tap(event: Update) -> bool:
+    callback = event.callback_query
+    return callback is not None and (callback.data or "").startswith("conv|") and callback.data != "conv|new"
+
+
+class PrefetchCancelMiddleware(BaseMiddleware):
+    """Outer-middleware для dp.update: любое действие пользователя, кроме выбора разговора, отменяет упреждающую загрузку"""
+
+    def __init__(self, prefetcher: HistoryPrefetcher):
+        self.prefetcher = prefetcher
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not _is_conversation_tap(event):
+            user = event.message.from_user if event.message is not None else None
+            if user is None and event.callback_query is not None:
+                user = event.callback_query.from_user
+            if user is not None:
+                self.prefetcher.cancel(user.id)
+        return await handler(event, data)
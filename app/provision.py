@@ -0,0 +1,340 @@
+"""
+Массовая регистрация пользователей заранее (например, всех сотрудников компании-клиента).
+
+    python -m app.provision users.csv
+    python -m app.provision users.jsonl --concurrency 16 --retries 5
+
+Вход — CSV с заголовком или JSONL; обязательное поле telegram_user_id, необязательные
+telegram_username, full_name (или first_name/last_name), email и business_type.
+Для каждого пользователя, как в register_confirm: Telegram пользователь создается в backend,
+регистрируется аккаунт (email и пароль генерируются, если email не задан) и связывается
+с Telegram. Уже связанные пользователи не регистрируются повторно.
+
+- одновременно обрабатывается не больше --concurrency пользователей (и не больше
+  BACKEND_MAX_CONNECTIONS запросов), неудачный шаг повторяется до --retries раз
+  с экспоненциальной задержкой; уже выполненные шаги при повторе не повторяются;
+- результаты пишутся в хранилище пачками по --batch-size (UserStorage.set_many),
+  после каждой пачки — в checkpoint (JSONL рядом со входом, без паролей). При повторном
+  запуске пользователи из checkpoint пропускаются, кроме завершившихся ошибкой;
+- email и пароль до регистрации дописываются (с fsync) в журнал учетных данных рядом
+  с checkpoint (<input>.provision.credentials.jsonl, права 0600). Если процесс убит до записи
+  пачки или ответ register потерян (таймаут), аккаунт уже создан: повторный register
+  получает конфликт, и вход с сохраненными учетными данными возвращает его. Журнал
+  удаляется, когда запуск завершился без ошибок.
+
+При первом /start пользователь уже зарегистрирован и связан — ответ сразу, без регистрации.
+С STATE_BACKEND=memory бот на время загрузки должен быть остановлен: он перезапишет файл
+хранилища своей копией. С Redis загружать можно на работающем боте.
+"""
+import argparse
+import asyncio
+import csv
+import os
+import random
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Set, TypeVar
+
+from .backend_client import BackendClient
+from .codec import dumps, loads
+from .config import settings
+from .logger import logger
+
+T = TypeVar("T")
+
+# Итоги, после которых пользователь при повторном запуске пропускается
+DONE_STATUSES = ("registered", "linked", "exists", "conflict")
+
+
+@dataclass
+class ProvisionResult:
+    telegram_user_id: int
+    # registered — зарегистрирован и связан; linked — уже был связан в backend (нужен /login);
+    # exists — уже зарегистрирован в хранилище; conflict — аккаунт с заданным во входе email уже есть
+    # и создан не здесь; failed — ошибка (в том числе конфликт по сгенерированному email, где вход не удался)
+    status: str
+    backend_user_id: Optional[int] = None
+    error: Optional[str] = None
+
+
+class StepFailed(Exception):
+    pass
+
+
+def read_users(path: str) -> Iterator[Dict[str, Any]]:
+    """Пользователи из CSV (с заголовком) или JSONL"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows: Any = csv.DictReader(f)
+        else:
+            rows = (loads(line) for line in f if line.strip())
+        for number, row in enumerate(rows, 1):
+            user = {k.strip(): v for k, v in row.items() if k and v not in (None, "")}
+            try:
+                user["telegram_user_id"] = int(user["telegram_user_id"])
+            except (KeyError, TypeError, ValueError):
+                logger.error("%s: record %s has no valid telegram_user_id, skipped", path, number)
+                continue
+            yield user
+
+
+def _names(user: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    full_name = user.get("full_name") or " ".join(filter(None, (user.get("first_name"), user.get("last_name"))))
+    first_name, _, last_name = full_name.partition(" ")
+    return {
+        "full_name": full_name or None,
+        "first_name": user.get("first_name") or first_name or None,
+        "last_name": user.get("last_name") or last_name or None,
+    }
+
+
+class Provisioner:
+    def __init__(
+        self,
+        backend: BackendClient,
+        storage: Any,
+        checkpoint_file: str,
+        credentials_file: Optional[str] = None,
+        concurrency: int = 8,
+        retries: int = 3,
+        batch_size: int = 200,
+        retry_base_seconds: float = 1.0,
+    ):
+        self.backend = backend
+        self.storage = storage
+        self.checkpoint_file = Path(checkpoint_file)
+        self.credentials_file = (
+            Path(credentials_file) if credentials_file else self.checkpoint_file.with_suffix(".credentials.jsonl")
+        )
+        self.concurrency = concurrency
+        self.retries = retries
+        self.batch_size = batch_size
+        self.retry_base_seconds = retry_base_seconds
+        # Готовые к записи: данные для хранилища и итог для checkpoint
+        self._pending: Dict[int, Dict] = {}
+        self._results: List[ProvisionResult] = []
+        self._flush_lock = asyncio.Lock()
+        # Учетные данные, отправленные в register этим или прошлыми запусками
+        self._credentials: Dict[int, Dict[str, str]] = self._load_credentials()
+        self._credentials_lock = asyncio.Lock()
+        self.counts: Counter = Counter()
+
+    def done_ids(self) -> Set[int]:
+        """Пользователи, уже обработанные прошлыми запусками"""
+        done: Set[int] = set()
+        if not self.checkpoint_file.exists():
+            return done
+        with open(self.checkpoint_file, "rb") as f:
+            for line in f:
+                try:
+                    record = loads(line)
+                except Exception:
+                    # Оборванная последняя строка (процесс был убит во время записи)
+                    continue
+                if record.get("status") in DONE_STATUSES:
+                    done.add(int(record["telegram_user_id"]))
+                else:
+                    done.discard(int(record["telegram_user_id"]))
+        return done
+
+    def _load_credentials(self) -> Dict[int, Dict[str, str]]:
+        credentials: Dict[int, Dict[str, str]] = {}
+        if not self.credentials_file.exists():
+            return credentials
+        with open(self.credentials_file, "rb") as f:
+            for line in f:
+                try:
+                    record = loads(line)
+                except Exception:
+                    # Оборванная последняя строка (процесс был убит во время записи)
+                    continue
+                credentials[int(record["telegram_user_id"])] = {"email": record["email"], "password": record["password"]}
+        return credentials
+
+    def _append_credentials(self, line: bytes) -> None:
+        fd = os.open(self.credentials_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        with os.fdopen(fd, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _save_credentials(self, telegram_user_id: int, email: str, password: str) -> None:
+        """Записывает учетные данные на диск до register: аккаунт может быть создан, даже если ответ потерян"""
+        line = dumps({"telegram_user_id": telegram_user_id, "email": email, "password": password}) + b"\n"
+        async with self._credentials_lock:
+            await asyncio.to_thread(self._append_credentials, line)
+        self._credentials[telegram_user_id] = {"email": email, "password": password}
+
+    async def _retry(self, step: str, call: Callable[[], Awaitable[Optional[T]]]) -> T:
+        """Повторяет шаг, пока он возвращает None, с экспоненциальной задержкой и разбросом"""
+        for attempt in range(self.retries + 1):
+            result = await call()
+            if result is not None:
+                return result
+            if attempt < self.retries:
+                await asyncio.sleep(self.retry_base_seconds * 2 ** attempt * random.uniform(0.5, 1.5))
+        raise StepFailed(f"{step} failed after {self.retries + 1} attempts")
+
+    async def provision(self, user: Dict[str, Any]) -> ProvisionResult:
+        telegram_user_id = user["telegram_user_id"]
+        username = user.get("telegram_username")
+        names = _names(user)
+
+        telegram_user = await self._retry("create telegram user", lambda: self.backend.create_or_get_telegram_user(
+            telegram_user_id=telegram_user_id,
+            telegram_username=username,
+            first_name=names["first_name"],
+            last_name=names["last_name"],
+        ))
+        if await self.storage.has_user(telegram_user_id):
+            # Зарегистрирован раньше (в том числе прошлым запуском, где не удалось связывание)
+            backend_user_id = await self.storage.get_backend_user_id(telegram_user_id)
+            if telegram_user.backend_user_id or backend_user_id is None:
+                return ProvisionResult(telegram_user_id, "exists", telegram_user.backend_user_id or backend_user_id)
+            await self._retry("link", lambda: self.backend.link_telegram_user(telegram_user_id, backend_user_id))
+            return ProvisionResult(telegram_user_id, "registered", backend_user_id)
+        if telegram_user.backend_user_id:
+            fields = {"backend_user_id": telegram_user.backend_user_id, "telegram_username": username}
+            credentials = self._credentials.get(telegram_user_id)
+            if credentials is not None:
+                # Возможно, связан прошлым запуском, убитым до записи пачки: учетные данные — из журнала
+                session = await self.backend.login(credentials["email"], credentials["password"])
+                if session and session.get("user_id") == telegram_user.backend_user_id:
+                    self._pending[telegram_user_id] = {**fields, "token": session.get("token"), **credentials}
+                    return ProvisionResult(telegram_user_id, "registered", telegram_user.backend_user_id)
+            # Уже связан с аккаунтом, созданным не здесь: учетных данных нет, пользователь войдет через /login
+            self._pending[telegram_user_id] = fields
+            return ProvisionResult(telegram_user_id, "linked", telegram_user.backend_user_id)
+
+        credentials = self._credentials.get(telegram_user_id)
+        if credentials is None:
+            email = user.get("email") or self.backend.generate_email(telegram_user_id, username)
+            credentials = {"email": email, "password": self.backend.generate_password()}
+            await self._save_credentials(telegram_user_id, credentials["email"], credentials["password"])
+        email, password = credentials["email"], credentials["password"]
+        try:
+            registration = await self._retry("register", lambda: self.backend.register(
+                email=email,
+                password=password,
+                business_type=user.get("business_type") or "other",
+                telegram_username=username,
+                full_name=names["full_name"],
+            ))
+        except StepFailed:
+            raise
+        except Exception as e:
+            # register сообщает о существующем аккаунте исключением (400/409). Если аккаунт создан
+            # прошлой попыткой с этими учетными данными, вход вернет его
+            registration = await self.backend.login(email, password)
+            if not registration or registration.get("user_id") is None:
+                if user.get("email"):
+                    return ProvisionResult(telegram_user_id, "conflict", error=str(e)[:200])
+                # Сгенерированный email занят, а войти не удалось — повторный запуск попробует снова
+                raise StepFailed(f"account {email} exists and login with saved credentials failed") from None
+
+        backend_user_id = registration.get("user_id")
+        # Учетные данные сохраняются и при неудачном связывании: повторный запуск только свяжет
+        self._pending[telegram_user_id] = {
+            "backend_user_id": backend_user_id,
+            "token": registration.get("token"),
+            "email": email,
+            "password": password,
+            "telegram_username": username,
+        }
+        await self._retry("link", lambda: self.backend.link_telegram_user(telegram_user_id, backend_user_id))
+        return ProvisionResult(telegram_user_id, "registered", backend_user_id)
+
+    async def _provision_one(self, user: Dict[str, Any]) -> None:
+        try:
+            result = await self.provision(user)
+        except Exception as e:
+            if not isinstance(e, StepFailed):
+                logger.exception("Provisioning %s failed: %s", user["telegram_user_id"], e)
+            result = ProvisionResult(user["telegram_user_id"], "failed", error=str(e)[:200])
+        self.counts[result.status] += 1
+        self._results.append(result)
+        if len(self._results) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Записывает накопленные результаты в хранилище, затем в checkpoint"""
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            results, self._results = self._results, []
+            if not results:
+                return
+            await self.storage.set_many(pending)
+            with open(self.checkpoint_file, "ab") as f:
+                f.write(b"".join(dumps(asdict(result)) + b"\n" for result in results))
+                f.flush()
+                os.fsync(f.fileno())
+
+    async def run(self, users: List[Dict[str, Any]]) -> None:
+        queue: asyncio.Queue = asyncio.Queue()
+        for user in users:
+            queue.put_nowait(user)
+
+        async def worker() -> None:
+            while not queue.empty():
+                await self._provision_one(queue.get_nowait())
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(users)))))
+        await self.flush()
+        if not self.counts["failed"]:
+            # Учетные данные всех пользователей уже в хранилище
+            self.credentials_file.unlink(missing_ok=True)
+
+
+def _open_storage() -> Any:
+    """Хранилище пользователей согласно STATE_BACKEND (без остальных хранилищ бота)"""
+    if settings.state_backend.lower() == "redis":
+        from .redis_state import RedisUserStorage, create_redis
+
+        return RedisUserStorage(create_redis(settings.redis_url), settings.redis_prefix)
+    from .user_storage import UserStorage
+
+    return UserStorage()
+
+
+async def _provision(ns: argparse.Namespace) -> None:
+    checkpoint_file = ns.checkpoint or f"{ns.input}.provision.jsonl"
+    provisioner = Provisioner(
+        BackendClient(),
+        _open_storage(),
+        checkpoint_file,
+        concurrency=ns.concurrency,
+        retries=ns.retries,
+        batch_size=ns.batch_size,
+    )
+    done = provisioner.done_ids()
+    users: Dict[int, Dict[str, Any]] = {}
+    for user in read_users(ns.input):
+        if user["telegram_user_id"] not in done:
+            users.setdefault(user["telegram_user_id"], user)
+    print(f"Users to provision: {len(users)} (already done: {len(done)}), checkpoint: {checkpoint_file}")
+
+    started = time.monotonic()
+    await provisioner.run(list(users.values()))
+    elapsed = time.monotonic() - started
+    print(f"Done in {elapsed:.1f} s ({len(users) / elapsed if elapsed else 0:.1f} users/s)")
+    for status, count in provisioner.counts.most_common():
+        print(f"  {status}: {count}")
+    if provisioner.counts["failed"]:
+        print("Run the same command again to retry failed users.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Register and link a cohort of Telegram users ahead of first contact")
+    parser.add_argument("input", help="CSV with header or JSONL, telegram_user_id is required")
+    parser.add_argument("--concurrency", type=int, default=8, help="users provisioned at once")
+    parser.add_argument("--retries", type=int, default=3, help="retries of a failed step")
+    parser.add_argument("--batch-size", type=int, default=200, help="results written to storage per batch")
+    parser.add_argument("--checkpoint", default="", help="checkpoint JSONL (default: <input>.provision.jsonl)")
+    ns = parser.parse_args()
+    asyncio.run(_provision(ns))
+
+
+if __name__ == "__main__":
+    main()
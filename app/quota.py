@@ -0,0 +1,218 @@
+"""
+Взвешенная квота на запросы к backend/LLM.
+
+RateLimiter считает сообщения поштучно, а реальная стоимость запроса растет с длиной
+промпта и временем генерации. Здесь каждый запрос оплачивается единицами стоимости:
+    при входе     — 1 + длина текста / QUOTA_CHARS_PER_UNIT, документ — QUOTA_DOCUMENT_UNITS
+                    (размер файла в байтах несравним с длиной текста, а его обработка
+                    оплачивается после ответа);
+    после ответа  — токены / QUOTA_TOKENS_PER_UNIT, если backend сообщает usage,
+                    иначе секунды генерации * QUOTA_UNITS_PER_SECOND.
+Траты считаются в скользящем окне 60 секунд (два минутных счетчика с интерполяцией)
+по пользователю и по всему боту.
+
+Пользователь, превысивший свою квоту (или половину своей квоты, когда исчерпана общая),
+не получает отказ: его запрос ждет в очереди низкого приоритета до восстановления квоты
+(не дольше QUOTA_MAX_WAIT_SECONDS), и одновременно обрабатывается ограниченное число
+таких запросов. Ожидание происходит до входа в полосу, поэтому места в медленной полосе
+остаются тем, кто в квоту укладывается.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from .lanes import SLOW, Lane, classify_update
+from .logger import logger
+
+WINDOW_SECONDS = 60
+GLOBAL_KEY = "*"
+# Как часто перепроверять квоту при ожидании, секунды
+_POLL_INTERVAL = 1.0
+
+
+def _window(now: float) -> Tuple[int, float]:
+    """Номер текущего окна и доля прошедшего в нем времени"""
+    return int(now // WINDOW_SECONDS), (now % WINDOW_SECONDS) / WINDOW_SECONDS
+
+
+class QuotaCounter:
+    """Минутные счетчики стоимости в памяти процесса"""
+
+    def __init__(self):
+        # ключ -> (номер окна, траты в окне, траты в предыдущем окне)
+        self._counters: Dict[str, Tuple[int, float, float]] = {}
+        self._purged_window = 0
+
+    def _roll(self, key: str, window: int) -> Tuple[float, float]:
+        stored = self._counters.get(key)
+        if stored is None:
+            return 0.0, 0.0
+        stored_window, current, previous = stored
+        if stored_window == window:
+            return current, previous
+        if stored_window == window - 1:
+            return 0.0, current
+        return 0.0, 0.0
+
+    async def charge(self, keys: List[str], cost: float) -> None:
+        window, _ = _window(time.time())
+        if window != self._purged_window:
+            self._purge(window)
+        for key in keys:
+            current, previous = self._roll(key, window)
+            self._counters[key] = (window, current + cost, previous)
+
+    async def usage(self, keys: List[str]) -> List[float]:
+        """Траты за последние 60 секунд по каждому ключу"""
+        window, elapsed = _window(time.time())
+        result = []
+        for key in keys:
+            current, previous = self._roll(key, window)
+            result.append(current + previous * (1 - elapsed))
+        return result
+
+    def _purge(self, window: int) -> None:
+        """Удаляет счетчики пользователей, не тративших ничего два окна подряд"""
+        for key in [k for k, (w, _, _) in self._counters.items() if w < window - 1]:
+            del self._counters[key]
+        self._purged_window = window
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class WeightedQuota:
+    def __init__(
+        self,
+        counter: Any,
+        user_budget: float,
+        global_budget: float,
+        chars_per_unit: int = 500,
+        document_units: float = 10.0,
+        units_per_second: float = 1.0,
+        tokens_per_unit: int = 250,
+        max_wait_seconds: float = 120.0,
+        low_priority_concurrency: int = 2,
+    ):
+        self.counter = counter
+        self.user_budget = user_budget
+        self.global_budget = global_budget
+        self.chars_per_unit = chars_per_unit
+        self.document_units = document_units
+        self.units_per_second = units_per_second
+        self.tokens_per_unit = tokens_per_unit
+        self.max_wait_seconds = max_wait_seconds
+        self._low_priority = Lane("low_priority", low_priority_concurrency)
+        self.waiting = 0
+        self.deferred = 0
+        self.rejected = 0
+
+    def input_cost(self, chars: int) -> float:
+        return 1 + chars / self.chars_per_unit
+
+    def reply_cost(self, seconds: float, tokens: Optional[int] = None) -> float:
+        if tokens is not None:
+            return tokens / self.tokens_per_unit
+        return seconds * self.units_per_second
+
+    async def is_heavy(self, user_id: int) -> bool:
+        """Пользователь сейчас обслуживается с низким приоритетом"""
+        user_used, global_used = await self.counter.usage([str(user_id), GLOBAL_KEY])
+        if user_used >= self.user_budget:
+            return True
+        return global_used >= self.global_budget and user_used >= self.user_budget / 2
+
+    async def wait_for_budget(self, user_id: int) -> float:
+        """Ждет, пока пользователь снова уложится в квоту. QuotaExceeded по истечении ожидания."""
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            while await self.is_heavy(user_id):
+                if time.monotonic() - started >= self.max_wait_seconds:
+                    self.rejected += 1
+                    raise QuotaExceeded()
+                await asyncio.sleep(_POLL_INTERVAL)
+        finally:
+            self.waiting -= 1
+        return time.monotonic() - started
+
+    async def charge(self, user_id: int, cost: float) -> None:
+        try:
+            await self.counter.charge([str(user_id), GLOBAL_KEY], cost)
+        except Exception as e:
+            # Недоступный счетчик не должен останавливать обработку: запрос просто не учтется
+            logger.warning("Quota charge failed for user %s: %s", user_id, e)
+
+    def low_priority_slot(self) -> Lane:
+        return self._low_priority
+
+
+def _request_cost(update: Update, quota: WeightedQuota) -> Optional[float]:
+    """Стоимость запроса к LLM при входе; None — обновление квотой не облагается"""
+    message = update.message
+    if message is None or classify_update(update) != SLOW:
+        return None
+    if message.document is not None:
+        return quota.document_units
+    if message.text and not message.text.startswith("/"):
+        return quota.input_cost(len(message.text))
+    return None
+
+
+class QuotaMiddleware(BaseMiddleware):
+    """
+    Outer-middleware для dp.update (до полос): сообщения пользователей сверх квоты
+    ждут восстановления квоты и обрабатываются с ограниченной параллельностью.
+    is_exempt(update) — обновление не идет в LLM (например, ввод пароля) и квотой не облагается.
+    """
+
+    def __init__(self, quota: WeightedQuota, is_exempt: Optional[Callable[[Update], Awaitable[bool]]] = None):
+        self.quota = quota
+        self.is_exempt = is_exempt
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        cost = _request_cost(event, self.quota)
+        user = event.message.from_user if event.message is not None else None
+        if cost is None or user is None:
+            return await handler(event, data)
+        if self.is_exempt is not None and await self.is_exempt(event):
+            return await handler(event, data)
+
+        try:
+            heavy = await self.quota.is_heavy(user.id)
+        except Exception as e:
+            logger.warning("Quota check failed for user %s: %s", user.id, e)
+            return await handler(event, data)
+        if not heavy:
+            await self.quota.charge(user.id, cost)
+            return await handler(event, data)
+
+        self.quota.deferred += 1
+        logger.info("User %s is over quota, deferring update %s", user.id, event.update_id)
+        try:
+            await event.message.answer("⏳ Вы отправили много больших запросов. Ответ придет чуть позже.")
+        except Exception as e:
+            logger.warning("Failed to notify user about quota: %s", e)
+        try:
+            await self.quota.wait_for_budget(user.id)
+        except QuotaExceeded:
+            try:
+                await event.message.answer("Превышен лимит запросов. Попробуйте позже.")
+            except Exception as e:
+                logger.warning("Failed to notify user about quota: %s", e)
+            return None
+        except Exception as e:
+            logger.warning("Quota check failed for user %s: %s", user.id, e)
+            return await handler(event, data)
+        async with self.quota.low_priority_slot():
+            await self.quota.charge(user.id, cost)
+            return await handler(event, data)
@@ -7,7 +7,7 @@ class RateLimiter:
         self.per_minute = per_minute
         self._hits: Dict[int, Deque[float]] = {}
 
-    def allow(self, user_id: int) -> bool:
+    async def allow(self, user_id: int) -> bool:
         now = time.time()
         window_start = now - 60
         q = self._hits.setdefault(user_id, deque())
@@ -0,0 +1,287 @@
+"""
+Запись реального трафика для воспроизведения (см. app/replay.py).
+
+При RECORD_FILE в append-only JSONL-файл пишутся записи трех видов:
+    {"kind": "update",  "ts": ..., "update": {...}}                  — входящее обновление Telegram
+    {"kind": "backend", "ts": ..., "update_id": ..., "method", "path", "query", "body",
+                        "status", "response", "latency"}             — запрос к backend и ответ
+    {"kind": "output",  "ts": ..., "update_id": ..., "method", "chat_id", "digest", "latency"}
+                                                                     — вызов Bot API из обработчика
+
+Данные обезличиваются при записи:
+- Telegram id пользователей и чатов заменяются стабильным хэшем с солью (RECORD_SALT);
+  те же id в путях и телах запросов к backend заменяются тем же хэшем. Без соли id
+  восстанавливаются перебором, поэтому при пустом RECORD_SALT генерируется случайная соль
+  и хранится отдельно от записи в <RECORD_FILE>.salt (права 0600) — записи разных запусков
+  в тот же файл остаются сопоставимыми. Передавая запись, файл соли не передавайте;
+- имена, username, email, пароли и токены удаляются;
+- текст шагов входа (email и пароль после /login) заменяется маской «***» независимо
+  от RECORD_REDACT_TEXT — не сохраняется даже его длина;
+- при RECORD_REDACT_TEXT тексты заменяются строкой той же длины и структуры
+  (буквы -> "x", цифры -> "0", пунктуация и разметка сохраняются), поэтому распределение
+  размеров сообщений и историй остается реальным.
+Ответы бота сохраняются только как digest обезличенного текста — для сравнения при replay.
+"""
+import hashlib
+import os
+import re
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, IO, Iterator, Optional, Set
+
+import httpx
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+
+from .codec import dumps, loads
+from .config import settings
+from .lanes import FAST_TEXTS
+from .logger import logger
+
+_current_update: ContextVar[Optional[int]] = ContextVar("recorded_update", default=None)
+
+# Поля с персональными данными: удаляются (first_name обязателен в User — заменяется)
+_DROP_KEYS = {"last_name", "full_name", "username", "telegram_username", "phone_number", "language_code"}
+# Секреты: заменяются маской
+_SECRET_KEYS = {"password", "token", "email", "access_token", "refresh_token"}
+# Текстовые поля: обезличиваются с сохранением длины
+_TEXT_KEYS = {"text", "caption", "message", "response", "content", "answer", "title", "name", "file_name"}
+# Поля с Telegram id
+_ID_KEYS = {"telegram_user_id", "chat_id"}
+_ID_OBJECTS = {"from", "chat", "user", "sender_chat"}
+
+_LETTERS = re.compile(r"[^\W\d_]")
+_DIGITS = re.compile(r"\d")
+
+
+@contextmanager
+def update_context(update_id: int) -> Iterator[None]:
+    """Помечает запросы к backend и вызовы Bot API внутри блока этим update_id"""
+    token = _current_update.set(update_id)
+    try:
+        yield
+    finally:
+        _current_update.reset(token)
+
+
+def current_update_id() -> Optional[int]:
+    return _current_update.get()
+
+
+def redact_text(text: str) -> str:
+    """
+    Заменяет буквы и цифры, сохраняя длину, пробелы, пунктуацию и разметку.
+    Команды (/start ...) и тексты кнопок сохраняются — от них зависит маршрутизация.
+    """
+    if text in FAST_TEXTS:
+        return text
+    command = ""
+    if text.startswith("/"):
+        command, _, text = text.partition(" ")
+        command += " " if text else ""
+    return command + _DIGITS.sub("0", _LETTERS.sub("x", text))
+
+
+def text_digest(text: Optional[str]) -> Optional[str]:
+    """Digest ответа бота, сравнимый между записью и replay"""
+    if text is None:
+        return None
+    return hashlib.blake2b(redact_text(text).encode(), digest_size=8).hexdigest()
+
+
+class TrafficRecorder:
+    def __init__(self, path: str = "", salt: str = "", redact: bool = True):
+        self.path = path
+        if path and not salt:
+            salt = self._load_salt()
+        self.salt = salt.encode()
+        self.redact = redact
+        self._file: Optional[IO[bytes]] = None
+        # Реальные Telegram id, встреченные в обновлениях (для обезличивания запросов к backend)
+        self._telegram_ids: Set[int] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _load_salt(self) -> str:
+        """Соль записи из файла рядом с ней; при первом запуске генерируется"""
+        salt_file = f"{self.path}.salt"
+        try:
+            with open(salt_file, "r", encoding="utf-8") as f:
+                salt = f.read().strip()
+            if salt:
+                return salt
+        except FileNotFoundError:
+            pass
+        salt = secrets.token_hex(32)
+        fd = os.open(salt_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(salt + "\n")
+        logger.warning("RECORD_SALT is not set, generated a random salt in %s (do not share it with the recording)", salt_file)
+        return salt
+
+    # --- обезличивание ---
+
+    def hash_id(self, value: int) -> int:
+        digest = hashlib.blake2b(str(value).encode(), key=self.salt[:64], digest_size=6).digest()
+        return int.from_bytes(digest, "big")
+
+    def _sanitize(self, value: Any, key: Optional[str] = None, id_context: bool = False) -> Any:
+        if isinstance(value, dict):
+            result = {}
+            for k, v in value.items():
+                if k in _DROP_KEYS:
+                    continue
+                if k == "first_name":
+                    result[k] = "User"
+                    continue
+                if k in _SECRET_KEYS and v is not None:
+                    result[k] = "***"
+                    continue
+                if k in _ID_KEYS or (id_context and k == "id"):
+                    # В объектах from/chat/user поле id — Telegram id
+                    result[k] = self._sanitize_id(v)
+                else:
+                    result[k] = self._sanitize(v, k, id_context=k in _ID_OBJECTS)
+            return result
+        if isinstance(value, list):
+            return [self._sanitize(v, key) for v in value]
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int):
+            return self.hash_id(value) if value in self._telegram_ids else value
+        if isinstance(value, str):
+            if key in _TEXT_KEYS and self.redact:
+                return redact_text(value)
+            if value.lstrip("-").isdigit() and int(value) in self._telegram_ids:
+                return str(self.hash_id(int(value)))
+            return value
+        return value
+
+    def _sanitize_id(self, value: Any) -> Any:
+        if isinstance(value, bool) or not isinstance(value, int):
+            return value
+        self._telegram_ids.add(value)
+        return self.hash_id(value)
+
+    def _sanitize_path(self, path: str) -> str:
+        parts = path.split("/")
+        for i, part in enumerate(parts):
+            if part.lstrip("-").isdigit() and int(part) in self._telegram_ids:
+                parts[i] = str(self.hash_id(int(part)))
+        return "/".join(parts)
+
+    # --- запись ---
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        record["ts"] = time.time()
+        self._file.write(dumps(record) + b"\n")
+
+    def flush(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def record_update(self, update: Update, secret: bool = False) -> None:
+        """secret — текст сообщения содержит учетные данные и заменяется маской"""
+        data = self._sanitize(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+        if secret and "text" in data.get("message", {}):
+            data["message"]["text"] = "***"
+        self._write({"kind": "update", "update": data})
+
+    async def record_backend(self, response: httpx.Response) -> None:
+        await response.aread()
+        request = response.request
+        body = loads(request.content) if request.content else None
+        try:
+            payload = loads(response.content) if response.content else None
+        except Exception:
+            payload = response.text
+        self._write({
+            "kind": "backend",
+            "update_id": _current_update.get(),
+            "method": request.method,
+            "path": self._sanitize_path(request.url.path),
+            "query": self._sanitize(dict(request.url.params)),
+            "body": self._sanitize(body),
+            "status": response.status_code,
+            "response": self._sanitize(payload),
+            "latency": response.elapsed.total_seconds(),
+        })
+
+    def record_output(self, method: TelegramMethod, latency: float) -> None:
+        chat_id = getattr(method, "chat_id", None)
+        text = getattr(method, "text", None) or getattr(method, "caption", None)
+        self._write({
+            "kind": "output",
+            "update_id": _current_update.get(),
+            "method": type(method).__name__,
+            "chat_id": self.hash_id(chat_id) if isinstance(chat_id, int) else chat_id,
+            "digest": text_digest(text),
+            "latency": latency,
+        })
+
+
+class RecorderMiddleware(BaseMiddleware):
+    """
+    Outer-middleware для dp.update: записывает обновление и помечает записи его update_id.
+    is_secret(update) — текст обновления содержит учетные данные (см. TrafficRecorder.record_update).
+    """
+
+    def __init__(self, recorder: TrafficRecorder, is_secret: Optional[Callable[[Update], Awaitable[bool]]] = None):
+        self.recorder = recorder
+        self.is_secret = is_secret
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        try:
+            secret = self.is_secret is not None and await self.is_secret(event)
+            self.recorder.record_update(event, secret=secret)
+        except Exception as e:
+            logger.warning("Failed to record update %s: %s", event.update_id, e)
+        try:
+            with update_context(event.update_id):
+                return await handler(event, data)
+        finally:
+            self.recorder.flush()
+
+
+class RecorderRequestMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot API: записывает исходящие вызовы обработчиков"""
+
+    def __init__(self, recorder: TrafficRecorder):
+        self.recorder = recorder
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        started = time.monotonic()
+        response = await make_request(bot, method)
+        if _current_update.get() is not None:
+            try:
+                self.recorder.record_output(method, time.monotonic() - started)
+            except Exception as e:
+                logger.warning("Failed to record output: %s", e)
+        return response
+
+
+recorder = TrafficRecorder(settings.record_file, salt=settings.record_salt, redact=settings.record_redact_text)
@@ -0,0 +1,277 @@
+"""
+Хранилища состояния поверх протокола Redis для нескольких реплик бота.
+
+Все составные операции выполняются в MULTI/EXEC-пайплайнах (при необходимости с WATCH),
+поэтому они атомарны и работают как с настоящим Redis, так и со встроенным стенд-ином
+(app/resp_server.py).
+
+Схема ключей (prefix — REDIS_PREFIX):
+    {prefix}rl:{telegram_user_id}     ZSET   — отметки запросов за последние 60 секунд
+    {prefix}user:{telegram_user_id}   HASH   — запись пользователя (поля как в UserStorage)
+    {prefix}users                     ZSET   — индекс telegram_user_id (score = id)
+    {prefix}state:{telegram_user_id}  STRING — временное состояние пользователя с TTL
+    {prefix}dedup:{key}               STRING — уже обработанное обновление (SET NX EX)
+    {prefix}quota:{key}:{window}      STRING — траты взвешенной квоты за минутное окно
+"""
+import secrets
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
+
+from .quota import WINDOW_SECONDS as QUOTA_WINDOW_SECONDS
+from .user_storage import COLD_FIELDS
+
+# Повторы проверки лимита сверх per_minute: каждый конфликт WATCH означает запись другой
+# реплики, а успешных записей в окне не больше per_minute
+_RATE_LIMIT_EXTRA_ATTEMPTS = 10
+
+# Поля записи пользователя, которые хранятся как целые числа
+_INT_FIELDS = ("backend_user_id",)
+
+
+def create_redis(url: str) -> Redis:
+    """Создает клиент с общим пулом соединений (RESP2 — поддерживается любым сервером)"""
+    return Redis.from_url(url, decode_responses=True, protocol=2)
+
+
+def _decode_user(raw: Dict[str, str]) -> Optional[Dict]:
+    if not raw:
+        return None
+    user_data: Dict = dict(raw)
+    for field in _INT_FIELDS:
+        value = user_data.get(field)
+        if value is not None and value.lstrip("-").isdigit():
+            user_data[field] = int(value)
+    return user_data
+
+
+class RedisRateLimiter:
+    """Скользящее окно в 60 секунд на ZSET, общее для всех реплик"""
+
+    def __init__(self, redis: Redis, prefix: str, per_minute: int = 20):
+        self._redis = redis
+        self._prefix = prefix
+        self.per_minute = per_minute
+
+    async def allow(self, user_id: int) -> bool:
+        """
+        Проверка и запись отметки атомарны (WATCH/MULTI): отметка добавляется, только если
+        окно не заполнено, поэтому отклоненные запросы не видны другим репликам.
+        """
+        key = f"{self._prefix}rl:{user_id}"
+        async with self._redis.pipeline(transaction=True) as pipe:
+            for _ in range(self.per_minute + _RATE_LIMIT_EXTRA_ATTEMPTS):
+                now = time.time()
+                try:
+                    await pipe.watch(key)
+                    count = await pipe.zcount(key, now - 60, "+inf")
+                    if count >= self.per_minute:
+                        await pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    pipe.zremrangebyscore(key, "-inf", now - 60)
+                    pipe.zadd(key, {f"{now:.6f}:{secrets.token_hex(4)}": now})
+                    pipe.pexpire(key, 60_000)
+                    await pipe.execute()
+                    return True
+                except WatchError:
+                    # Окно изменила другая реплика между проверкой и записью — проверяем заново
+                    continue
+        return False
+
+
+class RedisUserStorage:
+    """Аналог UserStorage: одна HASH-запись на пользователя"""
+
+    def __init__(self, redis: Redis, prefix: str):
+        self._redis = redis
+        self._prefix = prefix
+
+    def _key(self, telegram_user_id: int) -> str:
+        return f"{self._prefix}user:{telegram_user_id}"
+
+    async def get(self, telegram_user_id: int) -> Optional[Dict]:
+        """Получает данные пользователя"""
+        return _decode_user(await self._redis.hgetall(self._key(telegram_user_id)))
+
+    async def get_many(self, telegram_user_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Получает данные нескольких пользователей одним пайплайном"""
+        ids = list(telegram_user_ids)
+        if not ids:
+            return {}
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for telegram_user_id in ids:
+                pipe.hgetall(self._key(telegram_user_id))
+            rows = await pipe.execute()
+        result: Dict[int, Dict] = {}
+        for telegram_user_id, raw in zip(ids, rows):
+            user_data = _decode_user(raw)
+            if user_data is not None:
+                result[telegram_user_id] = user_data
+        return result
+
+    async def set(
+        self,
+        telegram_user_id: int,
+        backend_user_id: Optional[int] = None,
+        token: Optional[str] = None,
+        email: Optional[str] = None,
+        password: Optional[str] = None,
+        telegram_username: Optional[str] = None,
+        conversation_id: Optional[str] = None,
+    ) -> None:
+        """Сохраняет данные пользователя (None-поля не меняются)"""
+        fields = {
+            "backend_user_id": backend_user_id,
+            "token": token,
+            "email": email,
+            "password": password,
+            "telegram_username": telegram_username,
+            "conversation_id": conversation_id,
+        }
+        mapping = {k: str(v) for k, v in fields.items() if v is not None}
+        async with self._redis.pipeline(transaction=True) as pipe:
+            if mapping:
+                pipe.hset(self._key(telegram_user_id), mapping=mapping)
+            pipe.zadd(f"{self._prefix}users", {str(telegram_user_id): telegram_user_id})
+            await pipe.execute()
+
+    async def set_many(self, users: Dict[int, Dict]) -> None:
+        """Сохраняет данные многих пользователей (поля как в set) одним пайплайном"""
+        if not users:
+            return
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for telegram_user_id, fields in users.items():
+                mapping = {k: str(v) for k, v in fields.items() if v is not None}
+                if mapping:
+                    pipe.hset(self._key(telegram_user_id), mapping=mapping)
+            pipe.zadd(f"{self._prefix}users", {str(telegram_user_id): telegram_user_id for telegram_user_id in users})
+            await pipe.execute()
+
+    async def delete(self, telegram_user_id: int) -> None:
+        """Удаляет пользователя и его запись в индексе"""
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._key(telegram_user_id))
+            pipe.zrem(f"{self._prefix}users", str(telegram_user_id))
+            await pipe.execute()
+
+    async def iter_user_ids(self, after: Optional[int] = None, batch_size: int = 500) -> AsyncIterator[List[int]]:
+        """Отдает telegram_user_id по возрастанию страницами из индекса, не загружая его целиком"""
+        low = f"({after}" if after is not None else "-inf"
+        while True:
+            page = await self._redis.zrangebyscore(
+                f"{self._prefix}users", low, "+inf", start=0, num=batch_size
+            )
+            if not page:
+                return
+            ids = [int(member) for member in page]
+            yield ids
+            low = f"({ids[-1]}"
+
+    async def has_user(self, telegram_user_id: int) -> bool:
+        """Проверяет, зарегистрирован ли пользователь"""
+        return bool(await self._redis.hexists(self._key(telegram_user_id), "token"))
+
+    async def get_credentials(self, telegram_user_id: int) -> Dict[str, str]:
+        """token, email и password пользователя"""
+        values = await self._redis.hmget(self._key(telegram_user_id), list(COLD_FIELDS))
+        return {field: value for field, value in zip(COLD_FIELDS, values) if value is not None}
+
+    async def get_token(self, telegram_user_id: int) -> Optional[str]:
+        """Получает токен пользователя"""
+        return await self._redis.hget(self._key(telegram_user_id), "token")
+
+    async def get_backend_user_id(self, telegram_user_id: int) -> Optional[int]:
+        """Получает backend user_id"""
+        value = await self._redis.hget(self._key(telegram_user_id), "backend_user_id")
+        if value is None:
+            return None
+        return int(value) if value.lstrip("-").isdigit() else value
+
+    async def get_conversation_id(self, telegram_user_id: int) -> Optional[str]:
+        """Получает текущий conversation_id"""
+        return await self._redis.hget(self._key(telegram_user_id), "conversation_id")
+
+    async def set_conversation_id(self, telegram_user_id: int, conversation_id: Optional[str]) -> None:
+        """Устанавливает текущий conversation_id. None сбрасывает текущий разговор."""
+        if conversation_id is None:
+            await self._redis.hdel(self._key(telegram_user_id), "conversation_id")
+            return
+        await self.set(telegram_user_id=telegram_user_id, conversation_id=str(conversation_id))
+
+
+class RedisUserStates:
+    """Временные состояния пользователей с истечением по TTL"""
+
+    def __init__(self, redis: Redis, prefix: str, ttl_seconds: int = 3600):
+        self._redis = redis
+        self._prefix = prefix
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, telegram_user_id: int) -> str:
+        return f"{self._prefix}state:{telegram_user_id}"
+
+    async def get(self, telegram_user_id: int) -> Optional[str]:
+        return await self._redis.get(self._key(telegram_user_id))
+
+    async def set(self, telegram_user_id: int, state: str) -> None:
+        await self._redis.set(self._key(telegram_user_id), state, ex=self.ttl_seconds)
+
+    async def pop(self, telegram_user_id: int) -> Optional[str]:
+        key = self._key(telegram_user_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.get(key)
+            pipe.delete(key)
+            value, _ = await pipe.execute()
+        return value
+
+
+class RedisDedupStore:
+    """Аналог DedupStore: ключи обновлений с TTL, общие для всех реплик"""
+
+    def __init__(self, redis: Redis, prefix: str, ttl_seconds: int = 86400):
+        self._redis = redis
+        self._prefix = prefix
+        self.ttl_seconds = ttl_seconds
+        self.duplicates = 0
+
+    async def claim(self, keys: List[str]) -> bool:
+        """Отмечает ключи обработанными. False, если хотя бы один уже встречался."""
+        async with self._redis.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.set(f"{self._prefix}dedup:{key}", "1", nx=True, ex=self.ttl_seconds)
+            results = await pipe.execute()
+        if all(results):
+            return True
+        self.duplicates += 1
+        return False
+
+
+class RedisQuotaCounter:
+    """Аналог QuotaCounter: минутные счетчики INCRBYFLOAT, общие для всех реплик"""
+
+    def __init__(self, redis: Redis, prefix: str):
+        self._redis = redis
+        self._prefix = prefix
+
+    def _key(self, key: str, window: int) -> str:
+        return f"{self._prefix}quota:{key}:{window}"
+
+    async def charge(self, keys: List[str], cost: float) -> None:
+        window = int(time.time() // QUOTA_WINDOW_SECONDS)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.incrbyfloat(self._key(key, window), cost)
+                pipe.expire(self._key(key, window), 2 * QUOTA_WINDOW_SECONDS)
+            await pipe.execute()
+
+    async def usage(self, keys: List[str]) -> List[float]:
+        """Траты за последние 60 секунд по каждому ключу"""
+        now = time.time()
+        window = int(now // QUOTA_WINDOW_SECONDS)
+        elapsed = (now % QUOTA_WINDOW_SECONDS) / QUOTA_WINDOW_SECONDS
+        names = [self._key(key, w) for key in keys for w in (window, window - 1)]
+        values = [float(v or 0) for v in await self._redis.mget(names)]
+        return [values[i] + values[i + 1] * (1 - elapsed) for i in range(0, len(values), 2)]
@@ -0,0 +1,193 @@
+"""
+Подготовка текста к отправке в Telegram: очистка Markdown ответа LLM, форматирование истории
+разговора и разбиение на сообщения.
+
+Все это чистый CPU: на ответе в сотни килобайт или истории из сотен сообщений
+форматирование занимает десятки миллисекунд и останавливает event loop — обновления
+остальных чатов ждут. Renderer выполняет небольшие тексты сразу, а больше
+RENDER_OFFLOAD_CHARS символов — в пуле (RENDER_POOL: thread или process):
+    - в пуле одновременно не больше RENDER_WORKERS + RENDER_QUEUE_SIZE задач,
+      остальные ждут места, не занимая event loop;
+    - результаты кэшируются по хэшу содержимого (RENDER_CACHE_SIZE последних), одинаковый
+      текст, запрошенный одновременно (повторное открытие истории), форматируется один раз.
+
+В потоке форматирование делит GIL с event loop, но loop получает его каждые
+sys.getswitchinterval() (5 мс); процесс изолирует полностью ценой копирования текста.
+Замер задержки event loop: python -m app.bench_render.
+"""
+import asyncio
+import contextvars
+import hashlib
+import multiprocessing
+import re
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .history_export import history_title, speaker_name
+from .schemas import HistoryMessage
+
+# Максимальная длина одного сообщения (ограничение Telegram — 4096 символов, с запасом)
+MESSAGE_LIMIT = 4000
+
+
+def clean_markdown(text: str) -> str:
+    """Убирает из ответа LLM разметку Markdown, которую Telegram не покажет"""
+    lines = text.splitlines()
+    cleaned: list[str] = []
+    for line in lines:
+        line = re.sub(r"^\s{0,3}#{1,6}\s*", "", line)
+        line = re.sub(r"^\s{0,3}[-*]\s+", "• ", line)
+        line = re.sub(r"^\s{0,3}>\s?", "", line)
+        line = line.replace("**", "").replace("__", "").replace("*", "")
+        line = line.replace("```", "").replace("`", "")
+        cleaned.append(line)
+    result = "\n".join(cleaned)
+    result = re.sub(r"\n{3,}", "\n\n", result).strip()
+    return result
+
+
+def format_history(history: List[HistoryMessage]) -> str:
+    """Текст истории для отправки сообщениями"""
+    parts = ["📜 История разговора:\n\n"]
+    title = history_title(history)
+    if title:
+        parts.append(f"**{title}**\n\n")
+    for msg in history:
+        parts.append(f"{speaker_name(msg.role)}:\n{msg.content}\n\n")
+    return "".join(parts)
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Части не длиннее limit; разрез по возможности на переводе строки во второй половине части"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+def render_reply(text: str) -> List[str]:
+    """Ответ LLM: очистка разметки и разбиение на сообщения"""
+    return split_message(clean_markdown(text))
+
+
+def render_history(history: List[HistoryMessage]) -> List[str]:
+    """История разговора: форматирование и разбиение на сообщения"""
+    return split_message(format_history(history))
+
+
+def _history_digest(history: List[HistoryMessage]) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for msg in history:
+        for value in (msg.role, msg.title or "", msg.content):
+            data = value.encode("utf-8", "surrogatepass")
+            # Длина перед значением: ("ab", "c") и ("a", "bc") дают разные хэши
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+    return digest.digest()
+
+
+class Renderer:
+    def __init__(
+        self,
+        offload_chars: int = 20000,
+        pool: str = "thread",
+        workers: int = 1,
+        queue_size: int = 16,
+        cache_size: int = 128,
+    ):
+        if pool not in ("thread", "process"):
+            raise ValueError(f"Unsupported render pool: {pool}")
+        self.offload_chars = offload_chars
+        self.pool = pool
+        self.workers = workers
+        self.cache_size = cache_size
+        self._slots = asyncio.Semaphore(workers + queue_size)
+        self._executor: Optional[Executor] = None
+        # (вид, хэш содержимого) -> части
+        self._cache: "OrderedDict[Tuple[str, bytes], List[str]]" = OrderedDict()
+        # Рендеринг в процессе: одинаковые запросы ждут один результат
+        self._running: Dict[Tuple[str, bytes], asyncio.Task] = {}
+        self.inline = 0
+        self.offloaded = 0
+        self.cache_hits = 0
+        self.waited = 0
+
+    async def reply(self, text: str) -> List[str]:
+        """Ответ LLM, готовый к отправке сообщениями"""
+        if len(text) < self.offload_chars:
+            self.inline += 1
+            return render_reply(text)
+        key = ("reply", hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest())
+        return await self._render(key, render_reply, text)
+
+    async def history(self, history: List[HistoryMessage]) -> List[str]:
+        """История разговора, готовая к отправке сообщениями"""
+        if sum(len(msg.content) for msg in history) < self.offload_chars:
+            self.inline += 1
+            return render_history(history)
+        return await self._render(("history", _history_digest(history)), render_history, history)
+
+    async def _render(self, key: Tuple[str, bytes], render: Callable[[Any], List[str]], arg: Any) -> List[str]:
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return list(cached)
+        task = self._running.get(key)
+        if task is None:
+            # Пустой контекст: результат нужен всем ожидающим, а не только обновлению, которое его начало
+            task = asyncio.create_task(
+                self._offload(key, render, arg), name=f"render-{key[0]}", context=contextvars.Context()
+            )
+            self._running[key] = task
+            task.add_done_callback(lambda _: self._running.pop(key, None))
+        else:
+            self.cache_hits += 1
+        return list(await asyncio.shield(task))
+
+    async def _offload(self, key: Tuple[str, bytes], render: Callable[[Any], List[str]], arg: Any) -> List[str]:
+        if self._slots.locked():
+            self.waited += 1
+        async with self._slots:
+            self.offloaded += 1
+            parts = await asyncio.get_running_loop().run_in_executor(self._get_executor(), render, arg)
+        self._cache[key] = parts
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return parts
+
+    def start(self) -> None:
+        """Поднимает пул процессов заранее, при запуске бота"""
+        if self.pool == "process":
+            self._get_executor().submit(render_reply, "")
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.pool == "process":
+                # fork, а не spawn: spawn заново импортировал бы в каждом процессе главный модуль (app.bot)
+                # со всем состоянием бота. Процессы создаются в start(), пока других потоков еще нет
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="render")
+        return self._executor
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            "inline": self.inline,
+            "offloaded": self.offloaded,
+            "cache_hits": self.cache_hits,
+            "waited": self.waited,
+            "cached": len(self._cache),
+        }
@@ -0,0 +1,229 @@
+"""
+Воспроизведение записанного трафика (app/recorder.py) для проверки производительности.
+
+    python -m app.replay traffic.jsonl --speed 1     # в записанном темпе
+    python -m app.replay traffic.jsonl --speed 10    # в 10 раз быстрее
+    python -m app.replay traffic.jsonl --speed max   # без пауз между обновлениями
+
+Обновления подаются в тот же Dispatcher, что и в боте (create_dispatcher), с исходными
+интервалами, деленными на speed. Запросы к backend обслуживаются из записи: ответ ищется
+по методу, пути, query и телу запроса (или только по методу и пути, если точного совпадения
+нет) и отдается с записанной задержкой, деленной на speed. Вызовы Bot API перехватываются
+фиктивной сессией, в сеть ничего не уходит.
+
+Отчет: пропускная способность, распределение времени обработки обновлений, обращения
+к backend без записи и расхождения ответов бота с записью (метод и digest текста).
+
+Состояние (пользователи, зеркало истории и т.п.) создается во временном каталоге;
+лимиты по времени (RATE_LIMIT_PER_MINUTE, WEIGHTED_QUOTA) отключаются, т.к. при ускорении
+они срабатывали бы иначе, чем при записи.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import httpx
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetFile, TelegramMethod
+from aiogram.types import Chat, File, Message, Update
+
+from .codec import dumps, loads
+from .diagnostics import percentile
+
+# Вызовы, число которых зависит от темпа, а не от логики (индикатор «печатает…»)
+_TIMING_METHODS = {"SendChatAction"}
+
+
+def _load(path: str) -> List[Dict[str, Any]]:
+    with open(path, "rb") as f:
+        return [loads(line) for line in f if line.strip()]
+
+
+def _request_key(method: str, path: str, query: Any, body: Any) -> Tuple[str, str, bytes, bytes]:
+    return method, path, dumps(query or {}), dumps(body)
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Отдает записанные ответы backend вместо сетевых запросов"""
+
+    def __init__(self, records: List[Dict[str, Any]], speed: Optional[float]):
+        self.speed = speed
+        self._exact: Dict[tuple, Deque[Dict]] = defaultdict(deque)
+        self._loose: Dict[tuple, Deque[Dict]] = defaultdict(deque)
+        for record in records:
+            record["used"] = False
+            self._exact[_request_key(record["method"], record["path"], record.get("query"), record.get("body"))].append(record)
+            self._loose[(record["method"], record["path"])].append(record)
+        self.matched = 0
+        self.loose = 0
+        self.unmatched: List[str] = []
+
+    @staticmethod
+    def _pop(queue: Deque[Dict]) -> Optional[Dict]:
+        while queue:
+            record = queue.popleft()
+            if not record["used"]:
+                record["used"] = True
+                return record
+        return None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = loads(request.content) if request.content else None
+        key = _request_key(request.method, request.url.path, dict(request.url.params), body)
+        record = self._pop(self._exact[key])
+        if record is not None:
+            self.matched += 1
+        else:
+            record = self._pop(self._loose[(request.method, request.url.path)])
+            if record is None:
+                self.unmatched.append(f"{request.method} {request.url.path}")
+                return httpx.Response(503, content=b'{"error": "not recorded"}', request=request)
+            self.loose += 1
+        if self.speed:
+            await asyncio.sleep(record["latency"] / self.speed)
+        content = dumps(record["response"]) if record.get("response") is not None else b""
+        return httpx.Response(record["status"], content=content, request=request)
+
+
+class ReplaySession(BaseSession):
+    """Сессия Bot API без сети: запоминает вызовы и возвращает правдоподобные ответы"""
+
+    def __init__(self):
+        super().__init__()
+        self.outputs: Dict[int, List[Tuple[str, Optional[str]]]] = defaultdict(list)
+        self._message_ids = itertools.count(1)
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True):
+        # Содержимое файлов не записывается
+        return
+        yield b""
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[Any], timeout: Optional[int] = None) -> Any:
+        from .recorder import current_update_id, text_digest
+
+        update_id = current_update_id()
+        if update_id is not None and type(method).__name__ not in _TIMING_METHODS:
+            text = getattr(method, "text", None) or getattr(method, "caption", None)
+            self.outputs[update_id].append((type(method).__name__, text_digest(text)))
+
+        if isinstance(method, GetFile):
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_path=f"replay/{method.file_id}")
+        returning = getattr(method, "__returning__", None)
+        if returning is bool:
+            return True
+        chat_id = getattr(method, "chat_id", None)
+        if returning is Message or (chat_id is not None and "Message" in str(returning)):
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+                text=getattr(method, "text", None),
+            ).as_(bot)
+        return True
+
+
+async def _replay(path: str, speed: Optional[float], concurrency: int) -> None:
+    from . import bot as bot_module
+    from .recorder import update_context
+
+    records = _load(path)
+    updates = [r for r in records if r["kind"] == "update"]
+    backend_records = [r for r in records if r["kind"] == "backend"]
+    expected: Dict[int, List[Tuple[str, Optional[str]]]] = defaultdict(list)
+    for r in records:
+        if r["kind"] == "output" and r.get("update_id") is not None and r["method"] not in _TIMING_METHODS:
+            expected[r["update_id"]].append((r["method"], r["digest"]))
+    if not updates:
+        print("No updates in recording")
+        return
+
+    transport = ReplayTransport(backend_records, speed)
+    bot_module.backend.transport = transport
+    session = ReplaySession()
+    bot = Bot(token="42:replay", session=session)
+    dp = bot_module.create_dispatcher()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def feed(record: Dict[str, Any]) -> None:
+        nonlocal errors
+        update = Update.model_validate(record["update"], context={"bot": bot})
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                with update_context(update.update_id):
+                    await dp.feed_update(bot, update)
+            except Exception as e:
+                errors += 1
+                print(f"update {update.update_id} failed: {e!r}")
+            latencies.append(time.monotonic() - started)
+
+    first_ts = updates[0]["ts"]
+    started = time.monotonic()
+    tasks = []
+    for record in updates:
+        if speed:
+            delay = (record["ts"] - first_ts) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(feed(record)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+
+    diverged = [
+        r["update"]["update_id"]
+        for r in updates
+        if session.outputs.get(r["update"]["update_id"], []) != expected.get(r["update"]["update_id"], [])
+    ]
+    ms = [x * 1000 for x in latencies]
+    print(f"Updates:        {len(updates)} in {elapsed:.2f} s ({len(updates) / max(elapsed, 1e-9):.1f} upd/s)")
+    print(
+        f"Latency, ms:    p50={percentile(ms, 50):.1f} p90={percentile(ms, 90):.1f} "
+        f"p99={percentile(ms, 99):.1f} max={max(ms):.1f}"
+    )
+    print(f"Backend calls:  exact={transport.matched} loose={transport.loose} unmatched={len(transport.unmatched)}")
+    for call in transport.unmatched[:10]:
+        print(f"  unmatched: {call}")
+    print(f"Outputs:        {len(updates) - len(diverged)} match, {len(diverged)} diverge, {errors} errors")
+    for update_id in diverged[:10]:
+        print(f"  update {update_id}: expected {expected.get(update_id, [])}, got {session.outputs.get(update_id, [])}")
+    await bot.session.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded bot traffic against recorded backend responses")
+    parser.add_argument("recording", help="JSONL file written with RECORD_FILE")
+    parser.add_argument("--speed", default="1", help="playback speed multiplier or 'max'")
+    parser.add_argument("--concurrency", type=int, default=64, help="max updates processed at once")
+    ns = parser.parse_args()
+    speed = None if ns.speed == "max" else float(ns.speed)
+
+    path = os.path.abspath(ns.recording)
+    # Изолированное состояние и настройки до импорта модулей бота
+    os.chdir(tempfile.mkdtemp(prefix="replay-"))
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "42:replay",
+        "STATE_BACKEND": "memory",
+        "RECORD_FILE": "",
+        "RATE_LIMIT_PER_MINUTE": "1000000",
+        "WEIGHTED_QUOTA": "false",
+        "TRACE_SAMPLE_RATE": "0",
+    })
+    asyncio.run(_replay(path, speed, ns.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+"""
+Встроенный стенд-ин сервера с протоколом Redis (RESP2) для локальной разработки и проверок.
+
+Поддерживает только подмножество команд, которое используют хранилища бота
+(строки, хэши, sorted set, TTL и транзакции MULTI/EXEC с WATCH). Данные живут в памяти процесса.
+
+Запуск отдельным процессом:
+    python -m app.resp_server --port 6379
+Или внутри теста/скрипта:
+    server = RespServer()
+    await server.start()
+    redis = create_redis(server.url)
+"""
+import argparse
+import asyncio
+import fnmatch
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .logger import logger
+
+
+class RespError(Exception):
+    pass
+
+
+class _WrongType(RespError):
+    def __init__(self):
+        super().__init__("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+def _parse_score(raw: str) -> Tuple[float, bool]:
+    """Возвращает (значение, исключающая граница) для аргументов вида 5, (5, -inf, +inf"""
+    exclusive = raw.startswith("(")
+    if exclusive:
+        raw = raw[1:]
+    if raw in ("-inf", "+inf", "inf"):
+        return (-math.inf if raw == "-inf" else math.inf), exclusive
+    return float(raw), exclusive
+
+
+def _format_score(score: float) -> str:
+    return str(int(score)) if float(score).is_integer() else repr(score)
+
+
+# Команды, которые меняют ключ (для WATCH)
+_WRITE_COMMANDS = frozenset({
+    "SET", "DEL", "PEXPIRE", "EXPIRE", "INCRBYFLOAT", "HSET", "HDEL",
+    "ZADD", "ZREM", "ZREMRANGEBYSCORE", "FLUSHALL", "FLUSHDB",
+})
+
+
+class RespServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self._data: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+        # Номер изменения ключа для WATCH: растет при каждой записи
+        self._versions: Dict[str, int] = {}
+        self._server: Optional[asyncio.base_events.Server] = None
+        self._commands: Dict[str, Callable[[List[str]], Any]] = {
+            name[4:].upper(): getattr(self, name) for name in dir(self) if name.startswith("cmd_")
+        }
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("RESP stand-in server listening on %s:%s", self.host, self.port)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    # --- протокол ---
+
+    async def _read_command(self, reader: asyncio.StreamReader) -> Optional[List[str]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # inline-команда (например, из telnet)
+            return line.decode().split()
+        args: List[str] = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            length = int(header[1:])
+            payload = await reader.readexactly(length + 2)
+            args.append(payload[:-2].decode())
+        return args
+
+    def _encode(self, value: Any) -> bytes:
+        if isinstance(value, RespError):
+            return f"-{value}\r\n".encode()
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, bool):
+            return f":{int(value)}\r\n".encode()
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if isinstance(value, _Status):
+            return f"+{value}\r\n".encode()
+        if isinstance(value, (list, tuple)):
+            return f"*{len(value)}\r\n".encode() + b"".join(self._encode(v) for v in value)
+        data = str(value).encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        queued: Optional[List[List[str]]] = None
+        # WATCH: ключ -> номер изменения на момент WATCH
+        watched: Dict[str, int] = {}
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                name = args[0].upper()
+                if name == "MULTI":
+                    queued = []
+                    reply: Any = OK
+                elif name == "WATCH":
+                    if queued is not None:
+                        reply = RespError("ERR WATCH inside MULTI is not allowed")
+                    else:
+                        watched.update((key, self._versions.get(key, 0)) for key in args[1:])
+                        reply = OK
+                elif name == "UNWATCH":
+                    watched.clear()
+                    reply = OK
+                elif name == "DISCARD":
+                    queued = None
+                    watched.clear()
+                    reply = OK
+                elif name == "EXEC":
+                    if queued is None:
+                        reply = RespError("ERR EXEC without MULTI")
+                    elif any(self._versions.get(key, 0) != version for key, version in watched.items()):
+                        # Наблюдаемый ключ изменился после WATCH — транзакция не выполняется
+                        reply = None
+                        queued = None
+                    else:
+                        # Команды исполняются подряд без await — транзакция атомарна
+                        reply = [self._execute(cmd) for cmd in queued]
+                        queued = None
+                    watched.clear()
+                elif queued is not None:
+                    queued.append(args)
+                    reply = _Status("QUEUED")
+                else:
+                    reply = self._execute(args)
+                writer.write(self._encode(reply))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def _execute(self, args: List[str]) -> Any:
+        name = args[0].upper()
+        handler = self._commands.get(name)
+        if handler is None:
+            return RespError(f"ERR unknown command '{args[0]}'")
+        if name in _WRITE_COMMANDS:
+            keys = list(self._data) if name in ("FLUSHALL", "FLUSHDB") else args[1:] if name == "DEL" else args[1:2]
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+        try:
+            return handler(args[1:])
+        except RespError as e:
+            return e
+        except (ValueError, IndexError):
+            return RespError("ERR syntax error")
+
+    # --- хранилище ---
+
+    def _alive(self, key: str) -> bool:
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _get(self, key: str, kind: type) -> Any:
+        if not self._alive(key):
+            return None
+        value = self._data[key]
+        if not isinstance(value, kind):
+            raise _WrongType()
+        return value
+
+    def _get_or_create(self, key: str, kind: type) -> Any:
+        value = self._get(key, kind)
+        if value is None:
+            value = self._data[key] = kind()
+        return value
+
+    def _drop_if_empty(self, key: str) -> None:
+        if key in self._data and not self._data[key]:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    # --- служебные команды ---
+
+    def cmd_ping(self, args: List[str]) -> Any:
+        return args[0] if args else _Status("PONG")
+
+    def cmd_echo(self, args: List[str]) -> Any:
+        return args[0]
+
+    def cmd_client(self, args: List[str]) -> Any:
+        return OK
+
+    def cmd_select(self, args: List[str]) -> Any:
+        return OK
+
+    def cmd_flushall(self, args: List[str]) -> Any:
+        self._data.clear()
+        self._expires.clear()
+        return OK
+
+    cmd_flushdb = cmd_flushall
+
+    # --- ключи ---
+
+    def cmd_del(self, args: List[str]) -> Any:
+        removed = 0
+        for key in args:
+            if self._alive(key):
+                self._data.pop(key)
+                self._expires.pop(key, None)
+                removed += 1
+        return removed
+
+    def cmd_exists(self, args: List[str]) -> Any:
+        return sum(1 for key in args if self._alive(key))
+
+    def cmd_pexpire(self, args: List[str]) -> Any:
+        key, ms = args[0], int(args[1])
+        if not self._alive(key):
+            return 0
+        self._expires[key] = time.monotonic() + ms / 1000
+        return 1
+
+    def cmd_expire(self, args: List[str]) -> Any:
+        return self.cmd_pexpire([args[0], str(int(args[1]) * 1000)])
+
+    def cmd_pttl(self, args: List[str]) -> Any:
+        key = args[0]
+        if not self._alive(key):
+            return -2
+        deadline = self._expires.get(key)
+        return -1 if deadline is None else max(0, int((deadline - time.monotonic()) * 1000))
+
+    def cmd_scan(self, args: List[str]) -> Any:
+        pattern = "*"
+        for i in range(1, len(args) - 1):
+            if args[i].upper() == "MATCH":
+                pattern = args[i + 1]
+        keys = [k for k in list(self._data) if self._alive(k) and fnmatch.fnmatchcase(k, pattern)]
+        return ["0", keys]
+
+    # --- строки ---
+
+    def cmd_get(self, args: List[str]) -> Any:
+        return self._get(args[0], str)
+
+    def cmd_mget(self, args: List[str]) -> Any:
+        return [self._get(key, str) for key in args]
+
+    def cmd_set(self, args: List[str]) -> Any:
+        key, value = args[0], args[1]
+        ttl_ms: Optional[int] = None
+        nx = xx = False
+        i = 2
+        while i < len(args):
+            opt = args[i].upper()
+            if opt == "EX":
+                ttl_ms = int(args[i + 1]) * 1000
+                i += 1
+            elif opt == "PX":
+                ttl_ms = int(args[i + 1])
+                i += 1
+            elif opt == "NX":
+                nx = True
+            elif opt == "XX":
+                xx = True
+            else:
+                raise ValueError(opt)
+            i += 1
+        exists = self._alive(key)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self._data[key] = value
+        self._expires.pop(key, None)
+        if ttl_ms is not None:
+            self._expires[key] = time.monotonic() + ttl_ms / 1000
+        return OK
+
+    def cmd_incrbyfloat(self, args: List[str]) -> Any:
+        key = args[0]
+        current = float(self._get(key, str) or 0)
+        value = current + float(args[1])
+        self._data[key] = _format_score(value)
+        return self._data[key]
+
+    # --- хэши ---
+
+    def cmd_hset(self, args: List[str]) -> Any:
+        record = self._get_or_create(args[0], dict)
+        added = 0
+        for field, value in zip(args[1::2], args[2::2]):
+            added += field not in record
+            record[field] = value
+        return added
+
+    def cmd_hget(self, args: List[str]) -> Any:
+        record = self._get(args[0], dict)
+        return record.get(args[1]) if record else None
+
+    def cmd_hmget(self, args: List[str]) -> Any:
+        record = self._get(args[0], dict) or {}
+        return [record.get(field) for field in args[1:]]
+
+    def cmd_hgetall(self, args: List[str]) -> Any:
+        record = self._get(args[0], dict) or {}
+        return [item for pair in record.items() for item in pair]
+
+    def cmd_hexists(self, args: List[str]) -> Any:
+        record = self._get(args[0], dict)
+        return int(bool(record) and args[1] in record)
+
+    def cmd_hdel(self, args: List[str]) -> Any:
+        record = self._get(args[0], dict)
+        if not record:
+            return 0
+        removed = sum(1 for field in args[1:] if record.pop(field, None) is not None)
+        self._drop_if_empty(args[0])
+        return removed
+
+    # --- sorted sets ---
+
+    def cmd_zadd(self, args: List[str]) -> Any:
+        zset = self._get_or_create(args[0], _ZSet)
+        added = 0
+        for score, member in zip(args[1::2], args[2::2]):
+            added += member not in zset
+            zset[member] = float(score)
+        return added
+
+    def cmd_zrem(self, args: List[str]) -> Any:
+        zset = self._get(args[0], _ZSet)
+        if not zset:
+            return 0
+        removed = sum(1 for member in args[1:] if zset.pop(member, None) is not None)
+        self._drop_if_empty(args[0])
+        return removed
+
+    def cmd_zcard(self, args: List[str]) -> Any:
+        return len(self._get(args[0], _ZSet) or ())
+
+    def _zrange_by_score(self, zset: "_ZSet", low: str, high: str) -> List[Tuple[str, float]]:
+        lo, lo_ex = _parse_score(low)
+        hi, hi_ex = _parse_score(high)
+        items = sorted(zset.items(), key=lambda item: (item[1], item[0]))
+        return [
+            (member, score)
+            for member, score in items
+            if (score > lo if lo_ex else score >= lo) and (score < hi if hi_ex else score <= hi)
+        ]
+
+    def cmd_zcount(self, args: List[str]) -> Any:
+        return len(self._zrange_by_score(self._get(args[0], _ZSet) or _ZSet(), args[1], args[2]))
+
+    def cmd_zremrangebyscore(self, args: List[str]) -> Any:
+        zset = self._get(args[0], _ZSet)
+        if not zset:
+            return 0
+        doomed = self._zrange_by_score(zset, args[1], args[2])
+        for member, _ in doomed:
+            del zset[member]
+        self._drop_if_empty(args[0])
+        return len(doomed)
+
+    def cmd_zrangebyscore(self, args: List[str]) -> Any:
+        zset = self._get(args[0], _ZSet) or _ZSet()
+        items = self._zrange_by_score(zset, args[1], args[2])
+        with_scores = False
+        i = 3
+        while i < len(args):
+            opt = args[i].upper()
+            if opt == "WITHSCORES":
+                with_scores = True
+            elif opt == "LIMIT":
+                offset, count = int(args[i + 1]), int(args[i + 2])
+                items = items[offset:] if count < 0 else items[offset:offset + count]
+                i += 2
+            i += 1
+        if with_scores:
+            return [v for member, score in items for v in (member, _format_score(score))]
+        return [member for member, _ in items]
+
+
+class _Status(str):
+    """Простой строковый ответ (+OK)"""
+
+
+class _ZSet(dict):
+    """member -> score"""
+
+
+OK = _Status("OK")
+
+
+async def _serve(host: str, port: int) -> None:
+    server = RespServer(host, port)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-memory RESP stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    ns = parser.parse_args()
+    asyncio.run(_serve(ns.host, ns.port))
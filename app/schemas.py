@@ -0,0 +1,108 @@
+"""
+Типизированные ответы backend.
+
+Backend в разных версиях называет одни и те же поля по-разному (user_id / backend_user_id /
+linked_user_id, response / message / text / ...). Варианты нормализуются здесь один раз,
+на границе BackendClient, и дальше бот работает только с этими структурами.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+
+def _first(data: Dict[str, Any], *keys: str) -> Any:
+    for key in keys:
+        value = data.get(key)
+        if value:
+            return value
+    return None
+
+
+def _as_int(value: Any) -> Optional[int]:
+    """Число из int или строки с числом (backend может отдавать id строкой)"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    return None
+
+
+@dataclass(slots=True)
+class TelegramUser:
+    telegram_user_id: Optional[int]
+    # ID основного аккаунта, если Telegram пользователь с ним связан
+    backend_user_id: Optional[int]
+    telegram_username: Optional[str]
+
+    @classmethod
+    def from_payload(cls, data: Dict[str, Any]) -> "TelegramUser":
+        return cls(
+            telegram_user_id=_as_int(data.get("telegram_user_id")),
+            backend_user_id=_first(data, "user_id", "backend_user_id", "linked_user_id"),
+            telegram_username=data.get("telegram_username"),
+        )
+
+
+@dataclass(slots=True)
+class ChatReply:
+    text: Optional[str]
+    # ID разговора, если backend его вернул (например, для нового разговора)
+    conversation_id: Optional[str]
+    # Потраченные на генерацию токены, если backend сообщает usage
+    tokens: Optional[int] = None
+
+    @classmethod
+    def from_payload(cls, data: Any) -> "ChatReply":
+        if isinstance(data, str):
+            return cls(text=data, conversation_id=None)
+        if not isinstance(data, dict):
+            return cls(text=None, conversation_id=None)
+        nested = data.get("data")
+        text = _first(data, "response", "message", "text", "content", "answer")
+        if not text and isinstance(nested, dict):
+            text = nested.get("response")
+        conversation_id = _first(data, "conversation_id", "conversationId", "id")
+        usage = data.get("usage")
+        tokens = _first(usage, "total_tokens", "tokens") if isinstance(usage, dict) else _first(data, "total_tokens", "tokens")
+        return cls(
+            text=text,
+            conversation_id=str(conversation_id) if conversation_id is not None else None,
+            tokens=int(tokens) if isinstance(tokens, (int, float)) else None,
+        )
+
+
+@dataclass(slots=True)
+class Conversation:
+    id: str
+    title: str
+
+    @classmethod
+    def from_payload(cls, data: Dict[str, Any]) -> "Conversation":
+        conv_id = _first(data, "id", "conversation_id")
+        return cls(
+            id=str(conv_id),
+            title=_first(data, "title", "name") or f"Разговор #{conv_id}",
+        )
+
+
+@dataclass(slots=True)
+class HistoryMessage:
+    role: str
+    content: str
+    # Заголовок разговора (backend присылает его в сообщениях)
+    title: Optional[str] = None
+    # ID и время сообщения на backend (курсор для delta-синхронизации)
+    id: Optional[str] = None
+    created_at: Optional[str] = None
+
+    @classmethod
+    def from_payload(cls, data: Dict[str, Any]) -> "HistoryMessage":
+        message_id = _first(data, "id", "message_id")
+        return cls(
+            role=_first(data, "role", "name") or "user",
+            content=_first(data, "content", "message", "text") or "",
+            title=data.get("title") or None,
+            id=str(message_id) if message_id is not None else None,
+            created_at=_first(data, "created_at", "createdAt", "timestamp"),
+        )
@@ -0,0 +1,271 @@
+"""
+Сессии пользователей в backend: токены и кэш профилей.
+
+Токен, полученный при регистрации, хранится в UserStorage вместе с email и паролем,
+но сам по себе истекает. SessionManager:
+    - отдает действующий токен пользователя; истекший (или отклоненный backend) токен
+      заменяется новым через BackendClient.login по сохраненным учетным данным —
+      одновременные запросы одного пользователя ждут один вход;
+    - в фоне заранее обновляет токены активных пользователей, которые истекают в ближайшие
+      SESSION_REFRESH_BEFORE_SECONDS, чтобы запросы не ждали входа;
+    - после неудачного входа по сохраненным данным забывает сессию и не повторяет вход
+      автоматически от минуты до часа (вдвое дольше после каждой новой неудачи), чтобы не
+      попасть под блокировку аккаунта; вход через /login с вводом пароля не ограничен;
+    - кэширует профиль (get_profile) по токену на SESSION_PROFILE_TTL_SECONDS.
+
+Срок действия берется из поля exp, если токен — JWT, иначе считается
+SESSION_TOKEN_TTL_SECONDS от входа (0 — неизвестен: токен меняется только после отказа backend).
+"""
+import asyncio
+import base64
+import contextvars
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from .backend_client import BackendClient, TokenRejected
+from .codec import loads
+from .logger import logger
+
+# Пауза перед повторным автоматическим входом после неудачи: от первой до последней, секунды
+_LOGIN_BACKOFF_SECONDS = 60.0
+_LOGIN_BACKOFF_MAX_SECONDS = 3600.0
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """Момент истечения JWT (поле exp, unix time) без проверки подписи; None — не JWT или нет exp"""
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        payload = loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+    except Exception:
+        return None
+    exp = payload.get("exp") if isinstance(payload, dict) else None
+    return float(exp) if isinstance(exp, (int, float)) else None
+
+
+class SessionManager:
+    def __init__(
+        self,
+        backend: BackendClient,
+        storage: Any,
+        profile_ttl_seconds: float = 300.0,
+        token_ttl_seconds: float = 3600.0,
+        refresh_before_seconds: float = 300.0,
+        refresh_interval_seconds: float = 60.0,
+        refresh_concurrency: int = 4,
+    ):
+        self.backend = backend
+        self.storage = storage
+        self.profile_ttl_seconds = profile_ttl_seconds
+        self.token_ttl_seconds = token_ttl_seconds
+        self.refresh_before_seconds = refresh_before_seconds
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.refresh_concurrency = refresh_concurrency
+        # token -> (момент истечения записи, профиль)
+        self._profiles: Dict[str, Tuple[float, Dict]] = {}
+        # telegram_user_id -> (token, момент истечения токена по time.time() или None, последнее использование)
+        self._sessions: Dict[int, Tuple[str, Optional[float], float]] = {}
+        # Входы в процессе: одновременные запросы пользователя ждут один и тот же
+        self._logins: Dict[int, asyncio.Task] = {}
+        # telegram_user_id -> (monotonic-время, до которого вход не повторяется, пауза)
+        self._login_backoff: Dict[int, Tuple[float, float]] = {}
+        # Загрузки профилей в процессе по токенам
+        self._profile_loads: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.logins = 0
+        self.failed_logins = 0
+        self.refreshed = 0
+        self.profile_hits = 0
+        self.profile_misses = 0
+
+    # --- токены ---
+
+    def _expiry(self, token: str, issued_at: Optional[float]) -> Optional[float]:
+        expires_at = token_expiry(token)
+        if expires_at is None and issued_at is not None and self.token_ttl_seconds > 0:
+            expires_at = issued_at + self.token_ttl_seconds
+        return expires_at
+
+    def remember(self, telegram_user_id: int, token: str, issued_at: Optional[float] = None) -> None:
+        """Запоминает токен (например, полученный при регистрации); issued_at — момент выдачи"""
+        previous = self._sessions.get(telegram_user_id)
+        if previous is not None and previous[0] != token:
+            # Профиль переходит к новому токену: обновление токена не сбрасывает кэш
+            cached = self._profiles.pop(previous[0], None)
+            if cached is not None:
+                self._profiles[token] = cached
+        self._sessions[telegram_user_id] = (token, self._expiry(token, issued_at), time.monotonic())
+
+    async def token(self, telegram_user_id: int) -> Optional[str]:
+        """Действующий токен; истекший заменяется новым входом. None — войти не удалось"""
+        session = self._sessions.get(telegram_user_id)
+        if session is None:
+            token = await self.storage.get_token(telegram_user_id)
+            if token is None:
+                return await self.login(telegram_user_id)
+            self.remember(telegram_user_id, token)
+            session = self._sessions[telegram_user_id]
+        token, expires_at, _ = session
+        if expires_at is not None and expires_at <= time.time():
+            return await self.login(telegram_user_id)
+        self._sessions[telegram_user_id] = (token, expires_at, time.monotonic())
+        return token
+
+    async def login(self, telegram_user_id: int) -> Optional[str]:
+        """Вход по сохраненным учетным данным; одновременные вызовы для пользователя ждут один вход"""
+        task = self._logins.get(telegram_user_id)
+        if task is None:
+            # Пустой контекст: вход нужен всем ожидающим, а не только обновлению, которое его начало
+            task = asyncio.create_task(
+                self._login(telegram_user_id),
+                name=f"session-login-{telegram_user_id}",
+                context=contextvars.Context(),
+            )
+            self._logins[telegram_user_id] = task
+            task.add_done_callback(lambda _: self._logins.pop(telegram_user_id, None))
+        return await asyncio.shield(task)
+
+    async def _login(self, telegram_user_id: int) -> Optional[str]:
+        backoff = self._login_backoff.get(telegram_user_id)
+        if backoff is not None and backoff[0] > time.monotonic():
+            return None
+        credentials = await self.storage.get_credentials(telegram_user_id)
+        email, password = credentials.get("email"), credentials.get("password")
+        token = await self.login_with(telegram_user_id, email, password) if email and password else None
+        if token is None:
+            # Устаревшие учетные данные: истекшая сессия не должна снова попадать в обновление
+            self.forget(telegram_user_id)
+            delay = min(_LOGIN_BACKOFF_MAX_SECONDS, backoff[1] * 2) if backoff is not None else _LOGIN_BACKOFF_SECONDS
+            self._login_backoff[telegram_user_id] = (time.monotonic() + delay, delay)
+        return token
+
+    async def login_with(self, telegram_user_id: int, email: str, password: str) -> Optional[str]:
+        """Вход по email и паролю; при успехе токен и учетные данные сохраняются"""
+        issued_at = time.time()
+        result = await self.backend.login(email, password)
+        if not result or not result.get("token"):
+            self.failed_logins += 1
+            logger.warning("Backend login for telegram user %s failed", telegram_user_id)
+            return None
+        self.logins += 1
+        self._login_backoff.pop(telegram_user_id, None)
+        token = result["token"]
+        await self.storage.set(
+            telegram_user_id=telegram_user_id,
+            backend_user_id=result.get("user_id"),
+            token=token,
+            email=email,
+            password=password,
+        )
+        self.remember(telegram_user_id, token, issued_at)
+        return token
+
+    def forget(self, telegram_user_id: int) -> None:
+        session = self._sessions.pop(telegram_user_id, None)
+        if session is not None:
+            self._profiles.pop(session[0], None)
+
+    # --- профили ---
+
+    async def profile(self, telegram_user_id: int) -> Optional[Dict]:
+        """Профиль пользователя из кэша или backend; одновременные запросы ждут одну загрузку"""
+        token = await self.token(telegram_user_id)
+        if token is None:
+            return None
+        cached = self._profiles.get(token)
+        if cached is not None and cached[0] > time.monotonic():
+            self.profile_hits += 1
+            return cached[1]
+        task = self._profile_loads.get(token)
+        if task is None:
+            self.profile_misses += 1
+            task = asyncio.create_task(
+                self._load_profile(telegram_user_id, token),
+                name=f"session-profile-{telegram_user_id}",
+                context=contextvars.Context(),
+            )
+            self._profile_loads[token] = task
+            task.add_done_callback(lambda _: self._profile_loads.pop(token, None))
+        return await asyncio.shield(task)
+
+    async def _load_profile(self, telegram_user_id: int, token: str) -> Optional[Dict]:
+        try:
+            profile = await self.backend.get_profile(token)
+        except TokenRejected:
+            # Токен отклонен до истечения срока — новый вход и одна повторная попытка
+            self._profiles.pop(token, None)
+            token = await self.login(telegram_user_id)
+            if token is None:
+                return None
+            try:
+                profile = await self.backend.get_profile(token)
+            except TokenRejected:
+                return None
+        if profile is not None:
+            self._profiles[token] = (time.monotonic() + self.profile_ttl_seconds, profile)
+        return profile
+
+    # --- фоновое обновление ---
+
+    def _purge(self) -> None:
+        now = time.monotonic()
+        for token in [token for token, (expires_at, _) in self._profiles.items() if expires_at <= now]:
+            del self._profiles[token]
+        # Пользователи, которые давно ничего не делали, больше не обновляются заранее
+        idle = max(self.token_ttl_seconds, self.refresh_before_seconds, 3600.0)
+        for telegram_user_id in [uid for uid, (_, _, used) in self._sessions.items() if now - used > idle]:
+            self.forget(telegram_user_id)
+        for telegram_user_id in [
+            uid for uid, (until, _) in self._login_backoff.items() if now - until > _LOGIN_BACKOFF_MAX_SECONDS
+        ]:
+            del self._login_backoff[telegram_user_id]
+
+    async def refresh_due(self) -> int:
+        """Обновляет токены, которые истекают в ближайшие refresh_before_seconds; число обновленных"""
+        self._purge()
+        deadline = time.time() + self.refresh_before_seconds
+        due = [
+            telegram_user_id
+            for telegram_user_id, (_, expires_at, _) in self._sessions.items()
+            if expires_at is not None and expires_at <= deadline
+        ]
+        if not due:
+            return 0
+        limit = asyncio.Semaphore(self.refresh_concurrency)
+
+        async def refresh(telegram_user_id: int) -> bool:
+            async with limit:
+                return await self.login(telegram_user_id) is not None
+
+        results = await asyncio.gather(*(refresh(uid) for uid in due), return_exceptions=True)
+        refreshed = sum(1 for result in results if result is True)
+        self.refreshed += refreshed
+        if refreshed:
+            logger.info("Refreshed %s of %s expiring backend tokens", refreshed, len(due))
+        return refreshed
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="session-refresher")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval_seconds)
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                logger.exception("Session refresh failed: %s", e)
+
+    def size(self) -> Tuple[int, int]:
+        """Число отслеживаемых сессий и закэшированных профилей"""
+        return len(self._sessions), len(self._profiles)
@@ -0,0 +1,125 @@
+"""
+Выбор хранилищ состояния бота.
+
+STATE_BACKEND=memory — лимитер и состояния в памяти процесса, пользователи в локальном файле
+(подходит только для одной реплики).
+STATE_BACKEND=redis — всё состояние в Redis (или совместимом сервере), реплики делят
+лимиты и данные пользователей.
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+from .config import settings
+from .dedup import DedupStore
+from .logger import logger
+from .quota import QuotaCounter, WeightedQuota
+from .rate_limiter import RateLimiter
+from .user_storage import UserStorage
+
+
+class UserStates:
+    """
+    Временные состояния пользователей (например, шаг регистрации) в памяти процесса.
+    Состояние истекает через ttl_seconds, как в RedisUserStates: брошенная регистрация
+    не остается в памяти навсегда.
+    """
+
+    def __init__(self, ttl_seconds: int = 3600):
+        self.ttl_seconds = ttl_seconds
+        # telegram_user_id -> (состояние, момент истечения); порядок вставки совпадает с порядком истечения
+        self._states: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+
+    def _purge(self, now: float) -> None:
+        while self._states:
+            telegram_user_id, (_, expires_at) = next(iter(self._states.items()))
+            if expires_at > now:
+                return
+            del self._states[telegram_user_id]
+
+    async def get(self, telegram_user_id: int) -> Optional[str]:
+        entry = self._states.get(telegram_user_id)
+        if entry is None:
+            return None
+        state, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._states[telegram_user_id]
+            return None
+        return state
+
+    async def set(self, telegram_user_id: int, state: str) -> None:
+        now = time.monotonic()
+        self._purge(now)
+        self._states.pop(telegram_user_id, None)
+        self._states[telegram_user_id] = (state, now + self.ttl_seconds)
+
+    async def pop(self, telegram_user_id: int) -> Optional[str]:
+        entry = self._states.pop(telegram_user_id, None)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+
+@dataclass
+class StateBackends:
+    rate_limiter: Any
+    user_storage: Any
+    user_states: Any
+    dedup: Any
+    # Взвешенная квота (None, если WEIGHTED_QUOTA выключена)
+    quota: Optional[WeightedQuota] = None
+
+
+def _weighted_quota(counter: Any) -> Optional[WeightedQuota]:
+    if not settings.weighted_quota:
+        return None
+    return WeightedQuota(
+        counter,
+        user_budget=settings.quota_user_units_per_minute,
+        global_budget=settings.quota_global_units_per_minute,
+        chars_per_unit=settings.quota_chars_per_unit,
+        document_units=settings.quota_document_units,
+        units_per_second=settings.quota_units_per_second,
+        tokens_per_unit=settings.quota_tokens_per_unit,
+        max_wait_seconds=settings.quota_max_wait_seconds,
+        low_priority_concurrency=settings.quota_low_priority_concurrency,
+    )
+
+
+def create_state_backends() -> StateBackends:
+    """Создает хранилища согласно STATE_BACKEND"""
+    kind = settings.state_backend.lower()
+    if kind == "redis":
+        from .redis_state import (
+            RedisDedupStore,
+            RedisQuotaCounter,
+            RedisRateLimiter,
+            RedisUserStates,
+            RedisUserStorage,
+            create_redis,
+        )
+
+        redis = create_redis(settings.redis_url)
+        prefix = settings.redis_prefix
+        logger.info("Using Redis state backend (prefix=%s)", prefix)
+        return StateBackends(
+            rate_limiter=RedisRateLimiter(redis, prefix, per_minute=settings.rate_limit_per_minute),
+            user_storage=RedisUserStorage(redis, prefix),
+            user_states=RedisUserStates(redis, prefix, ttl_seconds=settings.user_state_ttl_seconds),
+            dedup=RedisDedupStore(redis, prefix, ttl_seconds=settings.dedup_ttl_seconds),
+            quota=_weighted_quota(RedisQuotaCounter(redis, prefix)),
+        )
+    if kind != "memory":
+        raise ValueError(f"Unknown STATE_BACKEND: {settings.state_backend}")
+    return StateBackends(
+        rate_limiter=RateLimiter(per_minute=settings.rate_limit_per_minute),
+        user_storage=UserStorage(),
+        user_states=UserStates(ttl_seconds=settings.user_state_ttl_seconds),
+        dedup=DedupStore(
+            settings.dedup_journal_file,
+            ttl_seconds=settings.dedup_ttl_seconds,
+            max_keys=settings.dedup_max_keys,
+        ),
+        quota=_weighted_quota(QuotaCounter()),
+    )
@@ -0,0 +1,132 @@
+"""
+Настраиваемый транспорт Bot API.
+
+TelegramSession — AiohttpSession с явным размером пула соединений (TELEGRAM_POOL_SIZE),
+keep-alive (TELEGRAM_KEEPALIVE_SECONDS) и таймаутами по методам
+(TELEGRAM_METHOD_TIMEOUTS="sendMessage=10,sendDocument=120"). Таймаут, переданный
+вызывающим кодом явно (например, long polling), имеет приоритет.
+
+TELEGRAM_API_URL — собственный Bot API сервер (telegram-bot-api) вместо api.telegram.org:
+меньше задержка и, в режиме --local (TELEGRAM_API_LOCAL), файлы до 2 ГБ, которые читаются
+прямо с диска. Если каталог файлов сервера смонтирован в контейнер бота по другому пути,
+задаются оба пути: TELEGRAM_API_SERVER_FILES_DIR и TELEGRAM_API_LOCAL_FILES_DIR.
+
+TelegramMetrics — middleware сессии: число вызовов, ошибок и задержки по методам Bot API.
+"""
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Any, Deque, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.client.telegram import PRODUCTION, SimpleFilesPathWrapper, TelegramAPIServer
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from .config import Settings
+from .diagnostics import percentile
+
+
+def parse_method_timeouts(value: str) -> Dict[str, float]:
+    """"sendMessage=10, getFile=30" -> {"sendmessage": 10.0, "getfile": 30.0}; ValueError при ошибке"""
+    timeouts: Dict[str, float] = {}
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        method, sep, seconds = item.partition("=")
+        if not sep or not method.strip():
+            raise ValueError(f"expected method=seconds, got {item!r}")
+        timeout = float(seconds)
+        if timeout <= 0:
+            raise ValueError(f"timeout for {method.strip()} must be positive")
+        timeouts[method.strip().lower()] = timeout
+    return timeouts
+
+
+def telegram_api_server(settings: Settings) -> TelegramAPIServer:
+    if not settings.telegram_api_url:
+        return PRODUCTION
+    if settings.telegram_api_server_files_dir and settings.telegram_api_local_files_dir:
+        return TelegramAPIServer.from_base(
+            settings.telegram_api_url,
+            is_local=settings.telegram_api_local,
+            wrap_local_file=SimpleFilesPathWrapper(
+                Path(settings.telegram_api_server_files_dir),
+                Path(settings.telegram_api_local_files_dir),
+            ),
+        )
+    return TelegramAPIServer.from_base(settings.telegram_api_url, is_local=settings.telegram_api_local)
+
+
+class TelegramSession(AiohttpSession):
+    def __init__(
+        self,
+        api: TelegramAPIServer = PRODUCTION,
+        pool_size: int = 100,
+        keepalive_seconds: float = 30.0,
+        timeout: float = 60.0,
+        method_timeouts: Optional[Dict[str, float]] = None,
+    ):
+        super().__init__(api=api, limit=pool_size, timeout=timeout)
+        self._connector_init["keepalive_timeout"] = keepalive_seconds
+        self.method_timeouts = method_timeouts or {}
+
+    async def make_request(self, bot: Bot, method: TelegramMethod[TelegramType], timeout: Optional[int] = None) -> TelegramType:
+        if timeout is None:
+            timeout = self.method_timeouts.get(method.__api_method__.lower())
+        return await super().make_request(bot, method, timeout=timeout)
+
+
+def create_telegram_session(settings: Settings) -> TelegramSession:
+    return TelegramSession(
+        api=telegram_api_server(settings),
+        pool_size=settings.telegram_pool_size,
+        keepalive_seconds=settings.telegram_keepalive_seconds,
+        timeout=settings.telegram_timeout_seconds,
+        method_timeouts=parse_method_timeouts(settings.telegram_method_timeouts),
+    )
+
+
+class TelegramMetrics(BaseRequestMiddleware):
+    """Middleware сессии Bot API: вызовы, ошибки и задержки по методам"""
+
+    def __init__(self, history: int = 500):
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self._latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=history))
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = method.__api_method__
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.calls[name] += 1
+            # Long polling ждет обновлений, а не сеть — его задержка не показательна
+            if name != "getUpdates":
+                self._latencies[name].append(time.monotonic() - started)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Метод -> {calls, errors, p50_ms, p95_ms, max_ms}, по убыванию числа вызовов"""
+        result = {}
+        for name in sorted(self.calls, key=self.calls.get, reverse=True):
+            ms = [x * 1000 for x in self._latencies.get(name, ())]
+            result[name] = {
+                "calls": self.calls[name],
+                "errors": self.errors[name],
+                "p50_ms": round(percentile(ms, 50), 1),
+                "p95_ms": round(percentile(ms, 95), 1),
+                "max_ms": round(max(ms, default=0.0), 1),
+            }
+        return result
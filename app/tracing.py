@@ -0,0 +1,207 @@
+"""
+Легковесная трассировка: спаны от получения обновления Telegram до отправки ответа.
+
+Решение о сэмплировании принимается один раз в корне трассы (TRACE_SAMPLE_RATE),
+дочерние спаны наследуют его. Для несэмплированных трасс используется общий no-op спан,
+поэтому при выключенной трассировке накладные расходы — одно чтение contextvar.
+
+Спаны пишутся в JSONL-файл (TRACE_FILE) в формате, близком к OTLP JSON:
+traceId, spanId, parentSpanId, name, startTimeUnixNano, endTimeUnixNano, attributes, status.
+В backend контекст передается заголовком W3C traceparent.
+"""
+import asyncio
+import contextvars
+import random
+import secrets
+import time
+from contextvars import ContextVar, Token
+from typing import Any, Awaitable, Callable, Dict, List, MutableMapping, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from .codec import dumps
+from .config import settings
+from .logger import logger
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "status", "_token")
+
+    sampled = True
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = 0
+        self.end_ns = 0
+        self.attributes = attributes
+        self.status = "OK"
+        self._token: Optional[Token] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> "Span":
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end_ns = time.time_ns()
+        if exc_type is not None:
+            self.status = "ERROR"
+            self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+        exporter.export(self, is_root=self.parent_id is None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+class _NoopSpan:
+    """Спан несэмплированной трассы: ничего не записывает"""
+
+    sampled = False
+    _token: Optional[Token] = None
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+class _NoopRoot(_NoopSpan):
+    """Корень несэмплированной трассы: помечает контекст, чтобы дочерние спаны тоже были no-op"""
+
+    def __enter__(self) -> "_NoopRoot":
+        self._token = _current_span.set(NOOP_SPAN)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current_span.reset(self._token)
+
+
+NOOP_SPAN = _NoopSpan()
+_current_span: ContextVar[Any] = ContextVar("current_span", default=None)
+
+
+class JsonlExporter:
+    """
+    Пишет спаны в JSONL-файл, сбрасывая буфер по завершении корневого спана.
+    Запись идет фоновой задачей в пуле потоков: спаны, завершившиеся во время записи,
+    уходят следующей пачкой.
+    """
+
+    def __init__(self, path: str, max_buffer: int = 256):
+        self.path = path
+        self.max_buffer = max_buffer
+        self._buffer: List[str] = []
+        self._writer: Optional[asyncio.Task] = None
+
+    def export(self, span: Span, is_root: bool = False) -> None:
+        self._buffer.append(dumps(span.to_dict(), default=str).decode("utf-8"))
+        if is_root or len(self._buffer) >= self.max_buffer:
+            self._schedule()
+
+    def _schedule(self) -> None:
+        if self._writer is not None:
+            # Запишет и новые спаны, когда закончит текущую пачку
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (CLI, тесты) — пишем сразу
+            self.flush()
+            return
+        # Пустой контекст: запись не относится к трассе и дедлайну обновления, которое ее начало
+        self._writer = loop.create_task(self._write_pending(), name="trace-exporter", context=contextvars.Context())
+
+    async def _write_pending(self) -> None:
+        try:
+            while self._buffer:
+                lines, self._buffer = self._buffer, []
+                await asyncio.to_thread(self._write, lines)
+        finally:
+            self._writer = None
+
+    def _write(self, lines: List[str]) -> None:
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except Exception as e:
+            logger.warning("Failed to export %s spans: %s", len(lines), e)
+
+    def flush(self) -> None:
+        """Синхронно дописывает буфер (вне event loop или при остановке)"""
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        self._write(lines)
+
+    async def close(self) -> None:
+        """Дожидается фоновой записи и дописывает остаток"""
+        if self._writer is not None:
+            await asyncio.shield(self._writer)
+        if self._buffer:
+            lines, self._buffer = self._buffer, []
+            await asyncio.to_thread(self._write, lines)
+
+
+exporter = JsonlExporter(settings.trace_file)
+
+
+def start_trace(name: str, **attributes: Any) -> Any:
+    """Корневой спан. Решение о сэмплировании принимается здесь."""
+    rate = settings.trace_sample_rate
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return _NoopRoot()
+    return Span(name, secrets.token_hex(16), None, attributes)
+
+
+def span(name: str, **attributes: Any) -> Any:
+    """Дочерний спан текущей трассы (no-op, если трасса не сэмплирована или ее нет)"""
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+def current_span() -> Any:
+    return _current_span.get() or NOOP_SPAN
+
+
+def inject_headers(headers: MutableMapping[str, str]) -> None:
+    """Добавляет заголовок traceparent для сэмплированной трассы"""
+    current = _current_span.get()
+    if current is not None and current.sampled:
+        headers["traceparent"] = f"00-{current.trace_id}-{current.span_id}-01"
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Outer-middleware для dp.update: корневой спан на каждое обновление Telegram"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        with start_trace("telegram.update", update_id=event.update_id, update_type=event.event_type):
+            return await handler(event, data)
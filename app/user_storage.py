@@ -1,27 +1,163 @@
 """
 Хранилище для маппинга Telegram пользователей и их данных в backend.
-В production лучше использовать базу данных или Redis.
+Локальный файл подходит для одной реплики; для нескольких реплик
+используйте STATE_BACKEND=redis (см. app/redis_state.py).
+
+В памяти держатся только «горячие» поля, нужные при каждом сообщении, в компактной
+записи UserRecord (__slots__, повторяющиеся строки интернируются, conversation_id
+в виде UUID хранится 16 байтами). Учетные данные (token, email, password) нужны лишь
+при регистрации и входе: они лежат в SQLite рядом с файлом хранилища и читаются по запросу.
+Память на пользователя — python -m app.bench_memory.
 """
-from typing import Optional, Dict
-import json
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional, Dict, Iterable, Iterator, List, Union
 import os
+import sqlite3
+import sys
+import uuid
 from pathlib import Path
 
+from .codec import dumps, loads
+
+# Поля, которые не держатся в памяти
+COLD_FIELDS = ("token", "email", "password")
+
+_UUID_LENGTH = 36
+
+
+def _pack_conversation_id(value: Union[str, int]) -> Union[bytes, int, str]:
+    """Компактная форма conversation_id: UUID -> 16 байт, число -> int, иначе строка"""
+    if isinstance(value, int):
+        return value
+    if len(value) == _UUID_LENGTH:
+        try:
+            packed = uuid.UUID(value)
+        except ValueError:
+            pass
+        else:
+            if str(packed) == value:
+                return packed.bytes
+    if value.isdigit() and str(int(value)) == value:
+        return int(value)
+    return value
+
+
+def _unpack_conversation_id(value: Union[bytes, int, str, None]) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return str(uuid.UUID(bytes=value))
+    return str(value)
+
+
+@dataclass(slots=True)
+class UserRecord:
+    backend_user_id: Optional[int] = None
+    telegram_username: Optional[str] = None
+    conversation_id: Union[bytes, int, str, None] = None
+    # Есть токен в хранилище учетных данных (пользователь зарегистрирован)
+    registered: bool = False
+
+    def to_dict(self) -> Dict:
+        user_data: Dict = {}
+        if self.backend_user_id is not None:
+            user_data["backend_user_id"] = self.backend_user_id
+        if self.telegram_username is not None:
+            user_data["telegram_username"] = self.telegram_username
+        if self.conversation_id is not None:
+            user_data["conversation_id"] = _unpack_conversation_id(self.conversation_id)
+        if self.registered:
+            user_data["registered"] = True
+        return user_data
+
+    @classmethod
+    def from_dict(cls, user_data: Dict) -> "UserRecord":
+        username = user_data.get("telegram_username")
+        conversation_id = user_data.get("conversation_id")
+        return cls(
+            backend_user_id=user_data.get("backend_user_id"),
+            telegram_username=sys.intern(username) if username is not None else None,
+            conversation_id=_pack_conversation_id(conversation_id) if conversation_id is not None else None,
+            registered=bool(user_data.get("registered")) or user_data.get("token") is not None,
+        )
+
+
+class CredentialStore:
+    """Учетные данные пользователей в SQLite: на диске, в память читаются по одной записи"""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS credentials ("
+            "telegram_user_id INTEGER PRIMARY KEY, token TEXT, email TEXT, password TEXT)"
+        )
+
+    def get(self, telegram_user_id: int) -> Dict[str, str]:
+        row = self._db.execute(
+            "SELECT token, email, password FROM credentials WHERE telegram_user_id = ?", (telegram_user_id,)
+        ).fetchone()
+        if row is None:
+            return {}
+        return {field: value for field, value in zip(COLD_FIELDS, row) if value is not None}
+
+    def set(self, telegram_user_id: int, **fields: Optional[str]) -> None:
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if not fields:
+            return
+        columns = ", ".join(fields)
+        updates = ", ".join(f"{k} = excluded.{k}" for k in fields)
+        self._db.execute(
+            f"INSERT INTO credentials (telegram_user_id, {columns}) VALUES (?{', ?' * len(fields)}) "
+            f"ON CONFLICT(telegram_user_id) DO UPDATE SET {updates}",
+            (telegram_user_id, *fields.values()),
+        )
+
+    def delete(self, telegram_user_id: int) -> None:
+        self._db.execute("DELETE FROM credentials WHERE telegram_user_id = ?", (telegram_user_id,))
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Несколько записей одной транзакцией (без нее каждая запись — отдельный fsync)"""
+        self._db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def close(self) -> None:
+        self._db.close()
+
 
 class UserStorage:
-    def __init__(self, storage_file: str = "user_storage.json"):
+    def __init__(self, storage_file: str = "user_storage.json", credentials_file: str = "user_credentials.sqlite3"):
         self.storage_file = Path(storage_file)
-        self._storage: Dict[int, Dict] = {}
+        self._storage: Dict[int, UserRecord] = {}
+        self._credentials = CredentialStore(credentials_file)
         self._load()
 
     def _load(self) -> None:
-        """Загружает данные из файла"""
+        """Загружает данные из файла; учетные данные из старого формата переносятся в SQLite"""
         if self.storage_file.exists():
             try:
-                with open(self.storage_file, "r", encoding="utf-8") as f:
-                    self._storage = json.load(f)
-                    # Конвертируем ключи обратно в int
-                    self._storage = {int(k): v for k, v in self._storage.items()}
+                with open(self.storage_file, "rb") as f:
+                    raw = loads(f.read())
+                migrated = False
+                # Перенос учетных данных одной транзакцией: по отдельности — fsync на каждого пользователя
+                with self._credentials.transaction():
+                    for key, user_data in raw.items():
+                        # Конвертируем ключи обратно в int
+                        telegram_user_id = int(key)
+                        cold = {field: user_data.get(field) for field in COLD_FIELDS}
+                        if any(value is not None for value in cold.values()):
+                            self._credentials.set(telegram_user_id, **cold)
+                            migrated = True
+                        self._storage[telegram_user_id] = UserRecord.from_dict(user_data)
+                del raw
+                if migrated:
+                    self._save()
             except Exception as e:
                 print(f"Error loading storage: {e}")
                 self._storage = {}
@@ -29,16 +165,30 @@ class UserStorage:
     def _save(self) -> None:
         """Сохраняет данные в файл"""
         try:
-            with open(self.storage_file, "w", encoding="utf-8") as f:
-                json.dump(self._storage, f, ensure_ascii=False, indent=2)
+            with open(self.storage_file, "wb") as f:
+                f.write(dumps({k: record.to_dict() for k, record in self._storage.items()}))
         except Exception as e:
             print(f"Error saving storage: {e}")
 
-    def get(self, telegram_user_id: int) -> Optional[Dict]:
-        """Получает данные пользователя"""
-        return self._storage.get(telegram_user_id)
+    async def get(self, telegram_user_id: int) -> Optional[Dict]:
+        """Получает данные пользователя (без учетных данных — см. get_credentials)"""
+        record = self._storage.get(telegram_user_id)
+        return record.to_dict() if record is not None else None
 
-    def set(
+    async def get_many(self, telegram_user_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Получает данные нескольких пользователей (отсутствующие пропускаются)"""
+        result: Dict[int, Dict] = {}
+        for telegram_user_id in telegram_user_ids:
+            record = self._storage.get(telegram_user_id)
+            if record is not None:
+                result[telegram_user_id] = record.to_dict()
+        return result
+
+    async def get_credentials(self, telegram_user_id: int) -> Dict[str, str]:
+        """token, email и password пользователя (читаются с диска)"""
+        return self._credentials.get(telegram_user_id)
+
+    def _apply(
         self,
         telegram_user_id: int,
         backend_user_id: Optional[int] = None,
@@ -48,49 +198,95 @@ class UserStorage:
         telegram_username: Optional[str] = None,
         conversation_id: Optional[str] = None,
     ) -> None:
-        """Сохраняет данные пользователя"""
-        if telegram_user_id not in self._storage:
-            self._storage[telegram_user_id] = {}
-        
+        record = self._storage.get(telegram_user_id)
+        if record is None:
+            record = self._storage[telegram_user_id] = UserRecord()
+
         if backend_user_id is not None:
-            self._storage[telegram_user_id]["backend_user_id"] = backend_user_id
-        if token is not None:
-            self._storage[telegram_user_id]["token"] = token
-        if email is not None:
-            self._storage[telegram_user_id]["email"] = email
-        if password is not None:
-            self._storage[telegram_user_id]["password"] = password
+            record.backend_user_id = backend_user_id
         if telegram_username is not None:
-            self._storage[telegram_user_id]["telegram_username"] = telegram_username
+            record.telegram_username = sys.intern(telegram_username)
         if conversation_id is not None:
-            self._storage[telegram_user_id]["conversation_id"] = conversation_id
-        
+            record.conversation_id = _pack_conversation_id(conversation_id)
+        if token is not None or email is not None or password is not None:
+            self._credentials.set(telegram_user_id, token=token, email=email, password=password)
+            if token is not None:
+                record.registered = True
+
+    async def set(
+        self,
+        telegram_user_id: int,
+        backend_user_id: Optional[int] = None,
+        token: Optional[str] = None,
+        email: Optional[str] = None,
+        password: Optional[str] = None,
+        telegram_username: Optional[str] = None,
+        conversation_id: Optional[str] = None,
+    ) -> None:
+        """Сохраняет данные пользователя"""
+        self._apply(
+            telegram_user_id,
+            backend_user_id=backend_user_id,
+            token=token,
+            email=email,
+            password=password,
+            telegram_username=telegram_username,
+            conversation_id=conversation_id,
+        )
+        self._save()
+
+    async def set_many(self, users: Dict[int, Dict]) -> None:
+        """Сохраняет данные многих пользователей (поля как в set): одна транзакция SQLite и одна запись файла"""
+        if not users:
+            return
+        with self._credentials.transaction():
+            for telegram_user_id, fields in users.items():
+                self._apply(telegram_user_id, **fields)
         self._save()
 
-    def has_user(self, telegram_user_id: int) -> bool:
+    async def delete(self, telegram_user_id: int) -> None:
+        """Удаляет пользователя"""
+        if self._storage.pop(telegram_user_id, None) is not None:
+            self._credentials.delete(telegram_user_id)
+            self._save()
+
+    async def iter_user_ids(self, after: Optional[int] = None, batch_size: int = 500) -> AsyncIterator[List[int]]:
+        """
+        Отдает telegram_user_id по возрастанию страницами, начиная после after.
+        Порядок стабилен, поэтому по последнему отданному id можно продолжить обход.
+        """
+        ids = sorted(k for k in self._storage if after is None or k > after)
+        for i in range(0, len(ids), batch_size):
+            yield ids[i:i + batch_size]
+
+    async def has_user(self, telegram_user_id: int) -> bool:
         """Проверяет, зарегистрирован ли пользователь"""
-        return telegram_user_id in self._storage and "token" in self._storage[telegram_user_id]
+        record = self._storage.get(telegram_user_id)
+        return record is not None and record.registered
 
-    def get_token(self, telegram_user_id: int) -> Optional[str]:
+    async def get_token(self, telegram_user_id: int) -> Optional[str]:
         """Получает токен пользователя"""
-        user_data = self.get(telegram_user_id)
-        return user_data.get("token") if user_data else None
+        if not await self.has_user(telegram_user_id):
+            return None
+        return self._credentials.get(telegram_user_id).get("token")
 
-    def get_backend_user_id(self, telegram_user_id: int) -> Optional[int]:
+    async def get_backend_user_id(self, telegram_user_id: int) -> Optional[int]:
         """Получает backend user_id"""
-        user_data = self.get(telegram_user_id)
-        return user_data.get("backend_user_id") if user_data else None
+        record = self._storage.get(telegram_user_id)
+        return record.backend_user_id if record is not None else None
 
-    def get_conversation_id(self, telegram_user_id: int) -> Optional[str]:
+    async def get_conversation_id(self, telegram_user_id: int) -> Optional[str]:
         """Получает текущий conversation_id (может быть UUID строкой или числом)"""
-        user_data = self.get(telegram_user_id)
-        conv_id = user_data.get("conversation_id") if user_data else None
-        # Конвертируем в строку, если это число
-        return str(conv_id) if conv_id is not None else None
-
-    def set_conversation_id(self, telegram_user_id: int, conversation_id: Optional[str]) -> None:
-        """Устанавливает текущий conversation_id (может быть UUID строкой или числом)"""
-        self.set(telegram_user_id=telegram_user_id, conversation_id=conversation_id)
-
-
+        record = self._storage.get(telegram_user_id)
+        return _unpack_conversation_id(record.conversation_id) if record is not None else None
 
+    async def set_conversation_id(self, telegram_user_id: int, conversation_id: Optional[str]) -> None:
+        """Устанавливает текущий conversation_id (может быть UUID строкой или числом).
+        None сбрасывает текущий разговор."""
+        if conversation_id is None:
+            record = self._storage.get(telegram_user_id)
+            if record is not None and record.conversation_id is not None:
+                record.conversation_id = None
+                self._save()
+            return
+        await self.set(telegram_user_id=telegram_user_id, conversation_id=str(conversation_id))